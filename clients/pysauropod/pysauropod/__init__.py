@@ -22,48 +22,93 @@ __version__ = "%d.%d.%d%s" % __ver_tuple__
 
 
 import json
-import uuid
+import time
+import urllib
+import threading
+import collections
+from base64 import b64encode, b64decode
 from urllib import quote as urlquote
 from urllib import unquote as urlunquote
 from urlparse import urlparse, urljoin
 
-import requests
-
-import vep
-
 from zope.interface import implements
 
-from mozsvc.util import maybe_resolve_name
-
-from pysauropod.interfaces import ISauropodConnection, ISauropodSession, Item
-from pysauropod.backends.sql import SQLBackend
+from pysauropod.interfaces import (ISauropodConnection, ISauropodSession,
+                                   Item, Change)
+from pysauropod.backends import load_backend
+from pysauropod.notify import watch_key, watch_changes
+from pysauropod.routing import (Node, HashRing, bucket_key, DEFAULT_VNODES,
+                                DEFAULT_RETRY_INTERVAL)
 from pysauropod.errors import (Error,  # NOQA
                                ConnectionError,
                                ServerError,
                                ServerBusyError,
                                ConflictError,
+                               QuotaExceededError,
+                               ResyncRequiredError,
                                AuthenticationError)
 
-# The requests module has a bug that makes it unable to access urls
-# containing a quoted slash. Monkey-patch until fix is released.
-if requests.__build__ <= 0x000801:
-    import requests.models
-    import urllib
+# Heavyweight dependencies such as requests, vep, uuid and the backends are
+# only imported when first needed, to keep down the startup time of scripts
+# and worker processes that don't use them.
+#
+# zope.interface is the exception.  pysauropod.interfaces subclasses its
+# Interface, and implements() must run as each class is defined, so it
+# can't be deferred; it accounts for only a few milliseconds of the import.
+
+# Number of threads that a DirectConnection uses for asynchronous operations
+# if its backend doesn't limit the number of connections.
+DEFAULT_MAX_WORKERS = 10
+
+
+class monkey_patched_urllib(object):
+
+    def __getattr__(self, name):
+        return getattr(urllib, name)
 
-    class monkey_patched_urllib(object):
+    def quote(self, s):
+        # Don't re-quote slashes if they're already quoted.
+        return "%2F".join(urlquote(part) for part in s.split("%2F"))
 
-        def __getattr__(self, name):
-            return getattr(urllib, name)
+    def unquote(self, s):
+        # Don't unquote slashes if they're already quoted.
+        return "%2F".join(urlunquote(part) for part in s.split("%2F"))
 
-        def quote(self, s):
-            # Don't re-quote slashes if they're already quoted.
-            return "%2F".join(urlquote(part) for part in s.split("%2F"))
 
-        def unquote(self, s):
-            # Don't unquote slashes if they're already quoted.
-            return "%2F".join(urlunquote(part) for part in s.split("%2F"))
+def _import_requests():
+    """Import the requests module, patching it if necessary."""
+    import requests
+    # The requests module has a bug that makes it unable to access urls
+    # containing a quoted slash. Monkey-patch until fix is released.
+    if requests.__build__ <= 0x000801:
+        import requests.models
+        if not isinstance(requests.models.urllib, monkey_patched_urllib):
+            requests.models.urllib = monkey_patched_urllib()
+    return requests
 
-    requests.models.urllib = monkey_patched_urllib()
+
+def _value_from_json(data):
+    """Get the value from a JSON item dict, undoing any base64 encoding."""
+    if data.get("encoding") == "base64":
+        return b64decode(data["value"])
+    return data["value"]
+
+
+def _operation_to_json(operation):
+    """Prepare a batched operation to be sent as JSON.
+
+    A value that isn't valid UTF-8 is base64-encoded, and the operation
+    given an "encoding" of "base64".
+    """
+    value = operation.get("value")
+    if value is None or isinstance(value, unicode):
+        return operation
+    try:
+        value.decode("utf8")
+    except UnicodeDecodeError:
+        operation = dict(operation, value=b64encode(value),
+                         encoding="base64")
+    return operation
 
 
 def connect(url, *args, **kwds):
@@ -73,44 +118,142 @@ def connect(url, *args, **kwds):
     Depending on the URL scheme it will load an appropriate backend and
     return an object implementing ISauropodConnection.
     """
+    # Lists of URLs are served by several nodes of the web API.
+    if not isinstance(url, basestring):
+        return WebAPIConnection(url, *args, **kwds)
     scheme = urlparse(url).scheme.lower()
     # HTTP urls use the web connector.
     if scheme in ("http", "https"):
         return WebAPIConnection(url, *args, **kwds)
-    # Memory URLs use an in-memory sqlite database
-    if scheme == "mem":
-        backend = SQLBackend("sqlite:///")
-        return DirectConnection(backend, *args, **kwds)
-    # Anything else must be a database URL.
-    backend = SQLBackend(url, create_tables=kwds.pop("create_tables", False))
+    # Anything else is served by a backend talking directly to the store.
+    backend = load_backend(url, create_tables=kwds.pop("create_tables", False))
     return DirectConnection(backend, *args, **kwds)
 
 
+class Batch(object):
+    """Ordered list of operations to be sent to the store together.
+
+    Batches are created by the batch() method of a session.  Operations are
+    queued up by calling get(), set() and delete(), and are performed when
+    the batch's "with" block exits without error, or when execute() is
+    called.  The results are then available in the "results" attribute.
+    """
+
+    def __init__(self, session):
+        self.session = session
+        self.operations = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def _add(self, op, key, userid, appid, **kwds):
+        if userid is None:
+            userid = self.session.userid
+        if appid is None:
+            appid = self.session.store.appid
+        operation = {"op": op, "appid": appid, "userid": userid, "key": key}
+        operation.update(kwds)
+        self.operations.append(operation)
+
+    def get(self, key, userid=None, appid=None):
+        """Queue up a get of the item stored under the specified key."""
+        self._add("get", key, userid, appid)
+
+    def set(self, key, value, userid=None, appid=None, if_match=None,
+            ttl=None):
+        """Queue up a set of the value stored under the specified key."""
+        self._add("set", key, userid, appid, value=value, if_match=if_match,
+                  ttl=ttl)
+
+    def delete(self, key, userid=None, appid=None, if_match=None):
+        """Queue up a delete of the value stored under the specified key."""
+        self._add("delete", key, userid, appid, if_match=if_match)
+
+    def execute(self):
+        """Perform the queued operations, returning the list of results."""
+        self.results = self.session._execute_batch(self.operations)
+        self.operations = []
+        return self.results
+
+
 class DirectConnection(object):
-    """ISauropodConnection implemented as a direct link to the backend."""
+    """ISauropodConnection implemented as a direct link to the backend.
+
+    Operations can also be run concurrently on a pool of threads, created
+    when first used, via submit() and imap() or the *_async() methods of
+    the sessions.  By default the pool has one thread for each connection
+    that the backend can use at once.
+    """
 
     implements(ISauropodConnection)
 
-    def __init__(self, backend, appid, verifier=None):
+    def __init__(self, backend, appid, verifier=None, max_workers=None):
         if verifier is None:
             verifier = "vep:RemoteVerifier"
-        verifier = maybe_resolve_name(verifier)
+        if isinstance(verifier, basestring):
+            from mozsvc.util import maybe_resolve_name
+            verifier = maybe_resolve_name(verifier)
         if callable(verifier):
             verifier = verifier()
         self._verifier = verifier
         self.backend = backend
         self.appid = appid
+        if max_workers is None:
+            max_workers = getattr(backend, "max_connections", None)
+        self.max_workers = max_workers or DEFAULT_MAX_WORKERS
+        self._executor = None
+        self._executor_lock = threading.Lock()
 
     def close(self):
-        """Close down the connection."""
-        pass
+        """Close down the connection, waiting for any pending operations."""
+        with self._executor_lock:
+            if self._executor is not None:
+                self._executor.close()
+                self._executor.join()
+                self._executor = None
+
+    def submit(self, func, *args, **kwds):
+        """Call func(*args, **kwds) on the thread pool.
+
+        This returns a multiprocessing.pool.AsyncResult, whose get() method
+        waits for the call to finish and returns its result or re-raises its
+        exception.
+        """
+        with self._executor_lock:
+            if self._executor is None:
+                from multiprocessing.pool import ThreadPool
+                self._executor = ThreadPool(self.max_workers)
+            return self._executor.apply_async(func, args, kwds)
+
+    def imap(self, func, iterable):
+        """Call func on each item of an iterable, using the thread pool.
+
+        The results are yielded in order, and the first exception raised by
+        a call is re-raised.  Only a few calls per thread are submitted ahead
+        of the results being consumed, so the iterable may be very long,
+        e.g. every userid to be backfilled.
+        """
+        pending = collections.deque()
+        for arg in iterable:
+            pending.append(self.submit(func, arg))
+            if len(pending) >= self.max_workers * 2:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
 
     def start_session(self, userid, credentials, **kwds):
         """Start a data access session."""
+        from vep import TrustError
         try:
             email = self._verifier.verify(**credentials)["email"]
-        except (ValueError, vep.TrustError):
+        except (ValueError, TrustError):
             raise AuthenticationError("invalid credentials")
+        import uuid
         return DirectSession(self, userid, uuid.uuid4().hex, **kwds)
 
     def resume_session(self, userid, sessionid, **kwds):
@@ -119,7 +262,12 @@ class DirectConnection(object):
 
 
 class DirectSession(object):
-    """ISauropodSession implementation as a direct link to the backend."""
+    """ISauropodSession implementation as a direct link to the backend.
+
+    The getitem_async(), get_async(), set_async() and delete_async() methods
+    take the same arguments as their synchronous versions, but run them on
+    the connection's thread pool and return an AsyncResult.
+    """
 
     implements(ISauropodSession)
 
@@ -144,13 +292,15 @@ class DirectSession(object):
         """Get the value stored under the specified key."""
         return self.getitem(key, userid, appid).value
 
-    def set(self, key, value, userid=None, appid=None, if_match=None):
+    def set(self, key, value, userid=None, appid=None, if_match=None,
+            ttl=None):
         """Set the value stored under the specified key."""
         if userid is None:
             userid = self.userid
         if appid is None:
             appid = self.store.appid
-        return self.store.backend.set(appid, userid, key, value, if_match)
+        return self.store.backend.set(appid, userid, key, value, if_match,
+                                      ttl)
 
     def delete(self, key, userid=None, appid=None, if_match=None):
         """Delete the value stored under the specified key."""
@@ -160,16 +310,127 @@ class DirectSession(object):
             appid = self.store.appid
         return self.store.backend.delete(appid, userid, key, if_match)
 
+    def watch(self, key, etag=None, timeout=None, userid=None, appid=None):
+        """Wait for the item stored under the specified key to change."""
+        if userid is None:
+            userid = self.userid
+        if appid is None:
+            appid = self.store.appid
+        return watch_key(self.store.backend, appid, userid, key, etag,
+                         timeout)
+
+    def getitem_async(self, key, userid=None, appid=None):
+        """Get the item stored under the specified key, asynchronously."""
+        return self.store.submit(self.getitem, key, userid, appid)
+
+    def get_async(self, key, userid=None, appid=None):
+        """Get the value stored under the specified key, asynchronously."""
+        return self.store.submit(self.get, key, userid, appid)
+
+    def set_async(self, key, value, userid=None, appid=None, if_match=None,
+                  ttl=None):
+        """Set the value stored under the specified key, asynchronously."""
+        return self.store.submit(self.set, key, value, userid, appid,
+                                 if_match, ttl)
+
+    def delete_async(self, key, userid=None, appid=None, if_match=None):
+        """Delete the value stored under the specified key, asynchronously."""
+        return self.store.submit(self.delete, key, userid, appid, if_match)
+
+    def batch(self):
+        """Start a batch of operations to be performed together."""
+        return Batch(self)
+
+    def _execute_batch(self, operations):
+        """Perform each operation in a batch, collecting the results."""
+        results = []
+        for operation in operations:
+            op = operation["op"]
+            args = (operation["key"], operation["userid"], operation["appid"])
+            try:
+                if op == "get":
+                    result = self.getitem(*args)
+                elif op == "set":
+                    result = self.set(args[0], operation["value"], *args[1:],
+                                      if_match=operation["if_match"],
+                                      ttl=operation["ttl"])
+                else:
+                    result = self.delete(*args,
+                                         if_match=operation["if_match"])
+            except (KeyError, ConflictError, QuotaExceededError), e:
+                result = e
+            results.append(result)
+        return results
+
+    def getstats(self, userid=None, appid=None):
+        """Get the usage counters for a bucket."""
+        if userid is None:
+            userid = self.userid
+        if appid is None:
+            appid = self.store.appid
+        return self.store.backend.getstats(appid, userid)
+
+    def changes(self, since=0, limit=None, userid=None, appid=None, wait=0):
+        """Get the changes made to a bucket since a given sequence number."""
+        if userid is None:
+            userid = self.userid
+        if appid is None:
+            appid = self.store.appid
+        if wait:
+            return watch_changes(self.store.backend, appid, userid,
+                                 since, limit, wait)
+        return self.store.backend.changes(appid, userid, since, limit)
+
+    def delete_bucket(self, userid=None, appid=None):
+        """Delete all the values stored in a bucket."""
+        if userid is None:
+            userid = self.userid
+        if appid is None:
+            appid = self.store.appid
+        self.store.backend.delete_bucket(appid, userid)
+
+    def delete_user(self, userid=None):
+        """Delete all the values stored for a user, across all applications."""
+        if userid is None:
+            userid = self.userid
+        self.store.backend.delete_user(userid)
+
 
 class WebAPIConnection(object):
-    """ISauropodConnection implemented by calling the HTTP-based API."""
+    """ISauropodConnection implemented by calling the HTTP-based API.
+
+    The set of optional protocol features advertised by the server is kept
+    in the "features" attribute, updated from every response.  If the server
+    supports it, values are sent and received as raw bytes rather than being
+    wrapped in forms and JSON; pass raw_values=False to avoid this.
+
+    The store_url may also be a list of URLs, or a whitespace-separated
+    string of them, for a store spread across several servers.  Each bucket
+    is then routed to one of them by a consistent-hash ring on its appid
+    and userid.  If that server can't be reached or is too busy, requests
+    fail over to the next "replicas" servers around the ring, which must
+    be able to serve the same data.  The servers must share a session
+    secret so that they all accept the same sessionids.
+    """
 
     implements(ISauropodConnection)
 
-    def __init__(self, store_url, appid):
-        self.store_url = store_url
+    def __init__(self, store_url, appid, raw_values=True, replicas=1,
+                 vnodes=DEFAULT_VNODES, retry_interval=DEFAULT_RETRY_INTERVAL):
+        if isinstance(store_url, basestring):
+            store_urls = store_url.split()
+        else:
+            store_urls = list(store_url)
+        self.store_url = store_urls[0]
         self.appid = appid
-        self._reqpool = requests.session()
+        self.raw_values = raw_values
+        self.features = set()
+        self.replicas = int(replicas)
+        self.retry_interval = retry_interval
+        self._requests = _import_requests()
+        self.nodes = [Node(url, self._requests.session())
+                      for url in store_urls]
+        self.ring = HashRing(self.nodes, int(vnodes))
 
     def close(self):
         """Close down the connection."""
@@ -177,7 +438,8 @@ class WebAPIConnection(object):
 
     def start_session(self, userid, credentials, **kwds):
         """Start a data access session."""
-        r = self.request("/session/start", "POST", credentials)
+        nodes = self.nodes_for(userid)
+        r = self.request("/session/start", "POST", credentials, nodes=nodes)
         sessionid = r.content
         return WebAPISession(self, userid, sessionid, **kwds)
 
@@ -185,11 +447,25 @@ class WebAPIConnection(object):
         """Resume a data access session."""
         return WebAPISession(self, userid, sessionid, **kwds)
 
-    def request(self, path, method="GET", data="", headers=None, session=None):
+    def nodes_for(self, userid, appid=None):
+        """Get the nodes serving the given bucket, in order of preference."""
+        if appid is None:
+            appid = self.appid
+        key = bucket_key(appid, userid)
+        return self.ring.get_nodes(key, 1 + self.replicas)
+
+    def request(self, path, method="GET", data="", headers=None, session=None,
+                nodes=None):
         """Make a HTTP request to the Sauropod server, return the result.
 
         This method is a handy wrapper around the "requests" module that makes
         signed requests to the Sauropod server.  It returns a response object.
+
+        The request is sent to each of the given nodes in turn until one of
+        them can be reached and isn't too busy, skipping nodes that failed
+        recently unless none are left.  By default it goes to the nodes
+        serving the session's own bucket, or to any node if there's no
+        session.
         """
         if not headers:
             headers = {}
@@ -197,15 +473,47 @@ class WebAPIConnection(object):
             headers = headers.copy()
         if session is not None:
             headers["Signature"] = session.sessionid
-        # Send the request.
-        url = urljoin(self.store_url, path)
+        # Ask for large responses to be compressed.  They are transparently
+        # decoded by urllib3 when the body is read.
+        headers.setdefault("Accept-Encoding", "gzip, deflate")
+        # Work out which nodes to try, healthy ones first.
+        if nodes is None:
+            if session is not None:
+                nodes = self.nodes_for(session.userid)
+            else:
+                nodes = self.nodes
+        now = time.time()
+        candidates = [node for node in nodes if node.is_available(now)]
+        if not candidates:
+            candidates = nodes
+        for node in candidates:
+            try:
+                r = self._send(node, path, method, data, headers)
+            except ConnectionError, e:
+                node.mark_down(self.retry_interval)
+                error = e
+            except ServerBusyError, e:
+                node.mark_down(e.retry_after or self.retry_interval)
+                error = e
+            else:
+                node.mark_up()
+                return r
+        raise error
+
+    def _send(self, node, path, method, data, headers):
+        """Send a request to a single node, and check the response."""
+        url = urljoin(node.url, path)
         try:
-            r = self._reqpool.request(method, url, None, data, headers)
-        except requests.RequestException, e:
+            r = node.session.request(method, url, None, data, headers)
+        except self._requests.RequestException, e:
             raise ConnectionError(*e.args)
         # Greedily load the body content.
         # This ensures the connection can be put back in the pool.
         r.content
+        # Note any optional features advertised by the server.
+        features = r.headers.get("X-Sauropod-Features")
+        if features:
+            self.features.update(features.split())
         # If that was an error, translate it into one of our internal types.
         # 401 or 403 indicate that authentication failed.
         if r.status_code in (401, 403):
@@ -213,6 +521,12 @@ class WebAPIConnection(object):
         # 412 indicates an etag conflict.
         if r.status_code == 412:
             raise ConflictError("if_match was not satisfied")
+        # 413 indicates that the write would exceed the bucket's quota.
+        if r.status_code == 413:
+            raise QuotaExceededError(r.content)
+        # 410 indicates that a change feed can't be resumed.
+        if r.status_code == 410:
+            raise ResyncRequiredError(r.content)
         # 503 indicates the server is too busy.
         if r.status_code == 503:
             try:
@@ -240,41 +554,74 @@ class WebAPISession(object):
         """Close down the session."""
         pass
 
-    def request(self, path="", method="GET", data="", headers=None):
+    def request(self, path="", method="GET", data="", headers=None,
+                userid=None, appid=None):
         """Make a HTTP request to the Sauropod server, return the result.
 
         This method is a handy wrapper around the Store.request method, to
-        make sure that it uses the correct session for OAuth signing.
+        make sure that it uses the correct session for OAuth signing.  It
+        goes to the nodes serving the given bucket, by default the
+        session's own.
         """
-        return self.store.request(path, method, data, headers, self)
+        if userid is None:
+            userid = self.userid
+        nodes = self.store.nodes_for(userid, appid)
+        return self.store.request(path, method, data, headers, self, nodes)
 
-    def keypath(self, key, userid=None, appid=None):
-        """Get the server path at which to access the given key."""
+    def bucketpath(self, userid=None, appid=None):
+        """Get the server path at which to access the given bucket."""
         if userid is None:
             userid = self.userid
         if appid is None:
             appid = self.store.appid
-        path = "/app/%s/users/%s/keys/%s"
-        path = path % tuple(urlquote(v, safe="") for v in (appid, userid, key))
+        path = "/app/%s/users/%s"
+        path = path % tuple(urlquote(v, safe="") for v in (appid, userid))
         return path
 
+    def keypath(self, key, userid=None, appid=None):
+        """Get the server path at which to access the given key."""
+        path = self.bucketpath(userid, appid)
+        return path + "/keys/" + urlquote(key, safe="")
+
+    def _use_raw_values(self):
+        """Check whether to send and receive values as raw bytes."""
+        return self.store.raw_values and "raw-values" in self.store.features
+
+    def _item_from_response(self, r, key, userid, appid):
+        """Get an Item from the response to a GET on a key."""
+        content_type = r.headers.get("Content-Type", "")
+        if content_type.startswith("application/octet-stream"):
+            value = r.content
+        else:
+            value = _value_from_json(json.loads(r.content))
+        etag = r.headers.get("ETag")
+        # Compressed responses have the encoding appended to their etag.
+        encoding = r.headers.get("Content-Encoding")
+        if etag and encoding and etag.endswith("-" + encoding):
+            etag = etag[:-len(encoding) - 1]
+        return Item(appid, userid, key, value, etag)
+
     def getitem(self, key, userid=None, appid=None):
         """Get the item stored under the specified key."""
         path = self.keypath(key, userid, appid)
+        headers = {}
+        if self._use_raw_values():
+            headers["Accept"] = "application/octet-stream"
         try:
-            r = self.request(path, "GET")
+            r = self.request(path, "GET", headers=headers, userid=userid,
+                             appid=appid)
         except ServerError, e:
             if e.status_code == 404:
                 raise KeyError(key)
             raise
-        value = json.loads(r.content)["value"]
-        return Item(appid, userid, key, value, r.headers.get("ETag"))
+        return self._item_from_response(r, key, userid, appid)
 
     def get(self, key, userid=None, appid=None):
         """Get the value stored under the specified key."""
         return self.getitem(key, userid, appid).value
 
-    def set(self, key, value, userid=None, appid=None, if_match=None):
+    def set(self, key, value, userid=None, appid=None, if_match=None,
+            ttl=None):
         """Set the value stored under the specified key."""
         path = self.keypath(key, userid, appid)
         headers = {}
@@ -283,7 +630,17 @@ class WebAPISession(object):
                 headers["If-None-Match"] = "*"
             else:
                 headers["If-Match"] = if_match
-        r = self.request(path, "PUT", dict(value=value), headers)
+        if ttl is not None:
+            headers["X-Sauropod-TTL"] = str(int(ttl))
+        if self._use_raw_values():
+            headers["Content-Type"] = "application/octet-stream"
+            if isinstance(value, unicode):
+                data = value.encode("utf8")
+            else:
+                data = value
+        else:
+            data = dict(value=value)
+        r = self.request(path, "PUT", data, headers, userid, appid)
         return Item(appid, userid, key, value, r.headers.get("ETag"))
 
     def delete(self, key, userid=None, appid=None, if_match=None):
@@ -296,8 +653,146 @@ class WebAPISession(object):
             else:
                 headers["If-Match"] = if_match
         try:
-            self.request(path, "DELETE", headers=headers)
+            self.request(path, "DELETE", headers=headers, userid=userid,
+                         appid=appid)
         except ServerError, e:
             if e.status_code == 404:
                 raise KeyError(key)
             raise
+
+    def watch(self, key, etag=None, timeout=None, userid=None, appid=None):
+        """Wait for the item stored under the specified key to change.
+
+        The server may hold each request for less time than we asked for,
+        in which case we keep re-issuing it until our timeout expires.
+        """
+        if userid is None:
+            userid = self.userid
+        if appid is None:
+            appid = self.store.appid
+        path = self.keypath(key, userid, appid)
+        headers = {}
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        if self._use_raw_values():
+            headers["Accept"] = "application/octet-stream"
+        if timeout is not None:
+            deadline = time.time() + timeout
+        while True:
+            if timeout is None:
+                wait = 60
+            else:
+                wait = deadline - time.time()
+                if wait <= 0:
+                    return None
+            try:
+                r = self.request(path + "?wait=%d" % (max(wait, 1),),
+                                 "GET", headers=headers, userid=userid,
+                                 appid=appid)
+            except ServerError, e:
+                if e.status_code == 404:
+                    raise KeyError(key)
+                if e.status_code == 304:
+                    continue
+                raise
+            return self._item_from_response(r, key, userid, appid)
+
+    def batch(self):
+        """Start a batch of operations to be performed together."""
+        return Batch(self)
+
+    def _execute_batch(self, operations):
+        """Send the operations in a batch to the server in a single request.
+
+        Values are sent as JSON strings, with any that aren't valid UTF-8
+        base64-encoded.  If the buckets are served by different nodes then
+        each node is sent a batch of its own operations, still in their
+        original order.
+        """
+        groups = collections.OrderedDict()
+        for i, operation in enumerate(operations):
+            nodes = self.store.nodes_for(operation["userid"],
+                                         operation["appid"])
+            groups.setdefault(tuple(nodes), []).append(i)
+        headers = {"Content-Type": "application/json"}
+        raw_results = [None] * len(operations)
+        for nodes, indexes in groups.iteritems():
+            batch = [_operation_to_json(operations[i]) for i in indexes]
+            body = json.dumps({"operations": batch})
+            r = self.store.request("/batch", "POST", body, headers, self,
+                                   list(nodes))
+            for i, result in zip(indexes, json.loads(r.content)["results"]):
+                raw_results[i] = result
+        results = []
+        for operation, result in zip(operations, raw_results):
+            key = operation["key"]
+            userid = operation["userid"]
+            appid = operation["appid"]
+            status = result["status"]
+            if status == 200:
+                result = Item(appid, userid, key, _value_from_json(result),
+                              result["etag"])
+            elif status == 204:
+                if operation["op"] == "set":
+                    result = Item(appid, userid, key, operation["value"],
+                                  result["etag"])
+                else:
+                    result = None
+            elif status == 404:
+                result = KeyError(key)
+            elif status == 412:
+                result = ConflictError("if_match was not satisfied")
+            elif status == 413:
+                result = QuotaExceededError(result.get("error", ""))
+            elif status == 403:
+                result = AuthenticationError("invalid credentials")
+            else:
+                result = ServerError("batch operation failed", status)
+            results.append(result)
+        return results
+
+    def getstats(self, userid=None, appid=None):
+        """Get the usage counters for a bucket."""
+        path = self.bucketpath(userid, appid) + "/stats"
+        r = self.request(path, "GET", userid=userid, appid=appid)
+        return json.loads(r.content)
+
+    def changes(self, since=0, limit=None, userid=None, appid=None, wait=0):
+        """Get the changes made to a bucket since a given sequence number."""
+        if userid is None:
+            userid = self.userid
+        if appid is None:
+            appid = self.store.appid
+        path = self.bucketpath(userid, appid) + "/changes?since=%d" % (since,)
+        if limit is not None:
+            path += "&limit=%d" % (limit,)
+        if wait:
+            path += "&wait=%d" % (max(wait, 1),)
+        r = self.request(path, "GET", userid=userid, appid=appid)
+        changes = []
+        for data in json.loads(r.content)["changes"]:
+            key = data["key"].encode("utf8")
+            if data.get("deleted"):
+                item = None
+            else:
+                item = Item(appid, userid, key, _value_from_json(data),
+                            data["etag"])
+            changes.append(Change(data["seq"], key, item))
+        return changes
+
+    def delete_bucket(self, userid=None, appid=None):
+        """Delete all the values stored in a bucket."""
+        path = self.bucketpath(userid, appid) + "/keys/"
+        self.request(path, "DELETE", userid=userid, appid=appid)
+
+    def delete_user(self, userid=None):
+        """Delete all the values stored for a user, across all applications.
+
+        The user's buckets may be spread over every node, so the request is
+        sent to each of them.
+        """
+        if userid is None:
+            userid = self.userid
+        path = "/users/%s" % (urlquote(userid, safe=""),)
+        for node in self.store.nodes:
+            self.store.request(path, "DELETE", session=self, nodes=[node])
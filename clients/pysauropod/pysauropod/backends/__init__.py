@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Backend storage implementations for the Sauropod data store.
+
+"""
+
+from urlparse import urlparse
+
+
+def load_backend(url, create_tables=False):
+    """Load an ISauropodBackend object for the given URL.
+
+    HBase URLs of the form "hbase://host:port" connect to the HBase thrift
+    gateway at that location, "mem:" URLs use an in-memory sqlite database,
+    and anything else is taken to be an SQLAlchemy database URL.
+    """
+    location = urlparse(url)
+    scheme = location.scheme.lower()
+    if scheme == "hbase":
+        from pysauropod.backends.hbase import HBaseBackend
+        return HBaseBackend(location.hostname or "localhost",
+                            location.port or 9090,
+                            create_tables=create_tables)
+    from pysauropod.backends.sql import SQLBackend
+    if scheme == "mem":
+        return SQLBackend("sqlite:///")
+    return SQLBackend(url, create_tables=create_tables)
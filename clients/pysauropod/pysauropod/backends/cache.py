@@ -0,0 +1,716 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Read-through, write-through caching wrapper for Sauropod backends.
+
+CachingBackend wraps any ISauropodBackend and keeps recently-read items in
+a cache, either a size-bounded LRU in the process or a set of memcached
+servers shared between processes.  It is configured through the usual
+"sauropod.storage" settings, with any it doesn't recognise being passed on
+to the wrapped backend:
+
+    [sauropod.storage]
+    backend = pysauropod.backends.cache:CachingBackend
+    cached_backend = pysauropod.backends.sql:SQLBackend
+    sqluri = mysql://...
+    cache_size = 10000
+    cache_servers = 10.0.0.1:11211 10.0.0.2:11211
+
+Writes made through the wrapper update the cache along with the backend,
+and reads only fill the cache with items that aren't there already, so a
+slow read can't replace the result of a newer write.  Keys found to be
+missing are cached for a short time too.  A conditional write that fails
+means the cached etag is stale, so the entry is replaced by a tombstone:
+lookups treat it as a miss, but reads already in flight can't fill the
+cache with the old item until it expires.  The same goes for values too
+large to cache.
+
+Writes made by other processes, or directly to the wrapped backend, are
+not seen until the cached entry expires; use memcached so that processes
+share their updates, and a cache_ttl that bounds how stale a read may be.
+With memcached, writes to a key are serialized by a lock kept there too,
+and a process that can't take it leaves a tombstone rather than its item.
+
+"""
+
+import os
+import time
+import zlib
+import Queue
+import socket
+import hashlib
+import logging
+import threading
+import contextlib
+import collections
+
+from zope.interface import implements
+
+from mozsvc.util import maybe_resolve_name
+
+from pysauropod.interfaces import ISauropodBackend, Item
+from pysauropod.errors import ConflictError
+
+
+logger = logging.getLogger("pysauropod.backends.cache")
+
+# Number of locks used to serialize writes to the same key in a process,
+# so that the cache is updated in the same order as the backend.
+NUM_WRITE_LOCKS = 64
+
+# Seconds that a key is kept out of the cache after a write that couldn't
+# update its entry, which should outlast any read of the old value.
+TOMBSTONE_TTL = 10
+
+# Seconds that a key's write lock in memcached is held for at most, in
+# case the process holding it dies without releasing it.
+LOCK_TTL = 10
+
+# Times to try fetching or creating a user's generation token in memcached.
+TOKEN_RETRIES = 3
+
+# Marker for a key that is being kept out of the cache.
+_TOMBSTONE = object()
+
+
+class CacheStats(object):
+    """Running totals of cache lookups, by result."""
+
+    def __init__(self):
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def record(self, hits=0, negative_hits=0, misses=0):
+        with self._lock:
+            self.hits += hits
+            self.negative_hits += negative_hits
+            self.misses += misses
+
+    @property
+    def hit_ratio(self):
+        """Fraction of lookups answered by the cache, or None if none yet."""
+        total = self.hits + self.negative_hits + self.misses
+        if not total:
+            return None
+        return (self.hits + self.negative_hits) / float(total)
+
+    def collect(self):
+        """Return a list of (labels, count) pairs for reporting metrics."""
+        return [((("result", "hit"),), self.hits),
+                ((("result", "negative_hit"),), self.negative_hits),
+                ((("result", "miss"),), self.misses)]
+
+
+class LRUCache(object):
+    """Size-bounded, in-process cache of items.
+
+    Entries are keyed by (appid, userid, key), with None standing for a key
+    known to be missing and _TOMBSTONE for one kept out of the cache.  Each
+    entry expires after its TTL, if it has one, and the least-recently-used
+    entries are evicted to stay within size.
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._write_locks = [threading.Lock()
+                             for _ in xrange(NUM_WRITE_LOCKS)]
+
+    def get_many(self, appid, userid, keys):
+        """Look up several keys, returning a dict of the entries found.
+
+        This also returns a token to pass to fill() when adding the rest,
+        which is always None for this cache.
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for key in keys:
+                try:
+                    item, expires = self._entries.pop((appid, userid, key))
+                except KeyError:
+                    continue
+                if expires is not None and expires <= now:
+                    continue
+                self._entries[(appid, userid, key)] = (item, expires)
+                if item is not _TOMBSTONE:
+                    found[key] = item
+        return found, None
+
+    def fill(self, appid, userid, entries, ttl, token=None):
+        """Add entries read from the backend, unless already present."""
+        now = time.time()
+        expires = now + ttl if ttl else None
+        with self._lock:
+            for key, item in entries.iteritems():
+                cache_key = (appid, userid, key)
+                current = self._entries.get(cache_key)
+                if current is None or (current[1] is not None and
+                                       current[1] <= now):
+                    self._entries[cache_key] = (item, expires)
+            self._evict()
+
+    @contextlib.contextmanager
+    def write_lock(self, appid, userid, key):
+        """Serialize writes to a key, for the duration of a with-block.
+
+        The cache is only shared by this process, so a thread lock will do.
+        The block is given a lease to pass to store(), which is always None.
+        """
+        lock = self._write_locks[hash((appid, userid, key)) %
+                                 NUM_WRITE_LOCKS]
+        with lock:
+            yield None
+
+    def store(self, appid, userid, key, item, ttl, lease=None):
+        """Add or replace the entry for a key that has been written."""
+        expires = time.time() + ttl if ttl else None
+        with self._lock:
+            self._entries.pop((appid, userid, key), None)
+            self._entries[(appid, userid, key)] = (item, expires)
+            self._evict()
+
+    def invalidate(self, appid, userid, key, ttl=TOMBSTONE_TTL):
+        """Keep a key out of the cache for the next "ttl" seconds."""
+        self.store(appid, userid, key, _TOMBSTONE, ttl)
+
+    def purge(self, userid, appid=None):
+        """Drop the entries for a bucket, or for all of a user's buckets."""
+        with self._lock:
+            for cache_key in self._entries.keys():
+                if cache_key[1] == userid:
+                    if appid is None or cache_key[0] == appid:
+                        del self._entries[cache_key]
+
+    def _evict(self):
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+
+class MemcacheError(Exception):
+    """Error raised when talking to a memcached server fails."""
+
+
+class MemcacheClient(object):
+    """Minimal client for the memcached text protocol.
+
+    Keys are spread over the servers by hashing, and idle sockets to each
+    server are kept in a pool for re-use.
+    """
+
+    def __init__(self, servers, timeout=1.0):
+        self.servers = []
+        for server in servers:
+            host, port = server.rsplit(":", 1)
+            self.servers.append((host, int(port)))
+        self.timeout = timeout
+        self._idle = dict((server, Queue.LifoQueue())
+                          for server in self.servers)
+
+    def close(self):
+        """Close all idle connections."""
+        for idle in self._idle.itervalues():
+            while True:
+                try:
+                    idle.get_nowait().close()
+                except Queue.Empty:
+                    break
+
+    def get_multi(self, keys):
+        """Get several keys, returning a dict mapping to (flags, data)."""
+        return self._retrieve("get", keys)
+
+    def gets(self, key):
+        """Get a key, returning (flags, data, cas_id) or None if missing."""
+        return self._retrieve("gets", [key]).get(key)
+
+    def _retrieve(self, command, keys):
+        by_server = collections.defaultdict(list)
+        for key in keys:
+            by_server[self._server_for(key)].append(key)
+        num_parts = 5 if command == "gets" else 4
+        results = {}
+        for server, server_keys in by_server.iteritems():
+            with self._connection(server) as conn:
+                conn.send("%s %s\r\n" % (command, " ".join(server_keys)))
+                while True:
+                    line = conn.readline()
+                    if line == "END":
+                        break
+                    parts = line.split(" ")
+                    if parts[0] != "VALUE" or len(parts) != num_parts:
+                        raise MemcacheError(line)
+                    data = conn.read(int(parts[3]) + 2)[:-2]
+                    result = (int(parts[2]), data)
+                    if command == "gets":
+                        result += (int(parts[4]),)
+                    results[parts[1]] = result
+        return results
+
+    def set(self, key, data, flags=0, exptime=0):
+        """Store data under a key."""
+        return self._store("set", key, data, flags, exptime)
+
+    def add(self, key, data, flags=0, exptime=0):
+        """Store data under a key, only if nothing is stored there yet."""
+        return self._store("add", key, data, flags, exptime)
+
+    def cas(self, key, cas_id, data, flags=0, exptime=0):
+        """Store data under a key, only if unchanged since it was fetched.
+
+        The cas_id is the one returned by gets().
+        """
+        return self._store("cas", key, data, flags, exptime, cas_id)
+
+    def delete(self, key):
+        """Delete a key, returning True if it existed."""
+        with self._connection(self._server_for(key)) as conn:
+            conn.send("delete %s\r\n" % (key,))
+            response = conn.readline()
+        if response not in ("DELETED", "NOT_FOUND"):
+            raise MemcacheError(response)
+        return response == "DELETED"
+
+    def _store(self, command, key, data, flags, exptime, cas_id=None):
+        args = "%s %d %d %d" % (key, flags, exptime, len(data))
+        if cas_id is not None:
+            args += " %d" % (cas_id,)
+        with self._connection(self._server_for(key)) as conn:
+            conn.send("%s %s\r\n%s\r\n" % (command, args, data))
+            response = conn.readline()
+        if response not in ("STORED", "NOT_STORED", "EXISTS", "NOT_FOUND"):
+            raise MemcacheError(response)
+        return response == "STORED"
+
+    def _server_for(self, key):
+        return self.servers[zlib.crc32(key) % len(self.servers)]
+
+    def _connection(self, server):
+        try:
+            conn = self._idle[server].get_nowait()
+        except Queue.Empty:
+            conn = None
+        return _PooledConnection(self, server, conn)
+
+
+class _MemcacheConnection(object):
+    """A socket to a memcached server, with buffered reads."""
+
+    def __init__(self, server, timeout):
+        self.sock = socket.create_connection(server, timeout)
+        self.file = self.sock.makefile("rb")
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def readline(self):
+        line = self.file.readline()
+        if not line.endswith("\r\n"):
+            raise MemcacheError("connection closed")
+        return line[:-2]
+
+    def read(self, size):
+        data = self.file.read(size)
+        if len(data) != size:
+            raise MemcacheError("connection closed")
+        return data
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class _PooledConnection(object):
+    """Context manager returning a connection to the pool unless it fails.
+
+    Socket errors are translated into MemcacheError.
+    """
+
+    def __init__(self, client, server, conn):
+        self.client = client
+        self.server = server
+        self.conn = conn
+
+    def __enter__(self):
+        if self.conn is None:
+            try:
+                self.conn = _MemcacheConnection(self.server,
+                                                self.client.timeout)
+            except socket.error, e:
+                raise MemcacheError(str(e))
+        return self.conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.client._idle[self.server].put(self.conn)
+            return False
+        self.conn.close()
+        if issubclass(exc_type, socket.error):
+            raise MemcacheError(str(exc_value))
+        return False
+
+
+class MemcacheCache(object):
+    """Cache of items stored in memcached, shared between processes.
+
+    Each user has a generation token stored in memcached, and entries are
+    only valid if they were stored under the user's current token.  Deleting
+    a bucket or user replaces the token, so all the user's entries can be
+    invalidated without having to know their keys.  The token is fetched
+    in the same request as the entries.
+
+    Other processes may be writing the same keys, and their writes can
+    reach memcached in a different order from the backend.  So a writer
+    must hold a lock on the key in memcached to store what it wrote, and
+    even then only does so if no other write has touched the entry since
+    it took the lock.  Otherwise the entry is left as a tombstone.
+
+    Errors talking to memcached are logged and treated as cache misses.
+    """
+
+    def __init__(self, servers, timeout=1.0):
+        self.client = MemcacheClient(servers, timeout)
+
+    def close(self):
+        self.client.close()
+
+    def get_many(self, appid, userid, keys):
+        """Look up several keys, returning a dict of the entries found.
+
+        This also returns the user's generation token, to pass to fill().
+        """
+        gen_key = self._gen_key(userid)
+        item_keys = dict((self._item_key(appid, userid, key), key)
+                         for key in keys)
+        try:
+            results = self.client.get_multi(item_keys.keys() + [gen_key])
+        except MemcacheError:
+            logger.exception("memcached lookup failed")
+            return {}, None
+        token = results.pop(gen_key, (None, None))[1]
+        found = {}
+        if token is not None:
+            for item_key, (flags, data) in results.iteritems():
+                key = item_keys[item_key]
+                entry_token, data = data.split("\n", 1)
+                if entry_token != token or flags == 2:
+                    continue
+                if flags:
+                    found[key] = None
+                else:
+                    etag, value = data.split("\n", 1)
+                    found[key] = Item(appid, userid, key, value, etag or None)
+        return found, token
+
+    def fill(self, appid, userid, entries, ttl, token=None):
+        """Add entries read from the backend, unless already present."""
+        try:
+            if token is None:
+                token = self._current_token(userid)
+            for key, item in entries.iteritems():
+                self.client.add(self._item_key(appid, userid, key),
+                                *self._encode(token, item, ttl))
+        except MemcacheError:
+            logger.exception("memcached fill failed")
+
+    @contextlib.contextmanager
+    def write_lock(self, appid, userid, key):
+        """Serialize writes to a key, for the duration of a with-block.
+
+        The lock is taken in memcached so that it covers all processes, and
+        the entry is replaced by a tombstone while it's held.  The block is
+        given a lease to pass to store(), which is None if the lock couldn't
+        be taken.
+        """
+        item_key = self._item_key(appid, userid, key)
+        lock_key = self._lock_key(appid, userid, key)
+        locked = False
+        lease = None
+        try:
+            locked = self.client.add(lock_key, "1", 0, LOCK_TTL)
+            if locked:
+                token = self._current_token(userid)
+                self.client.set(item_key, *self._encode(token, _TOMBSTONE,
+                                                        TOMBSTONE_TTL))
+                entry = self.client.gets(item_key)
+                if entry is not None:
+                    lease = entry[2]
+        except MemcacheError:
+            logger.exception("memcached lock failed for %r", key)
+        try:
+            yield lease
+        finally:
+            if locked:
+                try:
+                    self.client.delete(lock_key)
+                except MemcacheError:
+                    logger.exception("memcached unlock failed for %r", key)
+
+    def store(self, appid, userid, key, item, ttl, lease=None):
+        """Add or replace the entry for a key that has been written.
+
+        This needs the lease from write_lock(), and does nothing if another
+        write has touched the entry since it was taken.  Without a lease,
+        the key is just kept out of the cache.
+        """
+        if lease is None:
+            self.invalidate(appid, userid, key)
+            return
+        item_key = self._item_key(appid, userid, key)
+        try:
+            token = self._current_token(userid)
+            self.client.cas(item_key, lease, *self._encode(token, item, ttl))
+        except MemcacheError:
+            logger.exception("memcached store failed for %r", key)
+
+    def invalidate(self, appid, userid, key, ttl=TOMBSTONE_TTL):
+        """Keep a key out of the cache for the next "ttl" seconds."""
+        item_key = self._item_key(appid, userid, key)
+        try:
+            token = self._current_token(userid)
+            self.client.set(item_key, *self._encode(token, _TOMBSTONE, ttl))
+        except MemcacheError:
+            logger.exception("memcached invalidate failed for %r", key)
+
+    def purge(self, userid, appid=None):
+        """Drop the entries for all of a user's buckets."""
+        try:
+            self._new_token(userid, replace=True)
+        except MemcacheError:
+            logger.exception("memcached purge failed for %r", userid)
+
+    def _current_token(self, userid):
+        """Get the user's generation token, creating one if necessary."""
+        gen_key = self._gen_key(userid)
+        for _ in xrange(TOKEN_RETRIES):
+            token = self.client.get_multi([gen_key]).get(gen_key)
+            if token is not None:
+                return token[1]
+            token = self._new_token(userid, replace=False)
+            if token is not None:
+                return token
+        raise MemcacheError("no generation token for %r" % (userid,))
+
+    def _new_token(self, userid, replace):
+        """Store a fresh generation token for the user.
+
+        Unless told to replace it, an existing token is kept and None is
+        returned.
+        """
+        token = os.urandom(8).encode("hex")
+        if replace:
+            self.client.set(self._gen_key(userid), token)
+        elif not self.client.add(self._gen_key(userid), token):
+            return None
+        return token
+
+    def _encode(self, token, item, ttl):
+        # The flags are 1 for a missing key and 2 for a tombstone.
+        if item is None:
+            return token + "\n", 1, int(ttl or 0)
+        if item is _TOMBSTONE:
+            return token + "\n", 2, int(ttl or 0)
+        data = "%s\n%s\n%s" % (token, item.etag or "", item.value)
+        return data, 0, int(ttl or 0)
+
+    def _gen_key(self, userid):
+        if isinstance(userid, unicode):
+            userid = userid.encode("utf8")
+        return "sauropod:gen:" + hashlib.sha1(userid).hexdigest()
+
+    def _item_key(self, appid, userid, key):
+        return "sauropod:item:" + self._key_hash(appid, userid, key)
+
+    def _lock_key(self, appid, userid, key):
+        return "sauropod:lock:" + self._key_hash(appid, userid, key)
+
+    def _key_hash(self, appid, userid, key):
+        if isinstance(userid, unicode):
+            userid = userid.encode("utf8")
+        name = "\x00".join((appid, userid, key))
+        return hashlib.sha1(name).hexdigest()
+
+
+class CachingBackend(object):
+    """ISauropodBackend wrapper that caches items read from another backend.
+
+    The wrapped backend is given as an object or a dotted name in
+    "cached_backend", and any extra keyword arguments are used to construct
+    it.  If "cache_servers" lists any memcached servers then the cache is
+    kept there, otherwise it's an in-process LRU of up to "cache_size"
+    items.  Items expire after "cache_ttl" seconds and missing keys after
+    "negative_ttl" seconds, and values larger than "cache_max_item_size"
+    bytes are not cached at all.
+
+    The number of lookups that hit and miss the cache is kept in the
+    "cache_stats" attribute.  All other attributes are passed straight
+    through to the wrapped backend.
+    """
+
+    implements(ISauropodBackend)
+
+    def __init__(self, cached_backend="pysauropod.backends.sql:SQLBackend",
+                 cache_size=10000, cache_ttl=60, negative_ttl=5,
+                 cache_max_item_size=64 * 1024, cache_servers=None,
+                 cache_timeout=1.0, **kwds):
+        cached_backend = maybe_resolve_name(cached_backend)
+        if callable(cached_backend):
+            cached_backend = cached_backend(**kwds)
+        self.backend = cached_backend
+        self.cache_ttl = int(cache_ttl)
+        self.negative_ttl = int(negative_ttl)
+        self.cache_max_item_size = int(cache_max_item_size)
+        if isinstance(cache_servers, basestring):
+            cache_servers = cache_servers.split()
+        if cache_servers:
+            self.cache = MemcacheCache(cache_servers, float(cache_timeout))
+        else:
+            self.cache = LRUCache(int(cache_size))
+        self.cache_stats = CacheStats()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def close(self):
+        """Close down the backend and the cache."""
+        close_cache = getattr(self.cache, "close", None)
+        if close_cache is not None:
+            close_cache()
+        self.backend.close()
+
+    def getitem(self, appid, userid, key):
+        """Get the item stored under the specified key."""
+        found, token = self.cache.get_many(appid, userid, [key])
+        if key in found:
+            item = found[key]
+            if item is None:
+                self.cache_stats.record(negative_hits=1)
+                raise KeyError(key)
+            self.cache_stats.record(hits=1)
+            return item
+        self.cache_stats.record(misses=1)
+        try:
+            item = self.backend.getitem(appid, userid, key)
+        except KeyError:
+            self.cache.fill(appid, userid, {key: None}, self.negative_ttl,
+                            token)
+            raise
+        ttl = self._item_ttl(item)
+        if ttl is not None:
+            self.cache.fill(appid, userid, {key: item}, ttl, token)
+        return item
+
+    def getitems(self, appid, userid, keys):
+        """Get the items stored under several keys in a bucket at once."""
+        found, token = self.cache.get_many(appid, userid, keys)
+        items = {}
+        missing = []
+        for key in keys:
+            if key not in found:
+                missing.append(key)
+            elif found[key] is not None:
+                items[key] = found[key]
+        num_negative = len(found) - len(items)
+        self.cache_stats.record(hits=len(items), negative_hits=num_negative,
+                                misses=len(missing))
+        if missing:
+            fetched = self.backend.getitems(appid, userid, missing)
+            items.update(fetched)
+            positive = {}
+            negative = {}
+            for key in missing:
+                item = fetched.get(key)
+                if item is None:
+                    negative[key] = None
+                else:
+                    ttl = self._item_ttl(item)
+                    if ttl is not None:
+                        positive.setdefault(ttl, {})[key] = item
+            for ttl, entries in positive.iteritems():
+                self.cache.fill(appid, userid, entries, ttl, token)
+            if negative:
+                self.cache.fill(appid, userid, negative, self.negative_ttl,
+                                token)
+        return items
+
+    def set(self, appid, userid, key, value, if_match=None, ttl=None):
+        """Set the value stored under the specified key."""
+        with self.cache.write_lock(appid, userid, key) as lease:
+            try:
+                item = self.backend.set(appid, userid, key, value, if_match,
+                                        ttl)
+            except ConflictError:
+                self.cache.invalidate(appid, userid, key)
+                raise
+            cache_ttl = self._item_ttl(item)
+            if cache_ttl is not None:
+                self.cache.store(appid, userid, key, item, cache_ttl, lease)
+            else:
+                self.cache.invalidate(appid, userid, key)
+        return item
+
+    def delete(self, appid, userid, key, if_match=None):
+        """Delete the value stored under the specified key."""
+        with self.cache.write_lock(appid, userid, key) as lease:
+            try:
+                result = self.backend.delete(appid, userid, key, if_match)
+            except KeyError:
+                self.cache.store(appid, userid, key, None, self.negative_ttl,
+                                 lease)
+                raise
+            except ConflictError:
+                self.cache.invalidate(appid, userid, key)
+                raise
+            self.cache.store(appid, userid, key, None, self.negative_ttl,
+                             lease)
+        return result
+
+    def delete_bucket(self, appid, userid):
+        """Delete all the items stored in the specified bucket."""
+        try:
+            return self.backend.delete_bucket(appid, userid)
+        finally:
+            self.cache.purge(userid, appid)
+
+    def delete_user(self, userid):
+        """Delete all the items stored for the specified user, in all apps."""
+        try:
+            return self.backend.delete_user(userid)
+        finally:
+            self.cache.purge(userid)
+
+    def load(self, records):
+        """Load a stream of records, dropping cached entries for each user."""
+        userids = set()
+
+        def note_userids(records):
+            for record in records:
+                userids.add(record[1])
+                yield record
+
+        try:
+            return self.backend.load(note_userids(records))
+        finally:
+            for userid in userids:
+                self.cache.purge(userid)
+
+    def _item_ttl(self, item):
+        """Get how long to cache an item for, or None to not cache it.
+
+        Items are never cached beyond their own expiry time.
+        """
+        if len(item.value) > self.cache_max_item_size:
+            return None
+        if item.expires is None:
+            return self.cache_ttl
+        remaining = int(item.expires - time.time())
+        if remaining <= 0:
+            return None
+        if self.cache_ttl:
+            return min(self.cache_ttl, remaining)
+        return remaining
@@ -0,0 +1,168 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Coalescing of concurrent reads of the same key, for Sauropod backends.
+
+CoalescingBackend wraps any ISauropodBackend so that concurrent getitem()
+calls for the same (appid, userid, key) share a single call to the wrapped
+backend: the first caller makes the read, and any that arrive while it is
+in flight wait for it and get the same result, or the same error.  A hot
+key read by many clients at once then costs one query rather than one per
+client.
+
+A read that is in flight when a write to its key finishes is not shared
+with any later callers, who make a fresh read instead.  So every caller
+sees a result at least as new as the writes that completed before it
+called, just as if it had read the backend itself.
+
+The server wraps its backend in a CoalescingBackend unless the
+"sauropod.coalesce_reads" setting is false.  It can also be loaded through
+the usual "sauropod.storage" settings, with any it doesn't recognise being
+passed on to the wrapped backend:
+
+    [sauropod.storage]
+    backend = pysauropod.backends.coalesce:CoalescingBackend
+    coalesced_backend = pysauropod.backends.sql:SQLBackend
+    sqluri = mysql://...
+
+"""
+
+import threading
+
+from zope.interface import implements
+
+from mozsvc.util import maybe_resolve_name
+
+from pysauropod.interfaces import ISauropodBackend
+
+
+class CoalesceStats(object):
+    """Running totals of reads, by whether they were shared."""
+
+    def __init__(self):
+        self.issued = 0
+        self.shared = 0
+        self._lock = threading.Lock()
+
+    def record(self, issued=0, shared=0):
+        with self._lock:
+            self.issued += issued
+            self.shared += shared
+
+    def collect(self):
+        """Return a list of (labels, count) pairs for reporting metrics."""
+        return [((("result", "issued"),), self.issued),
+                ((("result", "shared"),), self.shared)]
+
+
+class _Flight(object):
+    """A read in progress, and its outcome once done."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class CoalescingBackend(object):
+    """ISauropodBackend wrapper that shares concurrent reads of a key.
+
+    The wrapped backend is given as an object or a dotted name in
+    "coalesced_backend", and any extra keyword arguments are used to
+    construct it.  The number of reads made and shared is kept in the
+    "coalesce_stats" attribute.  All other attributes are passed straight
+    through to the wrapped backend.
+    """
+
+    implements(ISauropodBackend)
+
+    def __init__(self, coalesced_backend="pysauropod.backends.sql:SQLBackend",
+                 **kwds):
+        coalesced_backend = maybe_resolve_name(coalesced_backend)
+        if callable(coalesced_backend):
+            coalesced_backend = coalesced_backend(**kwds)
+        self.backend = coalesced_backend
+        self.coalesce_stats = CoalesceStats()
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+    def getitem(self, appid, userid, key):
+        """Get the item stored under the specified key."""
+        flight_key = (appid, userid, key)
+        with self._lock:
+            flight = self._flights.get(flight_key)
+            leading = flight is None
+            if leading:
+                flight = self._flights[flight_key] = _Flight()
+        if not leading:
+            flight.done.wait()
+            self.coalesce_stats.record(shared=1)
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        self.coalesce_stats.record(issued=1)
+        try:
+            flight.result = self.backend.getitem(appid, userid, key)
+        except Exception, e:
+            flight.error = e
+            raise
+        finally:
+            self._land(flight_key, flight)
+            flight.done.set()
+        return flight.result
+
+    def set(self, appid, userid, key, value, if_match=None, ttl=None):
+        """Set the value stored under the specified key."""
+        try:
+            return self.backend.set(appid, userid, key, value, if_match, ttl)
+        finally:
+            self._land((appid, userid, key))
+
+    def delete(self, appid, userid, key, if_match=None):
+        """Delete the value stored under the specified key."""
+        try:
+            return self.backend.delete(appid, userid, key, if_match)
+        finally:
+            self._land((appid, userid, key))
+
+    def delete_bucket(self, appid, userid):
+        """Delete all the items stored in the specified bucket."""
+        try:
+            return self.backend.delete_bucket(appid, userid)
+        finally:
+            self._land_matching(lambda k: k[0] == appid and k[1] == userid)
+
+    def delete_user(self, userid):
+        """Delete all the items stored for the specified user, in all apps."""
+        try:
+            return self.backend.delete_user(userid)
+        finally:
+            self._land_matching(lambda k: k[1] == userid)
+
+    def load(self, records):
+        """Load a stream of records, then stop sharing any in-flight reads."""
+        try:
+            return self.backend.load(records)
+        finally:
+            self._land_matching(lambda k: True)
+
+    def _land(self, flight_key, flight=None):
+        """Stop later reads of a key from sharing its in-flight read.
+
+        If a flight is given, it's only removed if still the current one.
+        """
+        with self._lock:
+            current = self._flights.get(flight_key)
+            if current is not None and (flight is None or current is flight):
+                del self._flights[flight_key]
+
+    def _land_matching(self, predicate):
+        with self._lock:
+            for flight_key in self._flights.keys():
+                if predicate(flight_key):
+                    del self._flights[flight_key]
@@ -5,11 +5,634 @@
 
 HBase backend for the Sauropod data store.
 
+This backend talks to the HBase Thrift gateway, with a data layout of its
+own:
+
+    * one table per "consumer" of sauropod, named by hashing the appid
+    * row keys are prefixed by a hash of the userid, so each bucket is a
+      contiguous range of rows that is spread evenly across the regions
+    * the row for each item is the hashed userid followed by the raw key,
+      with the value stored in a single "item:value" column
+
+This is deliberately incompatible with the node-based server in
+srv/storage-thrift.js, which keeps a whole bucket in one row with a "key:"
+column for each item; neither server can read the other's tables.  Since a
+row is never split between regions, one row per bucket puts a limit on the
+size of a bucket and makes every write to it contend for the same row
+lock.  With a row per item, buckets of any size spread over the regions,
+listing the keys in a bucket is a simple range scan over the bucket's row
+prefix, and checkAndPut guards the single item being written.
+
+The thrift and hbase-thrift packages it needs are not installed by default;
+install pysauropod with the "hbase" extra to get them.
+
 """
 
+from __future__ import absolute_import
+
+import os
+import socket
+import threading
+import contextlib
+import Queue
+from itertools import groupby
+from hashlib import md5, sha1
+
+from zope.interface import implements
+
+from thrift.Thrift import TType, TMessageType, TApplicationException
+from thrift.transport import TSocket, TTransport
+from thrift.protocol import TBinaryProtocol
+from thrift.protocol.TBase import TBase
+
+from hbase import Hbase
+from hbase.ttypes import (Mutation, BatchMutation, ColumnDescriptor,
+                          AlreadyExists, IllegalArgument,
+                          IOError as HBaseIOError)
+
+from pysauropod.errors import ConflictError, ConnectionError, ServerError
+from pysauropod.interfaces import ISauropodBackend, Item
+from pysauropod.notify import default_notifier
+
+
+COLUMN_FAMILY = "item:"
+VALUE_COLUMN = "item:value"
+
+# Prefix of the placeholder value that a conditional delete swaps in for
+# the item before removing it.  Rows holding one read as missing.
+DELETING_PREFIX = "\x00sauropod:deleting:"
+
+
+def hashkey(value):
+    """Hash the given string for use in table names and row keys."""
+    return sha1(value).hexdigest()
+
+
+class checkAndPut_args(TBase):
+    """Arguments of the checkAndPut call, as in the HBase 0.94 IDL."""
+
+    thrift_spec = (
+        None,
+        (1, TType.STRING, "tableName", None, None),
+        (2, TType.STRING, "row", None, None),
+        (3, TType.STRING, "column", None, None),
+        None,
+        (5, TType.STRING, "value", None, None),
+        (6, TType.STRUCT, "mput", (Mutation, Mutation.thrift_spec), None),
+        (7, TType.MAP, "attributes",
+         (TType.STRING, None, TType.STRING, None), None),
+    )
+
+    def __init__(self, tableName=None, row=None, column=None, value=None,
+                 mput=None, attributes=None):
+        self.tableName = tableName
+        self.row = row
+        self.column = column
+        self.value = value
+        self.mput = mput
+        self.attributes = attributes
+
+
+class checkAndPut_result(TBase):
+    """Result of the checkAndPut call, as in the HBase 0.94 IDL."""
+
+    thrift_spec = (
+        (0, TType.BOOL, "success", None, None),
+        (1, TType.STRUCT, "io", (HBaseIOError, HBaseIOError.thrift_spec),
+         None),
+        (2, TType.STRUCT, "ia", (IllegalArgument,
+                                 IllegalArgument.thrift_spec), None),
+    )
+
+    def __init__(self, success=None, io=None, ia=None):
+        self.success = success
+        self.io = io
+        self.ia = ia
+
+
+class Client(Hbase.Client):
+    """Hbase.Client with the checkAndPut call added in HBase 0.94.
+
+    The published hbase-thrift bindings predate checkAndPut, so it is
+    implemented here in the same way as the generated calls.  Gateways
+    that lack it answer with a TApplicationException.
+    """
+
+    def checkAndPut(self, tableName, row, column, value, mput, attributes):
+        """Apply mput to the row if the column currently holds value.
+
+        A value of None checks that the column is missing.  Returns True
+        if the mutation was applied.
+        """
+        self._oprot.writeMessageBegin("checkAndPut", TMessageType.CALL,
+                                      self._seqid)
+        args = checkAndPut_args(tableName, row, column, value, mput,
+                                attributes)
+        args.write(self._oprot)
+        self._oprot.writeMessageEnd()
+        self._oprot.trans.flush()
+        (fname, mtype, rseqid) = self._iprot.readMessageBegin()
+        if mtype == TMessageType.EXCEPTION:
+            x = TApplicationException()
+            x.read(self._iprot)
+            self._iprot.readMessageEnd()
+            raise x
+        result = checkAndPut_result()
+        result.read(self._iprot)
+        self._iprot.readMessageEnd()
+        if result.io is not None:
+            raise result.io
+        if result.ia is not None:
+            raise result.ia
+        if result.success is None:
+            raise TApplicationException(
+                TApplicationException.MISSING_RESULT,
+                "checkAndPut failed: unknown result")
+        return result.success
+
+
+class ThriftConnectionPool(object):
+    """Pool of Thrift clients connected to a single HBase gateway.
+
+    Clients are created lazily up to the given pool_size, after which
+    callers will block for up to pool_timeout seconds waiting for one to
+    be returned to the pool.  Clients that hit a transport-level error are
+    discarded rather than being returned to the pool.
+    """
+
+    def __init__(self, host="localhost", port=9090, pool_size=10,
+                 pool_timeout=30, socket_timeout=None, framed=False):
+        self.host = host
+        self.port = int(port)
+        self.pool_size = int(pool_size)
+        self.max_connections = self.pool_size
+        self.pool_timeout = int(pool_timeout)
+        if socket_timeout is not None:
+            socket_timeout = int(socket_timeout)
+        self.socket_timeout = socket_timeout
+        self.framed = framed
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._num_clients = 0
+
+    def close(self):
+        """Close all idle connections in the pool."""
+        while True:
+            try:
+                client = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            self._discard(client)
+
+    @contextlib.contextmanager
+    def connection(self):
+        """Context manager to check out a client for the duration of a block.
+
+        Transport-level errors are translated into a ConnectionError and the
+        offending client is discarded.  Calls that the gateway doesn't
+        support raise NotImplementedError, and any other application-level
+        error from the gateway is raised as a ServerError.
+        """
+        client = self._checkout()
+        try:
+            yield client
+        except (TTransport.TTransportException, socket.error), e:
+            self._discard(client)
+            raise ConnectionError(str(e))
+        except TApplicationException, e:
+            self._idle.put(client)
+            if e.type == TApplicationException.UNKNOWN_METHOD:
+                raise NotImplementedError("HBase gateway does not support"
+                                          " this call: %s" % (e.message,))
+            raise ServerError(str(e))
+        except:
+            self._idle.put(client)
+            raise
+        else:
+            self._idle.put(client)
+
+    def _checkout(self):
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            can_create = (self._num_clients < self.pool_size)
+            if can_create:
+                self._num_clients += 1
+        if can_create:
+            try:
+                return self._connect()
+            except:
+                with self._lock:
+                    self._num_clients -= 1
+                raise
+        try:
+            return self._idle.get(timeout=self.pool_timeout)
+        except Queue.Empty:
+            raise ConnectionError("timed out waiting for HBase connection")
+
+    def _connect(self):
+        sock = TSocket.TSocket(self.host, self.port)
+        if self.socket_timeout is not None:
+            sock.setTimeout(self.socket_timeout * 1000)
+        if self.framed:
+            transport = TTransport.TFramedTransport(sock)
+        else:
+            transport = TTransport.TBufferedTransport(sock)
+        protocol = TBinaryProtocol.TBinaryProtocolAccelerated(transport)
+        client = Client(protocol)
+        try:
+            transport.open()
+        except (TTransport.TTransportException, socket.error), e:
+            raise ConnectionError(str(e))
+        client._transport = transport
+        return client
+
+    def _discard(self, client):
+        with self._lock:
+            self._num_clients -= 1
+        try:
+            client._transport.close()
+        except Exception:
+            pass
+
 
 class HBaseBackend(object):
     """HBase-based backend storage for Sauropod."""
 
-    def __init__(self):
-        raise NotImplementedError
+    implements(ISauropodBackend)
+
+    def __init__(self, host="localhost", port=9090, pool_size=10,
+                 pool_timeout=30, socket_timeout=None, framed_transport=False,
+                 table_prefix="", create_tables=False, batch_size=100,
+                 notifier=None, **kwds):
+        self._pool = ThriftConnectionPool(host, port, pool_size,
+                                          pool_timeout, socket_timeout,
+                                          framed_transport)
+        self.table_prefix = table_prefix
+        self.create_tables = create_tables
+        self.batch_size = int(batch_size)
+        if notifier is None:
+            notifier = default_notifier
+        self.notifier = notifier
+        self._known_tables = set()
+
+    def close(self):
+        """Close down the store."""
+        self._pool.close()
+
+    def _tablename(self, appid):
+        """Get the name of the HBase table storing data for the given app."""
+        return self.table_prefix + hashkey(_utf8(appid))
+
+    def _rowprefix(self, userid):
+        """Get the common row-key prefix for all items in a bucket."""
+        return hashkey(_utf8(userid))
+
+    def _ensure_table(self, client, table):
+        """Make sure the given table exists, creating it if configured to."""
+        if not self.create_tables or table in self._known_tables:
+            return
+        try:
+            client.createTable(table, [ColumnDescriptor(name=COLUMN_FAMILY)])
+        except AlreadyExists:
+            pass
+        self._known_tables.add(table)
+
+    def _getcell(self, client, table, row):
+        """Get the cell stored in the given row, or None if missing."""
+        try:
+            cells = client.get(table, row, VALUE_COLUMN)
+        except HBaseIOError, e:
+            # An IOError naming the table means it doesn't exist yet.
+            if e.message != table:
+                raise
+            return None
+        if not cells:
+            return None
+        return cells[0]
+
+    def _getvalue(self, client, table, row):
+        """Get the value stored in the given row, or None if missing."""
+        cell = self._getcell(client, table, row)
+        if cell is None or _is_deleting(cell.value):
+            return None
+        return cell.value
+
+    def getitem(self, appid, userid, key):
+        """Get the item stored under the specified key."""
+        key = _utf8(key)
+        table = self._tablename(appid)
+        row = self._rowprefix(userid) + key
+        with self._pool.connection() as client:
+            value = self._getvalue(client, table, row)
+        if value is None:
+            raise KeyError(key)
+        return Item(appid, userid, key, value, md5(value).hexdigest())
+
+    def getitems(self, appid, userid, keys):
+        """Get the items stored under several keys in a bucket at once.
+
+        The gateway has no multi-get, so this just saves checking out a
+        connection for each key.
+        """
+        items = {}
+        table = self._tablename(appid)
+        rowprefix = self._rowprefix(userid)
+        with self._pool.connection() as client:
+            for key in keys:
+                key = _utf8(key)
+                value = self._getvalue(client, table, rowprefix + key)
+                if value is not None:
+                    items[key] = Item(appid, userid, key, value,
+                                      md5(value).hexdigest())
+        return items
+
+    def set(self, appid, userid, key, value, if_match=None, ttl=None):
+        """Set the value stored under the specified key.
+
+        The Thrift gateway can't set a TTL on individual cells, so items
+        can't be stored with one.
+        """
+        if ttl is not None:
+            raise NotImplementedError("items can't expire in HBase")
+        key = _utf8(key)
+        value = _utf8(value)
+        table = self._tablename(appid)
+        row = self._rowprefix(userid) + key
+        mutation = Mutation(column=VALUE_COLUMN, value=value)
+        with self._pool.connection() as client:
+            self._ensure_table(client, table)
+            if if_match is None:
+                client.mutateRow(table, row, [mutation])
+            else:
+                self._check_and_put(client, table, row, key, mutation,
+                                    if_match)
+        self.notifier.notify(userid, appid, key)
+        return Item(appid, userid, key, value, md5(value).hexdigest())
+
+    def _check_and_put(self, client, table, row, key, mutation, if_match):
+        """Apply the given mutation if the current value matches if_match.
+
+        The etag is checked against the value we read, and checkAndPut then
+        applies the mutation only if that value hasn't changed since.  This
+        needs a gateway from HBase 0.94 or later; older ones make it raise
+        NotImplementedError rather than risk losing an update.
+        """
+        cell = self._getcell(client, table, row)
+        _check_etag(cell, key, if_match)
+        expected = cell.value if cell is not None else None
+        if not client.checkAndPut(table, row, VALUE_COLUMN, expected,
+                                  mutation, {}):
+            raise ConflictError(key)
+
+    def set_many(self, appid, userid, items):
+        """Set many values in a bucket, using batched mutations.
+
+        This method takes an iterable of (key, value) pairs and stores them
+        unconditionally, sending them to HBase in batches of batch_size rows
+        per mutateRows call.  It returns a list of the stored Items.
+        """
+        items = [(_utf8(key), _utf8(value)) for (key, value) in items]
+        self._put_many(appid, userid, items)
+        return [Item(appid, userid, key, value, md5(value).hexdigest())
+                for (key, value) in items]
+
+    def _put_many(self, appid, userid, items):
+        """Store (key, value) pairs in a bucket with batched mutateRows."""
+        table = self._tablename(appid)
+        prefix = self._rowprefix(userid)
+        count = 0
+        batch = []
+        with self._pool.connection() as client:
+            self._ensure_table(client, table)
+            for key, value in items:
+                mutation = Mutation(column=VALUE_COLUMN, value=_utf8(value))
+                batch.append(BatchMutation(row=prefix + _utf8(key),
+                                           mutations=[mutation]))
+                if len(batch) >= self.batch_size:
+                    client.mutateRows(table, batch)
+                    count += len(batch)
+                    batch = []
+            if batch:
+                client.mutateRows(table, batch)
+                count += len(batch)
+        self.notifier.notify(userid, appid)
+        return count
+
+    def delete(self, appid, userid, key, if_match=None):
+        """Delete the value stored under the specified key."""
+        key = _utf8(key)
+        table = self._tablename(appid)
+        row = self._rowprefix(userid) + key
+        with self._pool.connection() as client:
+            cell = self._getcell(client, table, row)
+            if cell is None or _is_deleting(cell.value):
+                if if_match is not None:
+                    if if_match != "":
+                        raise ConflictError(key)
+                raise KeyError(key)
+            if if_match is None:
+                client.deleteAllRow(table, row)
+            else:
+                _check_etag(cell, key, if_match)
+                self._check_and_delete(client, table, row, key, cell)
+        self.notifier.notify(userid, appid, key)
+
+    def _check_and_delete(self, client, table, row, key, cell):
+        """Delete the given cell if it is still the current one.
+
+        The gateway has no checkAndDelete, so checkAndPut is used to swap in
+        a placeholder that reads as missing, and then only the versions up
+        to the placeholder's are deleted.  Any write made in between has a
+        later timestamp and so survives.
+        """
+        placeholder = DELETING_PREFIX + os.urandom(8).encode("hex")
+        mutation = Mutation(column=VALUE_COLUMN, value=placeholder)
+        if not client.checkAndPut(table, row, VALUE_COLUMN, cell.value,
+                                  mutation, {}):
+            raise ConflictError(key)
+        claimed = self._getcell(client, table, row)
+        if claimed is not None and claimed.value == placeholder:
+            client.deleteAllTs(table, row, VALUE_COLUMN, claimed.timestamp)
+
+    def getstats(self, appid, userid):
+        """Get the usage counters for the specified bucket.
+
+        HBase has no transactions in which to keep counters consistent with
+        the data, so usage is not tracked by this backend.
+        """
+        raise NotImplementedError("HBaseBackend does not track usage")
+
+    def changes(self, appid, userid, since=0, limit=None):
+        """Get the changes made to a bucket since a given sequence number.
+
+        Without transactions there is no way to allocate sequence numbers
+        consistently with the writes, so this backend has no change feed.
+        """
+        raise NotImplementedError("HBaseBackend does not keep a change feed")
+
+    def delete_bucket(self, appid, userid):
+        """Delete all the values stored in the specified bucket."""
+        table = self._tablename(appid)
+        prefix = self._rowprefix(userid)
+        with self._pool.connection() as client:
+            count = self._purge_rows(client, table, prefix)
+        self.notifier.notify(userid, appid)
+        return count
+
+    def delete_user(self, userid):
+        """Delete all the values stored for a user, across all applications.
+
+        Since tables are named by a hash of the appid, we can't tell which
+        apps the user has data in.  Instead we purge the user's rows from
+        every table that could belong to this backend.
+        """
+        prefix = self._rowprefix(userid)
+        tablename_size = len(self.table_prefix) + len(hashkey(""))
+        count = 0
+        with self._pool.connection() as client:
+            for table in client.getTableNames():
+                if not table.startswith(self.table_prefix):
+                    continue
+                if len(table) != tablename_size:
+                    continue
+                count += self._purge_rows(client, table, prefix)
+        self.notifier.notify(userid)
+        return count
+
+    def _purge_rows(self, client, table, prefix):
+        """Delete all rows with the given prefix, batch_size rows at a time."""
+        try:
+            scanner = client.scannerOpenWithPrefix(table, prefix,
+                                                   [VALUE_COLUMN])
+        except HBaseIOError, e:
+            if e.message != table:
+                raise
+            return 0
+        count = 0
+        try:
+            while True:
+                rows = client.scannerGetList(scanner, self.batch_size)
+                if not rows:
+                    break
+                mutations = [Mutation(isDelete=True, column=VALUE_COLUMN)]
+                batch = [BatchMutation(row=row.row, mutations=mutations)
+                         for row in rows]
+                client.mutateRows(table, batch)
+                count += len(batch)
+        finally:
+            client.scannerClose(scanner)
+        return count
+
+    def listkeys(self, appid, userid, start=None, end=None, limit=None):
+        """List the keys available in the store."""
+        table = self._tablename(appid)
+        prefix = self._rowprefix(userid)
+        startrow = prefix
+        if start is not None:
+            startrow += _utf8(start)
+        if end is not None:
+            stoprow = prefix + _utf8(end)
+        else:
+            stoprow = _prefix_stop(prefix)
+        if limit is not None:
+            limit = int(limit)
+        keys = []
+        with self._pool.connection() as client:
+            try:
+                scanner = client.scannerOpenWithStop(table, startrow, stoprow,
+                                                     [VALUE_COLUMN])
+            except HBaseIOError, e:
+                if e.message != table:
+                    raise
+                return keys
+            try:
+                while limit is None or len(keys) < limit:
+                    nrows = self.batch_size
+                    if limit is not None:
+                        nrows = min(nrows, limit - len(keys))
+                    rows = client.scannerGetList(scanner, nrows)
+                    if not rows:
+                        break
+                    for row in rows:
+                        value = row.columns[VALUE_COLUMN].value
+                        if not _is_deleting(value):
+                            keys.append(row.row[len(prefix):])
+            finally:
+                client.scannerClose(scanner)
+        return keys
+
+    def dump(self, appid=None, userid=None):
+        """Iterate over all the items stored in the backend.
+
+        Since table names and row keys are hashed, the appid and userid for
+        a row cannot be recovered from HBase.  This backend can therefore
+        only dump a single bucket, which is streamed using a row scanner.
+        """
+        if appid is None or userid is None:
+            raise ValueError("HBaseBackend can only dump a single bucket")
+        table = self._tablename(appid)
+        prefix = self._rowprefix(userid)
+        with self._pool.connection() as client:
+            try:
+                scanner = client.scannerOpenWithPrefix(table, prefix,
+                                                       [VALUE_COLUMN])
+            except HBaseIOError, e:
+                if e.message != table:
+                    raise
+                return
+            try:
+                while True:
+                    rows = client.scannerGetList(scanner, self.batch_size)
+                    if not rows:
+                        break
+                    for row in rows:
+                        key = row.row[len(prefix):]
+                        value = row.columns[VALUE_COLUMN].value
+                        if not _is_deleting(value):
+                            yield (appid, userid, key, value)
+            finally:
+                client.scannerClose(scanner)
+
+    def load(self, records):
+        """Load items into the backend in bulk.
+
+        Consecutive records for the same bucket are sent to HBase in batches
+        of batch_size rows per mutateRows call.
+        """
+        count = 0
+        for (appid, userid), group in groupby(records, lambda r: r[:2]):
+            items = ((key, value) for (_, _, key, value) in group)
+            count += self._put_many(appid, userid, items)
+        return count
+
+
+def _check_etag(cell, key, if_match):
+    """Raise ConflictError unless the cell's value matches if_match.
+
+    An if_match of "" matches only a missing value.
+    """
+    if cell is None or _is_deleting(cell.value):
+        if if_match != "":
+            raise ConflictError(key)
+    elif md5(cell.value).hexdigest() != if_match:
+        raise ConflictError(key)
+
+
+def _is_deleting(value):
+    """Check whether a stored value is a conditional delete's placeholder."""
+    return value.startswith(DELETING_PREFIX)
+
+
+def _prefix_stop(prefix):
+    """Get the first row key that sorts after all rows with given prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _utf8(value):
+    """Encode unicode strings to utf8, leaving bytestrings alone."""
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    return value
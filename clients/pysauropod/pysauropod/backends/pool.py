@@ -0,0 +1,218 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Instrumented and adaptive connection pools for the SQL backend.
+
+InstrumentedPool is a QueuePool that records how long each checkout waited
+for a connection, how many checkouts timed out and how often connections
+had to be opened beyond the pool's size.  Timeouts are raised as a
+ServerBusyError, which the server turns into a "503 Service Unavailable".
+
+AdaptivePool also resizes itself between a minimum and a maximum size.
+Every "adjust_interval" seconds it looks back at the checkouts made since
+the last adjustment: if any of them had to wait, open an overflow
+connection or time out then the pool grows, and otherwise it shrinks
+towards the peak number of connections that were in use.  Connections
+beyond the current size are closed as they are returned.
+
+"""
+
+import time
+import threading
+
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.util import queue as sqla_queue
+
+from pysauropod.errors import ServerBusyError
+
+
+class PoolStats(object):
+    """Counters describing the checkouts made from a connection pool.
+
+    The counters are updated under a lock by every checkout, and the
+    collect_* methods report them as (labels, value) pairs suitable for
+    IMetricsRegistry.add_source().
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.overflows = 0
+        self.wait_time = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait, overflowed=False, timed_out=False):
+        with self.lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+            if overflowed:
+                self.overflows += 1
+            self.wait_time += wait
+            if wait > self.max_wait:
+                self.max_wait = wait
+
+    def collect_checkouts(self):
+        return [((("result", "ok"),), self.checkouts),
+                ((("result", "timeout"),), self.timeouts)]
+
+    def collect_wait_time(self):
+        return [((), self.wait_time)]
+
+    def collect_overflows(self):
+        return [((), self.overflows)]
+
+    def collect_connections(self):
+        pool = self.pool
+        return [((("state", "in_use"),), pool.checkedout()),
+                ((("state", "idle"),), pool.checkedin()),
+                ((("state", "size"),), pool.size())]
+
+    def metric_sources(self):
+        """Get (name, help, collect, type) tuples for each metric."""
+        return [
+            ("sauropod_pool_checkouts_total",
+             "Connections checked out of the database pool, by result.",
+             self.collect_checkouts, "counter"),
+            ("sauropod_pool_checkout_wait_seconds_total",
+             "Time spent waiting to check out database connections.",
+             self.collect_wait_time, "counter"),
+            ("sauropod_pool_overflows_total",
+             "Database connections opened beyond the pool size.",
+             self.collect_overflows, "counter"),
+            ("sauropod_pool_connections",
+             "Database connections in the pool, by state.",
+             self.collect_connections, "gauge"),
+        ]
+
+
+class InstrumentedPool(QueuePool):
+    """QueuePool that records checkout telemetry in a PoolStats object."""
+
+    def __init__(self, *args, **kwds):
+        QueuePool.__init__(self, *args, **kwds)
+        self.stats = PoolStats(self)
+
+    def _do_get(self):
+        start = time.time()
+        overflow = self._overflow
+        try:
+            conn = QueuePool._do_get(self)
+        except exc.TimeoutError:
+            self._record(time.time() - start, timed_out=True)
+            raise ServerBusyError("timed out waiting for a connection",
+                                  retry_after=1)
+        overflowed = self._overflow > max(overflow, 0)
+        self._record(time.time() - start, overflowed)
+        return conn
+
+    def _record(self, wait, overflowed=False, timed_out=False):
+        self.stats.record(wait, overflowed, timed_out)
+
+    def recreate(self):
+        pool = QueuePool.recreate(self)
+        pool.stats = self.stats
+        self.stats.pool = pool
+        return pool
+
+
+class AdaptivePool(InstrumentedPool):
+    """InstrumentedPool that grows and shrinks with the observed load.
+
+    The pool starts at the size it was created with, and can open as many
+    connections as that size plus its max_overflow.  Call configure() to
+    set the smallest size it may shrink to.
+    """
+
+    min_size = 1
+    wait_threshold = 0.01
+    adjust_interval = 10
+
+    def __init__(self, *args, **kwds):
+        InstrumentedPool.__init__(self, *args, **kwds)
+        self.max_size = self.size() + self._max_overflow
+        self._adapt_lock = threading.Lock()
+        self._start_window(time.time())
+
+    def configure(self, min_size=None, wait_threshold=None,
+                  adjust_interval=None):
+        """Set the parameters used to adapt the pool's size."""
+        if min_size is not None:
+            self.min_size = max(1, min(int(min_size), self.max_size))
+        if wait_threshold is not None:
+            self.wait_threshold = float(wait_threshold)
+        if adjust_interval is not None:
+            self.adjust_interval = float(adjust_interval)
+        self.resize(self.size())
+
+    def _start_window(self, now):
+        self._window_start = now
+        self._pressure = 0
+        self._peak = 0
+
+    def _record(self, wait, overflowed=False, timed_out=False):
+        InstrumentedPool._record(self, wait, overflowed, timed_out)
+        now = time.time()
+        with self._adapt_lock:
+            if timed_out or overflowed or wait >= self.wait_threshold:
+                self._pressure += 1
+            self._peak = max(self._peak, self.checkedout())
+            if now - self._window_start < self.adjust_interval:
+                return
+            size = self.size()
+            step = max(1, size // 4)
+            if self._pressure:
+                target = max(size + step, self._peak)
+            else:
+                target = max(size - step, self._peak)
+            self._start_window(now)
+        if target != size:
+            self.resize(target)
+
+    def resize(self, size):
+        """Change the number of connections kept in the pool.
+
+        The size is clamped to the pool's limits.  The most connections
+        that may be open at once stays the same, as the overflow allowance
+        is adjusted to match.  Idle connections beyond the new size are
+        closed straight away.
+        """
+        size = max(self.min_size, min(int(size), self.max_size))
+        with self._overflow_lock:
+            delta = self._pool.maxsize - size
+            self._pool.maxsize = size
+            self._overflow += delta
+            self._max_overflow += delta
+        while self._pool.qsize() > size:
+            try:
+                conn = self._pool.get(False)
+            except sqla_queue.Empty:
+                break
+            try:
+                conn.close()
+            finally:
+                self._dec_overflow()
+
+    def _do_return_conn(self, conn):
+        # The queue only refuses connections when it's exactly full, so
+        # check for it having been left over-full by a resize.
+        if self._pool.qsize() >= self.size():
+            try:
+                conn.close()
+            finally:
+                self._dec_overflow()
+        else:
+            InstrumentedPool._do_return_conn(self, conn)
+
+    def recreate(self):
+        pool = InstrumentedPool.recreate(self)
+        pool.max_size = self.max_size
+        pool.configure(self.min_size, self.wait_threshold,
+                       self.adjust_interval)
+        return pool
@@ -7,19 +7,31 @@ SQLAlchemy-based backend for the Sauropod data store.
 
 """
 
+import math
+import time
+import logging
 import urlparse
+import threading
 from hashlib import md5
 
 from zope.interface import implements
 
-from sqlalchemy.pool import QueuePool
-from sqlalchemy import (Integer, String, LargeBinary, Column, Index,
-                        ForeignKeyConstraint, Table, MetaData, create_engine)
+from sqlalchemy import event, inspect
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.pool import SingletonThreadPool
+from sqlalchemy import (Integer, BigInteger, String, LargeBinary, Column,
+                        Index, ForeignKeyConstraint, Table, MetaData,
+                        create_engine)
 
-from pysauropod.errors import ConflictError
-from pysauropod.interfaces import ISauropodBackend, Item
+from pysauropod.errors import (ConflictError, QuotaExceededError,
+                               ResyncRequiredError)
+from pysauropod.interfaces import ISauropodBackend, Item, Change
+from pysauropod.backends.pool import InstrumentedPool, AdaptivePool
+from pysauropod.notify import default_notifier
 
 
+logger = logging.getLogger("pysauropod.backends.sql")
+
 metadata = MetaData()
 tables = []
 
@@ -31,128 +43,514 @@ buckets = Table("buckets", metadata,
     Column("userid",  String(64), nullable=False),
 )
 Index("idx_buckets", buckets.c.appid, buckets.c.userid, unique=True)
+Index("idx_buckets_userid", buckets.c.userid)
 tables.append(buckets)
 
-# Table mapping (bucket, key) to value
+# Table mapping (bucket, key) to value, and the time at which the item
+# expires if it was written with a TTL.
 #
 items = Table("items", metadata,
     Column("bucket", Integer, primary_key=True, nullable=False),
     Column("key", String(256), primary_key=True, nullable=False),
     Column("value", LargeBinary, nullable=False),
+    Column("expires", Integer, nullable=True),
     ForeignKeyConstraint(["bucket"], ["buckets.bucket"], ondelete="CASCADE"),
 )
+Index("idx_items_expires", items.c.expires)
 tables.append(items)
 
+# Table of usage counters for each bucket, maintained by every write.
+# It also holds the bucket's latest change sequence number, and the highest
+# sequence number whose tombstone has been compacted away.
+#
+bucket_stats = Table("bucket_stats", metadata,
+    Column("bucket", Integer, primary_key=True, autoincrement=False),
+    Column("num_items", Integer, nullable=False),
+    Column("num_bytes", BigInteger, nullable=False),
+    Column("last_seq", BigInteger, nullable=False),
+    Column("purged_seq", BigInteger, nullable=False),
+    ForeignKeyConstraint(["bucket"], ["buckets.bucket"], ondelete="CASCADE"),
+)
+tables.append(bucket_stats)
+
+# Table recording the latest change to each key in a bucket.
+# Deleted keys are kept as tombstones until they are compacted.
+#
+changes = Table("changes", metadata,
+    Column("bucket", Integer, primary_key=True, nullable=False),
+    Column("key", String(256), primary_key=True, nullable=False),
+    Column("seq", BigInteger, nullable=False),
+    Column("deleted", Integer, nullable=False),
+    Column("modified", Integer, nullable=False),
+    ForeignKeyConstraint(["bucket"], ["buckets.bucket"], ondelete="CASCADE"),
+)
+Index("idx_changes_seq", changes.c.bucket, changes.c.seq)
+Index("idx_changes_tombstones", changes.c.deleted, changes.c.modified)
+tables.append(changes)
+
+
+class QueryStats(threading.local):
+    """Per-thread tally of the SQL queries run and the time spent on them.
+
+    Call reset() at the start of a unit of work, such as a web request, and
+    read the "count" and "duration" attributes at the end of it.
+    """
+
+    count = 0
+    duration = 0.0
+
+    def reset(self):
+        self.count = 0
+        self.duration = 0.0
+
 
 class SQLBackend(object):
-    """ISauropodBackend implemented on top of an SQL database."""
+    """ISauropodBackend implemented on top of an SQL database.
+
+    Every query run by the backend is tallied in its "query_stats" object,
+    and any query taking longer than "slow_query_threshold" seconds is
+    logged as a warning along with the types of its parameters.
+
+    File-backed SQLite databases can be opened with "sqlite_tuned" set,
+    which switches them to WAL journaling with the pragmas given by the
+    other "sqlite_*" options.  Reads then go through a separate engine
+    holding one connection per thread, and all writes are serialized
+    through a single writer connection, so that readers never wait on a
+    writer and writers never fail with "database is locked".
+
+    Pooled engines keep telemetry about connection checkouts in their
+    "pool_stats" object, and raise ServerBusyError when no connection
+    becomes free within "pool_timeout" seconds.  With "pool_adaptive" set
+    the pool starts at "pool_min_size" connections and grows as checkouts
+    have to wait, up to "pool_size" plus "pool_max_overflow", shrinking
+    again when the load drops.  Adaptive pools give up on a checkout
+    after a second by default, so that callers fail fast.
+
+    Items written with a TTL read as missing once it has passed, and are
+    deleted by expire_items(), which should be run periodically.
+    """
 
     implements(ISauropodBackend)
 
     def __init__(self, sqluri, pool_size=100, pool_recycle=60,
                  reset_on_return=True, create_tables=False,
                  pool_max_overflow=10, no_pool=False,
-                 pool_timeout=30, **kwds):
+                 pool_timeout=None, batch_size=1000, quota_items=None,
+                 quota_bytes=None, change_retention=30 * 24 * 60 * 60,
+                 notifier=None, slow_query_threshold=None,
+                 sqlite_tuned=False, sqlite_mmap_size=256 * 1024 * 1024,
+                 sqlite_cache_size=-16000, sqlite_busy_timeout=5000,
+                 pool_adaptive=False, pool_min_size=5,
+                 pool_wait_threshold=0.01, pool_adjust_interval=10,
+                 expiry_batch_size=100, **kwds):
         self.sqluri = sqluri
+        self.batch_size = int(batch_size)
+        self.expiry_batch_size = int(expiry_batch_size)
+        self.quota_items = int(quota_items) if quota_items else None
+        self.quota_bytes = int(quota_bytes) if quota_bytes else None
+        self.change_retention = int(change_retention)
+        if notifier is None:
+            notifier = default_notifier
+        self.notifier = notifier
         self.driver = urlparse.urlparse(sqluri).scheme
+        # WAL journaling needs a database file.
+        self.sqlite_tuned = _asbool(sqlite_tuned) and \
+            self.driver == "sqlite" and ":memory:" not in sqluri and \
+            urlparse.urlparse(sqluri).path not in ("", "/")
+        self.sqlite_pragmas = [("journal_mode", "WAL"),
+                               ("synchronous", "NORMAL"),
+                               ("mmap_size", int(sqlite_mmap_size)),
+                               ("cache_size", int(sqlite_cache_size)),
+                               ("busy_timeout", int(sqlite_busy_timeout))]
+        pool_adaptive = _asbool(pool_adaptive)
+        if pool_timeout is None:
+            pool_timeout = 1 if pool_adaptive else 30
         # Create the engine pased on database type and given parameters.
         # SQLite :memory: engines are limited to a single shared connection,
         # while other SQLite engines get only the default pool options.
-        if no_pool or self.driver == 'sqlite':
+        # Tuned SQLite engines have a single connection for writing.
+        if self.sqlite_tuned:
+            sqlkw = {'poolclass': InstrumentedPool, 'pool_size': 1,
+                     'max_overflow': 0, 'pool_timeout': float(pool_timeout),
+                     'connect_args': {'check_same_thread': False}}
+        elif no_pool or self.driver == 'sqlite':
             sqlkw = {}
             if ":memory:" in sqluri or sqluri == "sqlite://":
-                sqlkw['poolclass'] = QueuePool
+                sqlkw['poolclass'] = InstrumentedPool
                 sqlkw['pool_size'] = 1
                 sqlkw['max_overflow'] = 0
                 sqlkw['connect_args'] = {'check_same_thread': False}
         else:
-            sqlkw = {'pool_size': int(pool_size),
+            sqlkw = {'poolclass': InstrumentedPool,
+                     'pool_size': int(pool_size),
                      'pool_recycle': int(pool_recycle),
-                     'pool_timeout': int(pool_timeout),
+                     'pool_timeout': float(pool_timeout),
                      'max_overflow': int(pool_max_overflow)}
             if self.driver.startswith("mysql") or self.driver == "pymsql":
                 sqlkw['reset_on_return'] = reset_on_return
+            # Adaptive pools start small, but can open as many connections.
+            if pool_adaptive:
+                max_size = sqlkw['pool_size'] + sqlkw['max_overflow']
+                min_size = max(1, min(int(pool_min_size), max_size))
+                sqlkw['poolclass'] = AdaptivePool
+                sqlkw['pool_size'] = min_size
+                sqlkw['max_overflow'] = max_size - min_size
+        # Note the most connections the engine will open at once, if that's
+        # limited, so that callers can size their thread pools to match.
+        # Tuned SQLite engines are limited by the number of readers.
+        if self.sqlite_tuned:
+            self.max_connections = int(pool_size)
+        elif 'pool_size' in sqlkw:
+            self.max_connections = sqlkw['pool_size'] + sqlkw['max_overflow']
+        else:
+            self.max_connections = None
         sqlkw['logging_name'] = 'sqlstore'
         self._engine = create_engine(sqluri, **sqlkw)
+        self.pool_stats = getattr(self._engine.pool, "stats", None)
+        if isinstance(self._engine.pool, AdaptivePool):
+            self._engine.pool.configure(min_size, pool_wait_threshold,
+                                        pool_adjust_interval)
+        # Tuned SQLite engines read through a second engine, which gives
+        # each thread a connection of its own.  The pool must be big enough
+        # for every thread, or it will close connections that are in use.
+        if self.sqlite_tuned:
+            self._reader = create_engine(sqluri,
+                                         poolclass=SingletonThreadPool,
+                                         pool_size=int(pool_size),
+                                         connect_args={
+                                             'check_same_thread': False,
+                                         },
+                                         logging_name='sqlstore_reader')
+            engines = [self._engine, self._reader]
+        else:
+            self._reader = self._engine
+            engines = [self._engine]
+        self.query_stats = QueryStats()
+        if slow_query_threshold is not None:
+            slow_query_threshold = float(slow_query_threshold)
+        self.slow_query_threshold = slow_query_threshold
+        for engine in engines:
+            # Have SQLite hand back TEXT columns as bytestrings, rather than
+            # decoding values to unicode only for us to encode them again.
+            if self.driver == "sqlite":
+                event.listen(engine, "connect", _return_bytestrings)
+            if self.sqlite_tuned:
+                event.listen(engine, "connect", self._set_pragmas)
+            event.listen(engine, "before_cursor_execute",
+                         self._before_cursor_execute)
+            event.listen(engine, "after_cursor_execute",
+                         self._after_cursor_execute)
         # Bind the tables to the engine, creating if necessary.
         for table in tables:
             table.metadata.bind = self._engine
             if create_tables:
                 table.create(checkfirst=True)
+        if create_tables:
+            self._add_expiry_column()
+            self._add_missing_indexes()
         self.engine_name = self._engine.name
 
     def close(self):
         """Close down the store."""
         self._engine.dispose()
+        if self._reader is not self._engine:
+            self._reader.dispose()
 
     def execute(self, query, *args, **kwds):
         return self._engine.execute(query, *args, **kwds)
 
-    def _getbucket(self, appid, userid):
-        """Get the ID for the given bucket, creating if necessary."""
+    def _read(self, query, *args, **kwds):
+        """Run a read-only query, on the thread's own reader if there is one.
+
+        Readers see everything committed when each query starts, so use
+        the writer's connection for reads that must be consistent with a
+        write in progress.
+        """
+        return self._reader.execute(query, *args, **kwds)
+
+    def _add_expiry_column(self):
+        """Add the items.expires column to tables created without it."""
+        columns = inspect(self._engine).get_columns("items")
+        if "expires" in [column["name"] for column in columns]:
+            return
+        self.execute("ALTER TABLE items ADD COLUMN expires INTEGER")
+
+    def _add_missing_indexes(self):
+        """Create any indexes missing from tables created without them.
+
+        create(checkfirst=True) skips tables that already exist, so indexes
+        added since, such as idx_buckets_userid, must be created here.
+        """
+        inspector = inspect(self._engine)
+        for table in tables:
+            existing = set(index["name"]
+                           for index in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(self._engine)
+
+    def _set_pragmas(self, dbapi_connection, connection_record):
+        """Engine "connect" hook applying the tuned SQLite pragmas."""
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in self.sqlite_pragmas:
+                cursor.execute("PRAGMA %s = %s" % (name, value))
+        finally:
+            cursor.close()
+
+    def _before_cursor_execute(self, conn, cursor, statement, parameters,
+                               context, executemany):
+        if context is not None:
+            context._sauropod_start = time.time()
+
+    def _after_cursor_execute(self, conn, cursor, statement, parameters,
+                              context, executemany):
+        start = getattr(context, "_sauropod_start", None)
+        if start is None:
+            return
+        duration = time.time() - start
+        self.query_stats.count += 1
+        self.query_stats.duration += duration
+        threshold = self.slow_query_threshold
+        if threshold is not None and duration >= threshold:
+            # Log only the shape of the parameters, never the user data.
+            logger.warning("slow query (%.3fs): %s %s", duration,
+                           " ".join(statement.split()),
+                           _param_shape(parameters, executemany))
+
+    def _getbucket(self, appid, userid, connection=None):
+        """Get the ID for the given bucket, creating if necessary.
+
+        The bucket is normally created on a connection of its own, outside
+        any transaction in progress, so that losing a race to create it
+        can't abort the caller's transaction, and the winner's row is not
+        hidden by the caller's snapshot.  SQLite databases must use the
+        caller's connection instead, since :memory: databases only have
+        one and file databases would block on the caller's write lock.
+        """
+        if connection is None or self.driver != "sqlite":
+            connection = self
         get_query = "SELECT bucket FROM buckets"\
                     " WHERE appid = :appid AND userid = :userid"
         qargs = {"appid": appid, "userid": userid}
-        row = self.execute(get_query, **qargs).fetchone()
+        row = connection.execute(get_query, **qargs).fetchone()
         if row is None:
             ins_query = "INSERT INTO buckets VALUES (NULL, :appid, :userid)"
             try:
-                self.execute(ins_query, **qargs)
-            except Exception:
+                connection.execute(ins_query, **qargs)
+            except IntegrityError:
                 # Someone already created it for us.
-                # XXX: restrict to sqlalchemy conflict error
                 pass
-            row = self.execute(get_query, **qargs).fetchone()
+            row = connection.execute(get_query, **qargs).fetchone()
+            # Create the usage counters along with the bucket.
+            stats_query = "INSERT INTO bucket_stats"\
+                          " VALUES (:bucket, 0, 0, 0, 0)"
+            try:
+                connection.execute(stats_query, bucket=row[0])
+            except IntegrityError:
+                # Someone already created them for us.
+                pass
         return row[0]
 
+    def getstats(self, appid, userid):
+        """Get the usage counters for the specified bucket."""
+        query = "SELECT s.num_items, s.num_bytes"\
+                " FROM bucket_stats s, buckets k"\
+                " WHERE s.bucket = k.bucket"\
+                " AND k.appid = :appid AND k.userid = :userid"
+        row = self._read(query, appid=appid, userid=userid).fetchone()
+        if row is None:
+            return {"items": 0, "bytes": 0}
+        return {"items": int(row[0]), "bytes": int(row[1])}
+
+    def _check_quota(self, totals, num_items, num_bytes):
+        """Check that a write that added to the bucket's usage is in quota.
+
+        The totals are the bucket's usage including the write.  Writes that
+        don't add items or bytes are always allowed.
+        """
+        if self.quota_items is not None and num_items > 0:
+            if totals[0] > self.quota_items:
+                raise QuotaExceededError("too many items")
+        if self.quota_bytes is not None and num_bytes > 0:
+            if totals[1] > self.quota_bytes:
+                raise QuotaExceededError("too many bytes")
+
+    def _update_stats(self, connection, bucket, num_items, num_bytes,
+                      num_changes=1, check_quota=False):
+        """Add to the usage counters for the given bucket.
+
+        This also advances the bucket's sequence number by the given number
+        of changes, and returns the new value.  The counters row is locked
+        until the transaction commits, so concurrent writers to the bucket
+        are given distinct sequence numbers, and each sees the totals that
+        include the others' writes.  With check_quota set, QuotaExceededError
+        is raised if the write takes the bucket over its quota, and the
+        caller must roll back.
+        """
+        qargs = {"bucket": bucket, "items": num_items, "bytes": num_bytes,
+                 "changes": num_changes}
+        upd_query = "UPDATE bucket_stats"\
+                    " SET num_items = num_items + :items,"\
+                    "     num_bytes = num_bytes + :bytes,"\
+                    "     last_seq = last_seq + :changes"\
+                    " WHERE bucket = :bucket"
+        if connection.execute(upd_query, **qargs).rowcount == 0:
+            # Buckets created before we kept stats won't have a row yet.
+            self._create_stats(connection, bucket, upd_query, qargs)
+        query = "SELECT num_items, num_bytes, last_seq FROM bucket_stats"\
+                " WHERE bucket = :bucket"
+        row = connection.execute(query, bucket=bucket).fetchone()
+        if check_quota:
+            self._check_quota(row, num_items, num_bytes)
+        return int(row[2])
+
+    def _create_stats(self, connection, bucket, upd_query, qargs):
+        """Create the usage counters for a bucket that predates them.
+
+        The totals are counted from the items in the bucket, which already
+        include the caller's write.  If another writer creates the row
+        first, the caller's update is applied to theirs instead.
+        """
+        if self.driver == "sqlite":
+            size = "LENGTH(CAST(key AS BLOB)) + LENGTH(CAST(value AS BLOB))"
+        else:
+            size = "OCTET_LENGTH(key) + OCTET_LENGTH(value)"
+        ins_query = "INSERT INTO bucket_stats"\
+                    " SELECT :bucket, COUNT(*), COALESCE(SUM(%s), 0),"\
+                    "        :changes, 0"\
+                    " FROM items WHERE bucket = :bucket" % (size,)
+        # Writes to SQLite are serialized, so there's no race to lose.
+        if self.driver == "sqlite":
+            connection.execute(ins_query, **qargs)
+            return
+        savepoint = connection.begin_nested()
+        try:
+            connection.execute(ins_query, **qargs)
+        except IntegrityError:
+            savepoint.rollback()
+            connection.execute(upd_query, **qargs)
+        else:
+            savepoint.commit()
+
+    def _record_change(self, connection, bucket, key, seq, deleted=False):
+        """Record the latest change to a key in the bucket's change feed."""
+        qargs = {"bucket": bucket, "key": key, "seq": seq,
+                 "deleted": int(deleted), "modified": int(time.time())}
+        upd_query = "UPDATE changes"\
+                    " SET seq = :seq, deleted = :deleted,"\
+                    "     modified = :modified"\
+                    " WHERE bucket = :bucket AND key = :key"
+        if connection.execute(upd_query, **qargs).rowcount == 0:
+            ins_query = "INSERT INTO changes"\
+                        " VALUES (:bucket, :key, :seq, :deleted, :modified)"
+            connection.execute(ins_query, **qargs)
+
     def getitem(self, appid, userid, key, connection=None):
         """Get the item stored under the specified key."""
+        item = self._lookup(appid, userid, key, connection)
+        if item is None or _has_expired(item.expires, time.time()):
+            raise KeyError(key)
+        return item
+
+    def _lookup(self, appid, userid, key, connection=None):
+        """Get the item stored under a key, even if expired, or None."""
         if connection is None:
-            connection = self
-        query = "SELECT i.value, k.bucket FROM items i, buckets k"\
+            connection = self._reader
+        query = "SELECT i.value, k.bucket, i.expires FROM items i, buckets k"\
                 " WHERE i.bucket = k.bucket"\
                 " AND k.appid = :appid AND k.userid = :userid"\
                 " AND key = :key"
         qargs = {"appid": appid, "userid": userid, "key": key}
         row = connection.execute(query, **qargs).fetchone()
         if row is None:
-            raise KeyError(key)
-        etag = md5(row[0]).hexdigest()
-        item = Item(appid, userid, key, row[0], etag)
-        item.bucket = row[1]
-        if isinstance(item.key, unicode):
-            item.key = item.key.encode("utf8")
-        if isinstance(item.value, unicode):
-            item.value = item.value.encode("utf8")
-        return item
+            return None
+        value = row[0]
+        if not isinstance(value, str):
+            value = _to_bytes(value)
+        if isinstance(key, unicode):
+            key = key.encode("utf8")
+        return Item(appid, userid, key, value, md5(value).hexdigest(), row[1],
+                    row[2])
+
+    def getitems(self, appid, userid, keys):
+        """Get the items stored under several keys in a bucket at once."""
+        items = {}
+        keys = [_to_bytes(key) for key in keys]
+        now = time.time()
+        for i in xrange(0, len(keys), self.batch_size):
+            batch = keys[i:i + self.batch_size]
+            qargs = {"appid": appid, "userid": userid}
+            for j, key in enumerate(batch):
+                qargs["key%d" % (j,)] = key
+            query = "SELECT i.key, i.value, k.bucket, i.expires"\
+                    " FROM items i, buckets k"\
+                    " WHERE i.bucket = k.bucket"\
+                    " AND k.appid = :appid AND k.userid = :userid"\
+                    " AND i.key IN (%s)"
+            query %= ", ".join(":key%d" % (j,) for j in xrange(len(batch)))
+            for row in self._read(query, **qargs):
+                if _has_expired(row[3], now):
+                    continue
+                key = _to_bytes(row[0])
+                value = _to_bytes(row[1])
+                items[key] = Item(appid, userid, key, value,
+                                  md5(value).hexdigest(), row[2], row[3])
+        return items
 
-    def set(self, appid, userid, key, value, if_match=None):
-        """Set the value stored under the specified key."""
-        qargs = {"key": key, "value": value}
-        set_query = "UPDATE items SET value = :value"\
+    def set(self, appid, userid, key, value, if_match=None, ttl=None):
+        """Set the value stored under the specified key.
+
+        If "ttl" is given then the item expires that many seconds from now,
+        rounded up to a whole second.
+        """
+        if ttl is not None:
+            expires = int(math.ceil(time.time() + ttl))
+        else:
+            expires = None
+        qargs = {"key": key, "value": value, "expires": expires}
+        set_query = "UPDATE items SET value = :value, expires = :expires"\
                     " WHERE bucket = :bucket AND key = :key"
-        ins_query = "INSERT INTO items VALUES (:bucket, :key, :value)"
+        ins_query = "INSERT INTO items (bucket, key, value, expires)"\
+                    " VALUES (:bucket, :key, :value, :expires)"
         # We need a transaction in order to check the etag.
         connection = self._engine.connect()
         trn = connection.begin()
         try:
-            try:
-                item = self.getitem(appid, userid, key, connection)
-            except KeyError:
+            item = self._lookup(appid, userid, key, connection)
+            if item is None or _has_expired(item.expires, time.time()):
                 if if_match is not None:
                     if if_match != "":
                         raise ConflictError(key)
-                qargs["bucket"] = self._getbucket(appid, userid)
-                connection.execute(ins_query, **qargs)
+                if item is None:
+                    qargs["bucket"] = self._getbucket(appid, userid,
+                                                      connection)
+                    num_items = 1
+                    num_bytes = _size(key) + _size(value)
+                    query = ins_query
+                else:
+                    # An expired item that hasn't been swept yet is
+                    # overwritten in place.
+                    qargs["bucket"] = item.bucket
+                    num_items = 0
+                    num_bytes = _size(value) - _size(item.value)
+                    query = set_query
             else:
                 if if_match is not None:
                     if item.etag != if_match:
                         raise ConflictError(key)
                 qargs["bucket"] = item.bucket
-                connection.execute(set_query, **qargs)
+                num_items = 0
+                num_bytes = _size(value) - _size(item.value)
+                query = set_query
+            connection.execute(query, **qargs)
+            seq = self._update_stats(connection, qargs["bucket"],
+                                     num_items, num_bytes, check_quota=True)
+            self._record_change(connection, qargs["bucket"], key, seq)
             trn.commit()
+            self.notifier.notify(userid, appid, key)
             etag = md5(value).hexdigest()
-            return Item(appid, userid, key, value, etag)
+            return Item(appid, userid, key, value, etag, expires=expires)
         except:
             trn.rollback()
             raise
@@ -168,6 +566,7 @@ class SQLBackend(object):
         trn = connection.begin()
         try:
             try:
+                # Expired items are left for expire_items() to delete.
                 item = self.getitem(appid, userid, key, connection)
             except KeyError:
                 if if_match is not None:
@@ -185,20 +584,248 @@ class SQLBackend(object):
                 # Check that we actualy deleted something
                 if res.rowcount == 0:
                     raise KeyError(key)
+                num_bytes = _size(key) + _size(item.value)
+                seq = self._update_stats(connection, item.bucket,
+                                         -1, -num_bytes)
+                self._record_change(connection, item.bucket, key, seq,
+                                    deleted=True)
             trn.commit()
+            self.notifier.notify(userid, appid, key)
         except:
             trn.rollback()
             raise
         finally:
             connection.close()
 
+    def delete_bucket(self, appid, userid):
+        """Delete all the items stored in the specified bucket."""
+        get_query = "SELECT bucket FROM buckets"\
+                    " WHERE appid = :appid AND userid = :userid"
+        row = self.execute(get_query, appid=appid, userid=userid).fetchone()
+        if row is None:
+            return 0
+        count = self._purge_bucket(row[0])
+        self.notifier.notify(userid, appid)
+        return count
+
+    def delete_user(self, userid):
+        """Delete all the items stored for the specified user, in all apps."""
+        get_query = "SELECT bucket FROM buckets WHERE userid = :userid"
+        rows = self.execute(get_query, userid=userid).fetchall()
+        count = sum(self._purge_bucket(row[0]) for row in rows)
+        self.notifier.notify(userid)
+        return count
+
+    def _purge_bucket(self, bucket):
+        """Delete a bucket and all the items it contains.
+
+        Items are deleted in primary-key ranges of batch_size rows, each in
+        its own short transaction, so purging a large bucket never holds
+        locks on much of the table at once.  The same goes for its change
+        feed.  The bucket itself is removed along with any stragglers in a
+        final transaction.
+        """
+        count = self._purge_keys("items", bucket)
+        self._purge_keys("changes", bucket)
+        connection = self._engine.connect()
+        trn = connection.begin()
+        try:
+            items_query = "DELETE FROM items WHERE bucket = :bucket"
+            count += connection.execute(items_query, bucket=bucket).rowcount
+            changes_query = "DELETE FROM changes WHERE bucket = :bucket"
+            connection.execute(changes_query, bucket=bucket)
+            stats_query = "DELETE FROM bucket_stats WHERE bucket = :bucket"
+            connection.execute(stats_query, bucket=bucket)
+            bucket_query = "DELETE FROM buckets WHERE bucket = :bucket"
+            connection.execute(bucket_query, bucket=bucket)
+            trn.commit()
+        except:
+            trn.rollback()
+            raise
+        finally:
+            connection.close()
+        return count
+
+    def _purge_keys(self, table, bucket):
+        """Delete all but the last batch of a bucket's rows from a table."""
+        qargs = {"bucket": bucket, "limit": self.batch_size}
+        keys_query = "SELECT key FROM %s WHERE bucket = :bucket"\
+                     " ORDER BY key ASC LIMIT :limit" % (table,)
+        range_query = "DELETE FROM %s"\
+                      " WHERE bucket = :bucket AND key <= :last_key" % (table,)
+        count = 0
+        while True:
+            rows = self.execute(keys_query, **qargs).fetchall()
+            if len(rows) < self.batch_size:
+                break
+            qargs["last_key"] = rows[-1][0]
+            count += self.execute(range_query, **qargs).rowcount
+        return count
+
+    def changes(self, appid, userid, since=0, limit=None):
+        """Get the changes made to a bucket since a given sequence number.
+
+        If "since" is ahead of the bucket's sequence number then the bucket
+        must have been deleted and recreated, and if it's behind the point
+        to which tombstones have been compacted then some deletions may have
+        been lost.  Either way the caller must resync from scratch.
+        """
+        seq_query = "SELECT s.bucket, s.last_seq, s.purged_seq"\
+                    " FROM bucket_stats s, buckets k"\
+                    " WHERE s.bucket = k.bucket"\
+                    " AND k.appid = :appid AND k.userid = :userid"
+        row = self._read(seq_query, appid=appid, userid=userid).fetchone()
+        if row is None:
+            if since > 0:
+                raise ResyncRequiredError("bucket does not exist")
+            return []
+        bucket, last_seq, purged_seq = row
+        if since > last_seq:
+            raise ResyncRequiredError("bucket has been reset")
+        if 0 < since < purged_seq:
+            raise ResyncRequiredError("changes have been compacted")
+        qargs = {"bucket": bucket, "since": since, "limit": limit}
+        changes_query = "SELECT c.key, c.seq, i.value, i.expires"\
+                        " FROM changes c LEFT OUTER JOIN items i"\
+                        " ON (i.bucket = c.bucket AND i.key = c.key)"\
+                        " WHERE c.bucket = :bucket AND c.seq > :since"\
+                        " ORDER BY c.seq ASC"
+        if limit is not None:
+            changes_query += " LIMIT :limit"
+        result = []
+        now = time.time()
+        for row in self._read(changes_query, **qargs):
+            key = _to_bytes(row[0])
+            if row[2] is None or _has_expired(row[3], now):
+                item = None
+            else:
+                value = _to_bytes(row[2])
+                item = Item(appid, userid, key, value, md5(value).hexdigest(),
+                            bucket, row[3])
+            result.append(Change(int(row[1]), key, item))
+        return result
+
+    def compact_changes(self, retention=None):
+        """Discard the tombstones of keys deleted a while ago.
+
+        Tombstones older than "retention" seconds (by default, the backend's
+        change_retention setting) are deleted in batches, and each bucket
+        remembers the highest sequence number discarded so that clients
+        resuming from before that point can be told to resync.  This should
+        be run periodically; it returns the number of tombstones discarded.
+        """
+        if retention is None:
+            retention = self.change_retention
+        qargs = {"cutoff": int(time.time() - retention),
+                 "limit": self.batch_size}
+        tomb_query = "SELECT bucket, key, seq FROM changes"\
+                     " WHERE deleted = 1 AND modified < :cutoff"\
+                     " LIMIT :limit"
+        purge_query = "UPDATE bucket_stats SET purged_seq = :seq"\
+                      " WHERE bucket = :bucket AND purged_seq < :seq"
+        del_query = "DELETE FROM changes"\
+                    " WHERE bucket = :bucket AND key = :key AND seq = :seq"
+        count = 0
+        while True:
+            rows = self._read(tomb_query, **qargs).fetchall()
+            if not rows:
+                break
+            purged = {}
+            for bucket, key, seq in rows:
+                purged[bucket] = max(seq, purged.get(bucket, 0))
+            connection = self._engine.connect()
+            trn = connection.begin()
+            try:
+                for bucket, seq in purged.iteritems():
+                    connection.execute(purge_query, bucket=bucket, seq=seq)
+                # Tombstones that were overwritten in the meantime will have
+                # a new seq, and so are left alone.
+                connection.execute(del_query, [{"bucket": bucket,
+                                                "key": key, "seq": seq}
+                                               for (bucket, key, seq) in rows])
+                trn.commit()
+            except:
+                trn.rollback()
+                raise
+            finally:
+                connection.close()
+            count += len(rows)
+            if len(rows) < self.batch_size:
+                break
+        return count
+
+    def expire_items(self):
+        """Delete the items whose TTL has passed.
+
+        Expired items are found through the index on their expiry time and
+        deleted expiry_batch_size at a time, each batch in a transaction of
+        its own so that no locks are held over a large range of rows.  The
+        deletions are recorded in the change feed of each bucket.  This
+        should be run periodically; it returns the number of items deleted.
+        """
+        qargs = {"now": int(time.time()), "limit": self.expiry_batch_size}
+        expired_query = "SELECT i.bucket, i.key, i.value, i.expires,"\
+                        "       k.appid, k.userid"\
+                        " FROM items i, buckets k"\
+                        " WHERE i.bucket = k.bucket AND i.expires <= :now"\
+                        " ORDER BY i.expires LIMIT :limit"
+        # Items that were rewritten in the meantime will have a new expiry
+        # time, and so are left alone.
+        del_query = "DELETE FROM items WHERE bucket = :bucket"\
+                    " AND key = :key AND expires = :expires"
+        count = 0
+        while True:
+            rows = self._read(expired_query, **qargs).fetchall()
+            if not rows:
+                break
+            deleted = []
+            connection = self._engine.connect()
+            trn = connection.begin()
+            try:
+                stats = {}
+                for bucket, key, value, expires, appid, userid in rows:
+                    res = connection.execute(del_query, bucket=bucket,
+                                             key=key, expires=expires)
+                    if res.rowcount == 0:
+                        continue
+                    deleted.append((bucket, key, appid, userid))
+                    counts = stats.setdefault(bucket, [0, 0])
+                    counts[0] += 1
+                    counts[1] += _size(key) + _size(value)
+                # Reserve a block of sequence numbers for each bucket, and
+                # hand them out to its tombstones in order.
+                next_seq = {}
+                for bucket, (num_items, num_bytes) in stats.iteritems():
+                    last_seq = self._update_stats(connection, bucket,
+                                                  -num_items, -num_bytes,
+                                                  num_items)
+                    next_seq[bucket] = last_seq - num_items + 1
+                for bucket, key, appid, userid in deleted:
+                    self._record_change(connection, bucket, key,
+                                        next_seq[bucket], deleted=True)
+                    next_seq[bucket] += 1
+                trn.commit()
+            except:
+                trn.rollback()
+                raise
+            finally:
+                connection.close()
+            for bucket, key, appid, userid in deleted:
+                self.notifier.notify(_to_bytes(userid), _to_bytes(appid),
+                                     _to_bytes(key))
+            count += len(deleted)
+            if len(rows) < self.expiry_batch_size:
+                break
+        return count
+
     def listkeys(self, appid, userid, start=None, end=None, limit=None):
         """List the keys available in the store."""
-        qargs = {"appid": appid, "userid": userid,
+        qargs = {"appid": appid, "userid": userid, "now": int(time.time()),
                  "start": start, "end": end, "limit": limit}
         list_query = "SELECT i.key FROM items i, buckets k"\
                      " WHERE i.bucket = k.bucket"\
-                     " AND k.appid = :appid AND k.userid = :userid"
+                     " AND k.appid = :appid AND k.userid = :userid"\
+                     " AND (i.expires IS NULL OR i.expires > :now)"
         if start is not None:
             list_query += " AND i.key >= :start"
         if end is not None:
@@ -206,8 +833,196 @@ class SQLBackend(object):
         list_query += " ORDER BY i.key ASC"
         if limit is not None:
             list_query += " LIMIT :limit"
-        for row in self.execute(list_query, **qargs):
+        for row in self._read(list_query, **qargs):
             if isinstance(row[0], unicode):
                 yield row[0].encode("utf8")
             else:
                 yield row[0]
+
+    def dump(self, appid=None, userid=None):
+        """Iterate over all the items stored in the backend.
+
+        Items are read in (bucket, key) order, one batch at a time.  Each
+        batch resumes from the last row of the previous one rather than using
+        an OFFSET, so every query is a cheap range scan on the primary key.
+        """
+        qargs = {"appid": appid, "userid": userid,
+                 "limit": self.batch_size}
+        dump_query = "SELECT k.appid, k.userid, i.key, i.value, i.bucket,"\
+                     "       i.expires"\
+                     " FROM items i, buckets k"\
+                     " WHERE i.bucket = k.bucket"
+        if appid is not None:
+            dump_query += " AND k.appid = :appid"
+        if userid is not None:
+            dump_query += " AND k.userid = :userid"
+        dump_query += " AND (i.bucket > :last_bucket"\
+                      "      OR (i.bucket = :last_bucket"\
+                      "          AND i.key > :last_key))"\
+                      " ORDER BY i.bucket ASC, i.key ASC"\
+                      " LIMIT :limit"
+        qargs["last_bucket"] = 0
+        qargs["last_key"] = ""
+        while True:
+            rows = self._read(dump_query, **qargs).fetchall()
+            now = time.time()
+            for row in rows:
+                if not _has_expired(row[5], now):
+                    yield tuple(_to_bytes(v) for v in row[:4])
+            if len(rows) < self.batch_size:
+                break
+            qargs["last_bucket"] = rows[-1][4]
+            qargs["last_key"] = rows[-1][2]
+
+    def load(self, records):
+        """Load items into the backend in bulk.
+
+        Items are inserted batch_size at a time with a single executemany
+        call inside a transaction.  If a batch collides with existing keys
+        then it is retried one item at a time, overwriting the old values.
+        Usage counters and change feeds are kept up to date, but quotas are
+        not enforced.
+        """
+        count = 0
+        bucket_ids = {}
+        batch = []
+        touched = set()
+        for appid, userid, key, value in records:
+            try:
+                bucket = bucket_ids[(appid, userid)]
+            except KeyError:
+                # Keep the cache bounded for stores with many buckets.
+                if len(bucket_ids) >= self.batch_size:
+                    bucket_ids.clear()
+                bucket = self._getbucket(appid, userid)
+                bucket_ids[(appid, userid)] = bucket
+            batch.append({"bucket": bucket, "key": key, "value": value})
+            touched.add((appid, userid))
+            if len(batch) >= self.batch_size:
+                self._load_batch(batch)
+                count += len(batch)
+                batch = []
+                for appid, userid in touched:
+                    self.notifier.notify(userid, appid)
+                touched.clear()
+        if batch:
+            self._load_batch(batch)
+            count += len(batch)
+            for appid, userid in touched:
+                self.notifier.notify(userid, appid)
+        return count
+
+    def _load_batch(self, batch):
+        """Insert a batch of item rows, overwriting any existing values."""
+        ins_query = "INSERT INTO items (bucket, key, value)"\
+                    " VALUES (:bucket, :key, :value)"
+        set_query = "UPDATE items SET value = :value, expires = NULL"\
+                    " WHERE bucket = :bucket AND key = :key"
+        get_query = "SELECT value FROM items"\
+                    " WHERE bucket = :bucket AND key = :key"
+        change_query = "INSERT INTO changes"\
+                       " VALUES (:bucket, :key, :seq, 0, :modified)"
+        connection = self._engine.connect()
+        try:
+            trn = connection.begin()
+            try:
+                connection.execute(ins_query, batch)
+                stats = {}
+                for qargs in batch:
+                    num_bytes = _size(qargs["key"]) + _size(qargs["value"])
+                    counts = stats.setdefault(qargs["bucket"], [0, 0])
+                    counts[0] += 1
+                    counts[1] += num_bytes
+                # Reserve a block of sequence numbers for each bucket, and
+                # hand them out to its items in order.
+                next_seq = {}
+                for bucket, (num_items, num_bytes) in stats.iteritems():
+                    last_seq = self._update_stats(connection, bucket,
+                                                  num_items, num_bytes,
+                                                  num_items)
+                    next_seq[bucket] = last_seq - num_items + 1
+                modified = int(time.time())
+                change_rows = []
+                for qargs in batch:
+                    seq = next_seq[qargs["bucket"]]
+                    next_seq[qargs["bucket"]] += 1
+                    change_rows.append({"bucket": qargs["bucket"],
+                                        "key": qargs["key"], "seq": seq,
+                                        "modified": modified})
+                # This fails if any key has a tombstone, just like a collision.
+                connection.execute(change_query, change_rows)
+            except IntegrityError:
+                trn.rollback()
+            except:
+                trn.rollback()
+                raise
+            else:
+                trn.commit()
+                return
+            trn = connection.begin()
+            try:
+                for qargs in batch:
+                    row = connection.execute(get_query, **qargs).fetchone()
+                    if row is None:
+                        connection.execute(ins_query, **qargs)
+                        num_items = 1
+                        num_bytes = _size(qargs["key"]) + _size(qargs["value"])
+                    else:
+                        connection.execute(set_query, **qargs)
+                        num_items = 0
+                        num_bytes = _size(qargs["value"]) - _size(row[0])
+                    seq = self._update_stats(connection, qargs["bucket"],
+                                             num_items, num_bytes)
+                    self._record_change(connection, qargs["bucket"],
+                                        qargs["key"], seq)
+                trn.commit()
+            except:
+                trn.rollback()
+                raise
+        finally:
+            connection.close()
+
+
+def _size(value):
+    """Get the size in bytes of a string value, as it will be stored."""
+    if isinstance(value, unicode):
+        return len(value.encode("utf8"))
+    return len(value)
+
+
+def _has_expired(expires, now):
+    """Check whether an item with the given expiry time has expired."""
+    return expires is not None and expires <= now
+
+
+def _param_shape(parameters, executemany=False):
+    """Describe the types of a query's bind parameters, for logging."""
+    if executemany:
+        if not parameters:
+            return "[]"
+        return "%d x %s" % (len(parameters), _param_shape(parameters[0]))
+    if isinstance(parameters, dict):
+        return "{%s}" % (", ".join("%s: %s" % (k, type(v).__name__)
+                                   for (k, v) in sorted(parameters.items())),)
+    return "(%s)" % (", ".join(type(v).__name__ for v in parameters),)
+
+
+def _asbool(value):
+    """Interpret a boolean option, which may be given as a string."""
+    if isinstance(value, basestring):
+        return value.strip().lower() in ("true", "yes", "on", "1")
+    return bool(value)
+
+
+def _return_bytestrings(dbapi_connection, connection_record):
+    """Engine "connect" hook making sqlite3 return TEXT as bytestrings."""
+    dbapi_connection.text_factory = str
+
+
+def _to_bytes(value):
+    """Convert a value read from the database into a bytestring."""
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    if isinstance(value, buffer):
+        return str(value)
+    return value
@@ -0,0 +1,205 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Offline benchmarks for the hot paths of pysauropod.
+
+Unlike the FunkLoad tests in the top-level "loadtest" directory, these
+benchmarks need no running server.  They time the import of the main
+modules and the handling of Item objects, and exercise the SQL backend, the
+session manager and the complete pyramid app in-process, reporting the
+throughput and latency percentiles of each operation.
+
+Use it from the command-line like so:
+
+    sauropod-bench --output results.json
+    sauropod-bench --baseline results.json --tolerance 0.2
+
+Results are saved as JSON, and can be compared against a saved baseline
+to spot regressions; the exit status is non-zero if any benchmark got
+slower by more than the given tolerance.
+
+"""
+
+import sys
+import json
+import time
+import platform
+import optparse
+
+
+# Modules defining the benchmark suites, in the order they are run.
+# Each must provide a make_benchmarks() function returning a list of
+# Benchmark objects.
+SUITES = ["pysauropod.benchmarks.imports",
+          "pysauropod.benchmarks.items",
+          "pysauropod.benchmarks.backend",
+          "pysauropod.benchmarks.sessions",
+          "pysauropod.benchmarks.webapp"]
+
+
+class Benchmark(object):
+    """A named operation to be timed repeatedly.
+
+    The function "func" is called with the iteration number and timed.  If
+    given, "prepare" is called with the iteration number before each call
+    without being timed, and "teardown" is called once at the end.  The
+    first "warmup" calls are not timed either.  Any figures in the "info"
+    dict are reported along with the timings.
+    """
+
+    def __init__(self, name, func, prepare=None, teardown=None, warmup=10,
+                 info=None):
+        self.name = name
+        self.func = func
+        self.prepare = prepare
+        self.teardown = teardown
+        self.warmup = warmup
+        self.info = info or {}
+
+    def run(self, duration=1.0, min_iterations=10, warmup=None):
+        """Time the operation for about "duration" seconds.
+
+        Returns a dict giving the number of iterations, the throughput in
+        operations per second and the median and 99th percentile latencies
+        in milliseconds.
+        """
+        if warmup is None:
+            warmup = self.warmup
+        func = self.func
+        prepare = self.prepare
+        for i in xrange(warmup):
+            if prepare is not None:
+                prepare(i)
+            func(i)
+        timings = []
+        i = warmup
+        deadline = time.time() + duration
+        while len(timings) < min_iterations or time.time() < deadline:
+            if prepare is not None:
+                prepare(i)
+            start = time.time()
+            func(i)
+            timings.append(time.time() - start)
+            i += 1
+        result = summarize(timings)
+        result.update(self.info)
+        return result
+
+
+def summarize(timings):
+    """Summarize a list of per-operation timings, in seconds."""
+    timings = sorted(timings)
+    total = sum(timings)
+    return {"iterations": len(timings),
+            "ops_per_sec": len(timings) / total if total else 0.0,
+            "p50_ms": percentile(timings, 50) * 1000,
+            "p99_ms": percentile(timings, 99) * 1000}
+
+
+def percentile(sorted_values, pct):
+    """Get the given percentile of a sorted list, by nearest rank."""
+    if not sorted_values:
+        return 0.0
+    rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[rank]
+
+
+def load_benchmarks(suites=SUITES):
+    """Load the benchmarks from each suite module.
+
+    Suites whose dependencies aren't installed are skipped with a warning.
+    """
+    benchmarks = []
+    for suite in suites:
+        try:
+            module = __import__(suite, fromlist=["make_benchmarks"])
+        except ImportError, e:
+            sys.stderr.write("skipping %s: %s\n" % (suite, e))
+            continue
+        benchmarks.extend(module.make_benchmarks())
+    return benchmarks
+
+
+def run_benchmarks(benchmarks, duration=1.0, pattern=None, stream=None):
+    """Run the given benchmarks, returning a dict of results by name."""
+    results = {}
+    try:
+        for benchmark in benchmarks:
+            if pattern is not None and pattern not in benchmark.name:
+                continue
+            result = benchmark.run(duration)
+            results[benchmark.name] = result
+            if stream is not None:
+                stream.write("%-40s %10.1f ops/s  p50 %8.3f ms  "
+                             "p99 %8.3f ms" % (benchmark.name,
+                                               result["ops_per_sec"],
+                                               result["p50_ms"],
+                                               result["p99_ms"]))
+                for name, value in sorted(benchmark.info.iteritems()):
+                    stream.write("  %s %s" % (name, value))
+                stream.write("\n")
+                stream.flush()
+    finally:
+        for benchmark in benchmarks:
+            if benchmark.teardown is not None:
+                benchmark.teardown()
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.1):
+    """Compare results against a baseline, returning a list of regressions.
+
+    A benchmark has regressed if its throughput has dropped by more than
+    the given fraction.  Each regression is a (name, old_ops, new_ops)
+    tuple.  Benchmarks missing from either set of results are ignored.
+    """
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old_ops = baseline[name]["ops_per_sec"]
+        new_ops = results[name]["ops_per_sec"]
+        if new_ops < old_ops * (1 - tolerance):
+            regressions.append((name, old_ops, new_ops))
+    return regressions
+
+
+def main(argv=None):
+    """Command-line entry point for running the benchmarks."""
+    usage = "usage: %prog [options]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--duration", type="float", default=1.0,
+                      help="seconds to spend timing each benchmark")
+    parser.add_option("--filter", default=None,
+                      help="only run benchmarks whose name contains this")
+    parser.add_option("--output", default=None,
+                      help="file in which to save the results as JSON")
+    parser.add_option("--baseline", default=None,
+                      help="JSON results file to compare against")
+    parser.add_option("--tolerance", type="float", default=0.1,
+                      help="fractional slowdown allowed before failing")
+    opts, args = parser.parse_args(argv)
+    if args:
+        parser.error("unexpected arguments")
+    benchmarks = load_benchmarks()
+    results = run_benchmarks(benchmarks, opts.duration, opts.filter,
+                             sys.stdout)
+    if opts.output is not None:
+        data = {"python": platform.python_version(),
+                "platform": platform.platform(),
+                "timestamp": int(time.time()),
+                "results": results}
+        with open(opts.output, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+    if opts.baseline is not None:
+        with open(opts.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare_results(results, baseline, opts.tolerance)
+        for name, old_ops, new_ops in regressions:
+            print "REGRESSION %s: %.1f ops/s => %.1f ops/s" % (name, old_ops,
+                                                               new_ops)
+        if regressions:
+            return 1
+    return 0
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmarks for SQLBackend operations on SQLite.
+
+"""
+
+import os
+import shutil
+import tempfile
+
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.benchmarks import Benchmark
+
+
+APPID = "BENCH"
+USERID = "bench@example.com"
+# New keys go in a separate bucket, so the one being listed doesn't grow.
+SCRATCH_USERID = "scratch@example.com"
+NUM_KEYS = 100
+
+
+def make_benchmarks():
+    """Make get/set/delete/listkeys benchmarks for each flavour of SQLite."""
+    benchmarks = []
+    tempdir = tempfile.mkdtemp()
+    sqluris = [("memory", "sqlite:///:memory:"),
+               ("file", "sqlite:///" + os.path.join(tempdir, "bench.db"))]
+    backends = []
+    for label, sqluri in sqluris:
+        backend = SQLBackend(sqluri, create_tables=True)
+        backends.append(backend)
+        benchmarks.extend(_backend_benchmarks("sql.%s" % (label,), backend))
+
+    def teardown():
+        while backends:
+            backends.pop().close()
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    benchmarks[-1].teardown = teardown
+    return benchmarks
+
+
+def _backend_benchmarks(prefix, backend):
+    keys = ["key%d" % (i,) for i in xrange(NUM_KEYS)]
+    value = "X" * 256
+    for key in keys:
+        backend.set(APPID, USERID, key, value)
+
+    def getitem(i):
+        backend.getitem(APPID, USERID, keys[i % NUM_KEYS])
+
+    def set_existing(i):
+        backend.set(APPID, USERID, keys[i % NUM_KEYS], value)
+
+    def set_new(i):
+        backend.set(APPID, SCRATCH_USERID, "new%d" % (i,), value)
+
+    def prepare_delete(i):
+        backend.set(APPID, SCRATCH_USERID, "del%d" % (i,), value)
+
+    def delete(i):
+        backend.delete(APPID, SCRATCH_USERID, "del%d" % (i,))
+
+    def listkeys(i):
+        list(backend.listkeys(APPID, USERID))
+
+    return [Benchmark(prefix + ".getitem", getitem),
+            Benchmark(prefix + ".set_existing", set_existing),
+            Benchmark(prefix + ".set_new", set_new),
+            Benchmark(prefix + ".delete", delete, prepare=prepare_delete),
+            Benchmark(prefix + ".listkeys", listkeys)]
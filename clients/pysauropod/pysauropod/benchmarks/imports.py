@@ -0,0 +1,50 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmarks for the time taken to import pysauropod's main modules.
+
+Each iteration imports the module in a fresh Python interpreter, so the
+timings include the startup of the interpreter itself.  The "import.python"
+benchmark gives the baseline cost of that.
+
+"""
+
+import sys
+import subprocess
+
+from pysauropod.benchmarks import Benchmark
+
+
+MODULES = ["pysauropod",
+           "pysauropod.backends.sql",
+           "pysauropod.server"]
+
+
+def python_command(code):
+    """Get the command to run some code in a fresh Python interpreter.
+
+    The interpreter is given the same sys.path as this one, with any .pth
+    files processed, so that it can import whatever we can import.
+    """
+    setup = "import site; map(site.addsitedir, %r)\n" % (sys.path,)
+    return [sys.executable, "-c", setup + code]
+
+
+def make_benchmarks():
+    """Make a benchmark for importing each of the main modules."""
+    benchmarks = [_import_benchmark("import.python", "pass")]
+    for module in MODULES:
+        benchmarks.append(_import_benchmark("import." + module,
+                                            "import " + module))
+    return benchmarks
+
+
+def _import_benchmark(name, code):
+    command = python_command(code)
+
+    def run_python(i):
+        subprocess.check_call(command)
+
+    return Benchmark(name, run_python, warmup=1)
@@ -0,0 +1,73 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmarks for allocating Item objects and rendering them as JSON.
+
+Items are compared against an equivalent class without __slots__, as Item
+used to be, to show the saving in time and memory for each item read.
+
+"""
+
+import sys
+import json
+
+from pysauropod.interfaces import Item
+from pysauropod.server.views import _item_to_json
+from pysauropod.benchmarks import Benchmark
+
+
+BATCH_SIZE = 1000
+
+
+class DictItem(object):
+    """Item as it was before it used __slots__, for comparison."""
+
+    def __init__(self, appid, userid, key, value, etag):
+        self.appid = appid
+        self.userid = userid
+        self.key = key
+        self.value = value
+        self.etag = etag
+
+
+def item_size(item):
+    """Get the number of bytes used by an item, excluding its attributes."""
+    size = sys.getsizeof(item)
+    if hasattr(item, "__dict__"):
+        size += sys.getsizeof(item.__dict__)
+    return size
+
+
+def make_benchmarks():
+    """Make benchmarks for creating a batch of items, and rendering one."""
+    args = ("BENCH", "bench@example.com", "key", "X" * 256, "0" * 32)
+    item = Item(*args, bucket=1)
+    dict_item = DictItem(*args)
+    # Backends used to attach the bucket id as an ad-hoc attribute.
+    dict_item.bucket = 1
+
+    def create_items(i):
+        for _ in xrange(BATCH_SIZE):
+            Item(*args, bucket=1)
+
+    def create_dict_items(i):
+        for _ in xrange(BATCH_SIZE):
+            DictItem(*args).bucket = 1
+
+    def item_to_json(i):
+        _item_to_json(item)
+
+    def item_to_json_via_dict(i):
+        json.dumps({"key": item.key, "value": item.value,
+                    "user": item.userid, "bucket": item.appid,
+                    "timestamp": 0})
+
+    return [Benchmark("items.create_%d" % (BATCH_SIZE,), create_items,
+                      info={"bytes_per_item": item_size(item)}),
+            Benchmark("items.create_%d_unslotted" % (BATCH_SIZE,),
+                      create_dict_items,
+                      info={"bytes_per_item": item_size(dict_item)}),
+            Benchmark("items.to_json", item_to_json),
+            Benchmark("items.to_json_via_dict", item_to_json_via_dict)]
@@ -0,0 +1,504 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Load generator for reproducing production traffic shapes against Sauropod.
+
+This module drives a configurable mix of reads, writes, deletes and listings
+against either a Sauropod server at an HTTP URL, or a Sauropod WSGI app run
+in-process.  Requests are issued from many threads, optionally spread over
+several processes, on behalf of a population of users whose keys are chosen
+with Zipfian popularity.  Throughput and latency percentiles are reported for
+each interval of the run, and for the run as a whole.
+
+Use it from the command-line like so:
+
+    sauropod-loadgen --threads 20 --duration 60 http://localhost:8080
+    sauropod-loadgen --processes 4 --mix read=80,write=15,list=5 wsgi:
+
+The target server must accept dummy BrowserID assertions, as the FunkLoad
+tests in the top-level "loadtest" directory also require.
+
+"""
+
+import os
+import sys
+import json
+import time
+import math
+import Queue
+import random
+import shutil
+import bisect
+import optparse
+import tempfile
+import threading
+import multiprocessing
+from urllib import quote as urlquote
+from urlparse import urljoin
+
+import vep
+
+from pysauropod.benchmarks import percentile
+
+
+OPERATIONS = ("read", "write", "delete", "list")
+
+DEFAULT_MIX = "read=70,write=20,delete=5,list=5"
+
+# Sessions time out after five minutes, so renew them a bit before that.
+SESSION_LIFETIME = 4 * 60
+
+
+class ZipfKeys(object):
+    """Callable to pick key numbers in [0, n) with Zipfian popularity.
+
+    Key number i is chosen with probability proportional to 1/(i+1)**s for
+    the given exponent s.  An exponent of zero gives uniform popularity.
+    """
+
+    def __init__(self, n, exponent=1.0):
+        weights = [1.0 / (i + 1) ** exponent for i in xrange(n)]
+        total = sum(weights)
+        self.cdf = []
+        cumulative = 0.0
+        for weight in weights:
+            cumulative += weight / total
+            self.cdf.append(cumulative)
+
+    def __call__(self, rng=random):
+        i = bisect.bisect_left(self.cdf, rng.random())
+        return min(i, len(self.cdf) - 1)
+
+
+def parse_sizes(spec):
+    """Parse a value-size distribution into a callable taking an RNG.
+
+    The supported distributions are "fixed:SIZE", "uniform:MIN:MAX" and
+    "lognormal:MEDIAN:SIGMA".
+    """
+    parts = spec.split(":")
+    try:
+        kind, args = parts[0], [float(arg) for arg in parts[1:]]
+        if kind == "fixed" and len(args) == 1:
+            size = int(args[0])
+            return lambda rng: size
+        if kind == "uniform" and len(args) == 2:
+            low, high = int(args[0]), int(args[1])
+            return lambda rng: rng.randint(low, high)
+        if kind == "lognormal" and len(args) == 2:
+            mu, sigma = math.log(args[0]), args[1]
+            return lambda rng: max(1, int(rng.lognormvariate(mu, sigma)))
+    except ValueError:
+        pass
+    raise ValueError("invalid size distribution: %r" % (spec,))
+
+
+def parse_mix(spec):
+    """Parse an operation mix like "read=70,write=30" into a dict of weights.
+
+    Weights are relative, so they needn't add up to any particular total.
+    """
+    mix = {}
+    try:
+        for item in spec.split(","):
+            op, weight = item.split("=")
+            op = op.strip()
+            if op not in OPERATIONS:
+                raise ValueError(op)
+            mix[op] = float(weight)
+    except ValueError:
+        raise ValueError("invalid operation mix: %r" % (spec,))
+    if sum(mix.values()) <= 0:
+        raise ValueError("invalid operation mix: %r" % (spec,))
+    return mix
+
+
+class Workload(object):
+    """Description of the traffic to generate.
+
+    Each operation acts on a bucket chosen uniformly from "num_users"
+    users, and reads, writes and deletes act on one of "num_keys" keys in
+    that bucket chosen with Zipfian popularity.  Writes have values whose
+    sizes are drawn from the given distribution, and the given fraction of
+    them are conditional on the last etag seen for the key.
+    """
+
+    def __init__(self, appid="LOADGEN", num_users=100, num_keys=100,
+                 zipf=1.0, sizes="fixed:256", mix=DEFAULT_MIX,
+                 conditional=0.0):
+        self.appid = appid
+        self.num_users = num_users
+        self.num_keys = num_keys
+        self.conditional = conditional
+        self.pick_key = ZipfKeys(num_keys, zipf)
+        self.pick_size = parse_sizes(sizes)
+        weights = parse_mix(mix)
+        total = sum(weights.values())
+        self._ops = []
+        cumulative = 0.0
+        for op in OPERATIONS:
+            if weights.get(op):
+                cumulative += weights[op] / total
+                self._ops.append((cumulative, op))
+
+    def pick_op(self, rng=random):
+        """Pick an (op, userid, key) triple for the next request."""
+        r = rng.random()
+        for cumulative, op in self._ops:
+            if r < cumulative:
+                break
+        userid = "user%d@example.com" % (rng.randrange(self.num_users),)
+        key = "key%d" % (self.pick_key(rng),)
+        return op, userid, key
+
+
+class HTTPTarget(object):
+    """Target that sends requests to a Sauropod server over HTTP."""
+
+    def __init__(self, url):
+        import requests
+        self.url = url
+        self._reqpool = requests.session()
+
+    def request(self, method, path, data="", headers=None):
+        """Make a request, returning the status code, headers and body."""
+        url = urljoin(self.url, path)
+        r = self._reqpool.request(method, url, None, data, headers or {})
+        return r.status_code, r.headers, r.content
+
+
+class WSGITarget(object):
+    """Target that calls a Sauropod WSGI app in-process, via WebTest."""
+
+    def __init__(self, app):
+        import webtest
+        self.app = webtest.TestApp(app)
+
+    def request(self, method, path, data="", headers=None):
+        """Make a request, returning the status code, headers and body."""
+        kwds = {"headers": headers or {}, "expect_errors": True}
+        if method == "GET":
+            r = self.app.get(path, **kwds)
+        elif method == "DELETE":
+            r = self.app.delete(path, **kwds)
+        elif method == "PUT":
+            r = self.app.put(path, data, **kwds)
+        else:
+            r = self.app.post(path, data, **kwds)
+        return r.status_int, r.headers, r.body
+
+
+def make_wsgi_app(sqluri):
+    """Make a Sauropod app for load testing, storing data at the given URI."""
+    from pysauropod.server import main
+    settings = {
+        "sauropod.storage.backend": "pysauropod.backends.sql:SQLBackend",
+        "sauropod.storage.sqluri": sqluri,
+        "sauropod.storage.create_tables": True,
+        "sauropod.credentials.verifier": "vep:DummyVerifier",
+        "sauropod.credentials.backend":
+            "pysauropod.server.credentials:BrowserIDCredentials",
+    }
+    return main({}, **settings)
+
+
+class Worker(object):
+    """Issue a stream of requests against a target, recording latencies.
+
+    Each completed request appends an (op, latency, error) tuple to the
+    "samples" list, where error is None or a short description of what
+    went wrong.  Missing keys and etag conflicts are expected under load,
+    so they are not counted as errors.
+    """
+
+    def __init__(self, target, workload, rng=None):
+        self.target = target
+        self.workload = workload
+        self.rng = rng or random.Random()
+        self.samples = []
+        self._sessions = {}
+        self._etags = {}
+
+    def run(self, deadline):
+        """Issue requests until the deadline passes."""
+        while time.time() < deadline:
+            op, userid, key = self.workload.pick_op(self.rng)
+            start = time.time()
+            try:
+                error = getattr(self, "do_" + op)(userid, key)
+            except Exception, e:
+                error = type(e).__name__
+            self.samples.append((op, time.time() - start, error))
+
+    def _request(self, userid, method, path, data="", headers=None):
+        headers = dict(headers or {})
+        session = self._sessions.get(userid)
+        if session is None or session[1] < time.time():
+            session = (self._start_session(userid),
+                       time.time() + SESSION_LIFETIME)
+            self._sessions[userid] = session
+        headers["Signature"] = session[0]
+        return self.target.request(method, path, data, headers)
+
+    def _start_session(self, userid):
+        appid = self.workload.appid
+        assertion = vep.DummyVerifier.make_assertion(userid, appid)
+        data = {"audience": appid, "assertion": assertion}
+        status, _, body = self.target.request("POST", "/session/start", data)
+        if status != 200:
+            raise RuntimeError("failed to start session: %d" % (status,))
+        return body
+
+    def _keypath(self, userid, key=""):
+        path = "/app/%s/users/%s/keys/" % (urlquote(self.workload.appid),
+                                           urlquote(userid))
+        return path + urlquote(key, safe="")
+
+    def _check(self, status, allowed=()):
+        if 200 <= status < 300 or status in allowed:
+            return None
+        return "HTTP %d" % (status,)
+
+    def do_read(self, userid, key):
+        status, headers, _ = self._request(userid, "GET",
+                                           self._keypath(userid, key))
+        if status == 200:
+            self._etags[(userid, key)] = headers.get("ETag")
+        return self._check(status, (404,))
+
+    def do_write(self, userid, key):
+        value = "X" * self.workload.pick_size(self.rng)
+        headers = {}
+        if self.rng.random() < self.workload.conditional:
+            etag = self._etags.get((userid, key))
+            if etag is None:
+                headers["If-None-Match"] = "*"
+            else:
+                headers["If-Match"] = etag
+        status, headers, _ = self._request(userid, "PUT",
+                                           self._keypath(userid, key),
+                                           {"value": value}, headers)
+        if 200 <= status < 300:
+            self._etags[(userid, key)] = headers.get("ETag")
+        return self._check(status, (412,))
+
+    def do_delete(self, userid, key):
+        status, _, _ = self._request(userid, "DELETE",
+                                     self._keypath(userid, key))
+        self._etags.pop((userid, key), None)
+        return self._check(status, (404,))
+
+    def do_list(self, userid, key):
+        status, _, _ = self._request(userid, "GET", self._keypath(userid))
+        return self._check(status)
+
+
+def run_process(target_spec, workload, num_threads, duration, interval,
+                results, seed=None):
+    """Run worker threads against a target, reporting samples to a queue.
+
+    Every "interval" seconds the samples collected by all threads are put
+    on the results queue as an (interval number, samples) pair, and None
+    is put on the queue when the run is complete.
+    """
+    workers = []
+    threads = []
+    rng = random.Random(seed)
+    start = time.time()
+    deadline = start + duration
+    for _ in xrange(num_threads):
+        worker = Worker(make_target(target_spec), workload,
+                        random.Random(rng.random()))
+        workers.append(worker)
+        thread = threading.Thread(target=worker.run, args=(deadline,))
+        thread.daemon = True
+        threads.append(thread)
+        thread.start()
+    tick = 0
+    while any(thread.is_alive() for thread in threads):
+        tick += 1
+        time.sleep(max(0, start + tick * interval - time.time()))
+        samples = []
+        for worker in workers:
+            batch, worker.samples = worker.samples, []
+            samples.extend(batch)
+        results.put((tick, samples))
+    results.put(None)
+
+
+def make_target(target_spec):
+    """Make a target from its specification on the command-line.
+
+    HTTP URLs give an HTTPTarget.  Specs of the form "wsgi:SQLURI" give a
+    WSGITarget for an in-process app storing data at that SQLAlchemy URI.
+    """
+    if target_spec.startswith("wsgi:"):
+        return WSGITarget(make_wsgi_app(target_spec[len("wsgi:"):]))
+    return HTTPTarget(target_spec)
+
+
+class Reporter(object):
+    """Aggregate samples from all processes, and report on each interval."""
+
+    def __init__(self, num_processes, interval, stream=None):
+        self.num_processes = num_processes
+        self.interval = interval
+        self.stream = stream
+        self.intervals = []
+        self._pending = {}
+        self._totals = {}
+
+    def add(self, tick, samples):
+        """Add the samples for an interval from one of the processes."""
+        count, merged = self._pending.get(tick, (0, []))
+        merged.extend(samples)
+        for op, latency, error in samples:
+            self._totals.setdefault(op, []).append((latency, error))
+        if count + 1 < self.num_processes:
+            self._pending[tick] = (count + 1, merged)
+        else:
+            self._pending.pop(tick, None)
+            self._report(tick, merged)
+
+    def finish(self):
+        """Report any incomplete intervals, and return a summary dict."""
+        for tick in sorted(self._pending):
+            self._report(tick, self._pending[tick][1])
+        self._pending.clear()
+        elapsed = max(len(self.intervals), 1) * self.interval
+        summary = {}
+        for op, samples in sorted(self._totals.iteritems()):
+            summary[op] = _summarize([l for (l, _) in samples],
+                                     sum(1 for (_, e) in samples if e),
+                                     elapsed)
+        return {"intervals": self.intervals, "summary": summary}
+
+    def _report(self, tick, samples):
+        result = _summarize([l for (_, l, _) in samples],
+                            sum(1 for (_, _, e) in samples if e),
+                            self.interval)
+        result["time"] = tick * self.interval
+        self.intervals.append(result)
+        if self.stream is not None:
+            self.stream.write("%6.1fs %s\n" % (result["time"],
+                                               _format(result)))
+            self.stream.flush()
+
+
+def _summarize(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {"requests": len(latencies),
+            "errors": errors,
+            "ops_per_sec": len(latencies) / float(elapsed),
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000}
+
+
+def _format(result):
+    return "%7d reqs %9.1f ops/s  p50 %8.3f ms  p99 %8.3f ms  %d errors" % (
+           result["requests"], result["ops_per_sec"], result["p50_ms"],
+           result["p99_ms"], result["errors"])
+
+
+def run(target_spec, workload, num_processes=1, num_threads=10,
+        duration=30, interval=5, stream=None, seed=None):
+    """Run the load generator, returning a dict of results.
+
+    The results contain a list of per-interval summaries under "intervals",
+    and a summary for each type of operation under "summary".
+    """
+    if num_processes > 1:
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=run_process,
+                                           args=(target_spec, workload,
+                                                 num_threads, duration,
+                                                 interval, results,
+                                                 (seed, i)))
+                   for i in xrange(num_processes)]
+    else:
+        results = Queue.Queue()
+        workers = [threading.Thread(target=run_process,
+                                    args=(target_spec, workload,
+                                          num_threads, duration,
+                                          interval, results, seed))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    reporter = Reporter(num_processes, interval, stream)
+    num_running = num_processes
+    while num_running:
+        message = results.get()
+        if message is None:
+            num_running -= 1
+        else:
+            reporter.add(*message)
+    for worker in workers:
+        worker.join()
+    return reporter.finish()
+
+
+def main(argv=None):
+    """Command-line entry point for the load generator."""
+    usage = "usage: %prog [options] (URL|wsgi:[SQLURI])"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--processes", type="int", default=1,
+                      help="number of processes to run")
+    parser.add_option("--threads", type="int", default=10,
+                      help="number of threads to run in each process")
+    parser.add_option("--duration", type="float", default=30,
+                      help="number of seconds to run for")
+    parser.add_option("--interval", type="float", default=5,
+                      help="number of seconds between progress reports")
+    parser.add_option("--users", type="int", default=100,
+                      help="number of distinct users")
+    parser.add_option("--keys", type="int", default=100,
+                      help="number of distinct keys per user")
+    parser.add_option("--zipf", type="float", default=1.0,
+                      help="exponent of the Zipfian key popularity")
+    parser.add_option("--sizes", default="fixed:256",
+                      help="value sizes: fixed:N, uniform:MIN:MAX"
+                           " or lognormal:MEDIAN:SIGMA")
+    parser.add_option("--mix", default=DEFAULT_MIX,
+                      help="relative weights of read, write, delete, list")
+    parser.add_option("--conditional", type="float", default=0.0,
+                      help="fraction of writes that use If-Match")
+    parser.add_option("--appid", default="LOADGEN",
+                      help="appid under which to store data")
+    parser.add_option("--output", default=None,
+                      help="file in which to save the results as JSON")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error("invalid arguments")
+    target_spec = args[0]
+    try:
+        workload = Workload(opts.appid, opts.users, opts.keys, opts.zipf,
+                            opts.sizes, opts.mix, opts.conditional)
+    except ValueError, e:
+        parser.error(str(e))
+    tempdir = None
+    if target_spec == "wsgi:":
+        tempdir = tempfile.mkdtemp()
+        target_spec += "sqlite:///" + os.path.join(tempdir, "loadgen.db")
+    try:
+        if target_spec.startswith("wsgi:"):
+            # Create the tables once, before any processes are forked.
+            from pysauropod.backends.sql import SQLBackend
+            SQLBackend(target_spec[len("wsgi:"):], create_tables=True).close()
+        results = run(target_spec, workload, opts.processes, opts.threads,
+                      opts.duration, opts.interval, sys.stdout)
+    finally:
+        if tempdir is not None:
+            shutil.rmtree(tempdir, ignore_errors=True)
+    print
+    for op, result in sorted(results["summary"].iteritems()):
+        print "%-8s%s" % (op, _format(result))
+    if opts.output is not None:
+        with open(opts.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,30 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmarks for the server's session manager.
+
+"""
+
+from pysauropod.server.session import SignedSessionManager
+from pysauropod.benchmarks import Benchmark
+
+
+APPID = "https://bench.example.com"
+USERID = "bench@example.com"
+
+
+def make_benchmarks():
+    """Make benchmarks for creating and checking signed sessions."""
+    manager = SignedSessionManager(secret="BENCHMARK SECRET")
+    sessionid = manager.new_session(APPID, USERID)
+
+    def new_session(i):
+        manager.new_session(APPID, USERID)
+
+    def get_session_data(i):
+        manager.get_session_data(sessionid)
+
+    return [Benchmark("session.new_session", new_session),
+            Benchmark("session.get_session_data", get_session_data)]
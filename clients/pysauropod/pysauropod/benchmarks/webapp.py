@@ -0,0 +1,86 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Benchmarks for the complete pyramid app, driven in-process by WebTest.
+
+"""
+
+import os
+import shutil
+import tempfile
+from urllib import quote as urlquote
+
+import vep
+import webtest
+
+from pysauropod.server import main
+from pysauropod.benchmarks import Benchmark
+
+
+APPID = "BENCHAPP"
+USERID = "bench@example.com"
+SCRATCH_USERID = "scratch@example.com"
+NUM_KEYS = 100
+
+
+def make_benchmarks():
+    """Make benchmarks for each of the main views of the web API."""
+    tempdir = tempfile.mkdtemp()
+    settings = {
+        "sauropod.storage.backend": "pysauropod.backends.sql:SQLBackend",
+        "sauropod.storage.sqluri": "sqlite:///" + os.path.join(tempdir,
+                                                               "bench.db"),
+        "sauropod.storage.create_tables": True,
+        "sauropod.credentials.verifier": "vep:DummyVerifier",
+        "sauropod.credentials.backend":
+            "pysauropod.server.credentials:BrowserIDCredentials",
+    }
+    app = webtest.TestApp(main({}, **settings))
+
+    def start_session(userid):
+        assertion = vep.DummyVerifier.make_assertion(userid, APPID)
+        params = {"audience": APPID, "assertion": assertion}
+        sessionid = app.post("/session/start", params).body
+        return {"Signature": sessionid}
+
+    def bucketpath(userid):
+        return "/app/%s/users/%s" % (urlquote(APPID, safe=""),
+                                     urlquote(userid, safe=""))
+
+    headers = start_session(USERID)
+    scratch_headers = start_session(SCRATCH_USERID)
+    keypath = bucketpath(USERID) + "/keys/"
+    scratch_keypath = bucketpath(SCRATCH_USERID) + "/keys/"
+    keys = ["key%d" % (i,) for i in xrange(NUM_KEYS)]
+    value = {"value": "X" * 256}
+    for key in keys:
+        app.put(keypath + key, value, headers=headers)
+
+    def session_start(i):
+        start_session(USERID)
+
+    def get_key(i):
+        app.get(keypath + keys[i % NUM_KEYS], headers=headers)
+
+    def put_key(i):
+        app.put(keypath + keys[i % NUM_KEYS], value, headers=headers)
+
+    def prepare_delete(i):
+        app.put(scratch_keypath + str(i), value, headers=scratch_headers)
+
+    def delete_key(i):
+        app.delete(scratch_keypath + str(i), headers=scratch_headers)
+
+    def list_keys(i):
+        app.get(keypath, headers=headers)
+
+    def teardown():
+        shutil.rmtree(tempdir, ignore_errors=True)
+
+    return [Benchmark("web.session_start", session_start),
+            Benchmark("web.get_key", get_key),
+            Benchmark("web.put_key", put_key),
+            Benchmark("web.delete_key", delete_key, prepare=prepare_delete),
+            Benchmark("web.list_keys", list_keys, teardown=teardown)]
@@ -0,0 +1,188 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Bulk export and import of Sauropod data.
+
+This module defines a compact streaming dump format for Sauropod data, and
+a command-line tool for dumping a store to a file and loading it back.
+
+The dump format is a short header line followed by a sequence of records,
+one per item.  Each record is a fixed-size struct giving the lengths of the
+appid, userid, key and value, followed by the raw bytes of each in turn.
+Records can be read and written one at a time, so arbitrarily large stores
+can be processed in bounded memory.
+
+Use it from the command-line like so:
+
+    sauropod-dump export sqlite:////tmp/sauropod.db backup.dump
+    sauropod-dump import sqlite:////tmp/sauropod.db backup.dump
+
+"""
+
+import sys
+import time
+import struct
+import optparse
+
+from pysauropod.backends import load_backend
+
+
+DUMP_HEADER = "SAUROPOD-DUMP 1\n"
+
+RECORD_HEADER = struct.Struct(">HHHI")
+
+
+def write_dump(fileobj, records, progress=None):
+    """Write (appid, userid, key, value) records to a file in dump format.
+
+    If given, the progress callback will be called with the size of each
+    record after it is written.  The number of records is returned.
+    """
+    count = 0
+    fileobj.write(DUMP_HEADER)
+    for appid, userid, key, value in records:
+        header = RECORD_HEADER.pack(len(appid), len(userid),
+                                    len(key), len(value))
+        fileobj.write(header)
+        fileobj.write(appid)
+        fileobj.write(userid)
+        fileobj.write(key)
+        fileobj.write(value)
+        count += 1
+        if progress is not None:
+            progress(RECORD_HEADER.size + len(appid) + len(userid) +
+                     len(key) + len(value))
+    return count
+
+
+def read_dump(fileobj, progress=None):
+    """Iterate over the (appid, userid, key, value) records in a dump file.
+
+    If given, the progress callback will be called with the size of each
+    record after it is read.  ValueError is raised if the file is not a
+    valid dump, or if it ends part-way through a record.
+    """
+    if fileobj.read(len(DUMP_HEADER)) != DUMP_HEADER:
+        raise ValueError("not a sauropod dump file")
+    while True:
+        header = fileobj.read(RECORD_HEADER.size)
+        if not header:
+            break
+        if len(header) != RECORD_HEADER.size:
+            raise ValueError("truncated dump file")
+        sizes = RECORD_HEADER.unpack(header)
+        record = []
+        for size in sizes:
+            data = fileobj.read(size)
+            if len(data) != size:
+                raise ValueError("truncated dump file")
+            record.append(data)
+        if progress is not None:
+            progress(RECORD_HEADER.size + sum(sizes))
+        yield tuple(record)
+
+
+class ProgressReporter(object):
+    """Callable to periodically report progress of a dump or load.
+
+    Call an instance of this class with the size of each record processed,
+    and every "interval" seconds it will write a line reporting the number
+    of records and bytes processed and their rates.
+    """
+
+    def __init__(self, action, stream=None, interval=5):
+        if stream is None:
+            stream = sys.stderr
+        self.action = action
+        self.stream = stream
+        self.interval = interval
+        self.count = 0
+        self.size = 0
+        self.start_time = self.last_report = time.time()
+
+    def __call__(self, size):
+        self.count += 1
+        self.size += size
+        if self.count % 100 == 0:
+            now = time.time()
+            if now - self.last_report >= self.interval:
+                self.report(now)
+
+    def report(self, now=None):
+        if now is None:
+            now = time.time()
+        self.last_report = now
+        elapsed = max(now - self.start_time, 0.001)
+        msg = "%s %d items, %.1f MB (%.0f items/s, %.2f MB/s)\n"
+        mb = self.size / (1024.0 * 1024.0)
+        self.stream.write(msg % (self.action, self.count, mb,
+                                 self.count / elapsed, mb / elapsed))
+        self.stream.flush()
+
+
+def main(argv=None):
+    """Command-line entry point for dumping and loading a store."""
+    usage = "usage: %prog [options] (export|import) STORE_URL DUMP_FILE"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--appid", default=None,
+                      help="only export items belonging to this app")
+    parser.add_option("--userid", default=None,
+                      help="only export items belonging to this user")
+    parser.add_option("--batch-size", type="int", default=None,
+                      help="number of items to read or write per query")
+    parser.add_option("--create-tables", action="store_true", default=False,
+                      help="create the backend tables if they don't exist")
+    parser.add_option("--quiet", action="store_true", default=False,
+                      help="don't report progress while running")
+    opts, args = parser.parse_args(argv)
+    if len(args) != 3 or args[0] not in ("export", "import"):
+        parser.error("invalid arguments")
+    command, store_url, filename = args
+    backend = load_backend(store_url, create_tables=opts.create_tables)
+    if opts.batch_size is not None:
+        backend.batch_size = opts.batch_size
+    action = "exported" if command == "export" else "imported"
+    progress = None
+    if not opts.quiet:
+        progress = ProgressReporter(action)
+    try:
+        if command == "export":
+            records = backend.dump(opts.appid, opts.userid)
+            with _open(filename, "wb") as f:
+                write_dump(f, records, progress)
+        else:
+            with _open(filename, "rb") as f:
+                backend.load(read_dump(f, progress))
+        if progress is not None:
+            progress.report()
+    finally:
+        backend.close()
+    return 0
+
+
+def _open(filename, mode):
+    """Open the named file, treating "-" as stdin or stdout."""
+    if filename == "-":
+        if "w" in mode:
+            return _Unclosed(sys.stdout)
+        return _Unclosed(sys.stdin)
+    return open(filename, mode)
+
+
+class _Unclosed(object):
+    """Context manager to use a standard stream without closing it."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def __enter__(self):
+        return self.stream
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stream.flush()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
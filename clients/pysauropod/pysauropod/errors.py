@@ -33,6 +33,16 @@ class ConflictError(Error):
     pass
 
 
+class QuotaExceededError(Error):
+    """Error raised when a write would take a bucket over its quota."""
+    pass
+
+
+class ResyncRequiredError(Error):
+    """Error raised when a change feed can't be resumed from a position."""
+    pass
+
+
 class ConnectionError(Error):
     """Error raised when there is a problem connecting to the server."""
     pass
@@ -94,11 +94,12 @@ class ISauropodSession(Interface):
         (assuming, of course, that you have the appropriate permissions).
         """
 
-    def set(key, value, userid=None, appid=None, if_match=None):
+    def set(key, value, userid=None, appid=None, if_match=None, ttl=None):
         """Set the value stored under the specified key.
 
         This method takes the name of a key and a string value, and stores the
-        value under the specified key.
+        value under the specified key.  If "ttl" is given then the item will
+        expire after that many seconds, and will then read as missing.
 
         By default this accesses the bucket for the owning userid and appid.
         Use the optional arguments "userid" and/or "appid" to override this
@@ -116,6 +117,88 @@ class ISauropodSession(Interface):
         (assuming, of course, that you have the appropriate permissions).
         """
 
+    def batch():
+        """Start a batch of operations to be performed together.
+
+        This method returns a Batch object with get(), set() and delete()
+        methods taking the same arguments as those of the session.  Rather
+        than being performed immediately, the operations are queued up and
+        then sent to the store in a single request when the batch is
+        executed, which happens on leaving the batch's "with" block::
+
+            with session.batch() as b:
+                b.get("one")
+                b.set("two", "value")
+
+        The results are then available, in order, in the batch's "results"
+        list.  Each is the Item for a get() or set(), None for a delete(), or
+        the exception instance if that operation failed.
+        """
+
+    def getstats(userid=None, appid=None):
+        """Get the usage counters for a bucket.
+
+        This method returns a dict giving the number of "items" stored in
+        the bucket and the total number of "bytes" used by their keys and
+        values.
+
+        By default this accesses the bucket for the owning userid and appid.
+        Use the optional arguments "userid" and/or "appid" to override this
+        (assuming, of course, that you have the appropriate permissions).
+        """
+
+    def watch(key, etag=None, timeout=None, userid=None, appid=None):
+        """Wait for the item stored under the specified key to change.
+
+        This method blocks until the etag of the item stored under the key
+        differs from the given etag, and returns the new Item.  An etag of
+        None waits for the key to be created.  It raises KeyError if the
+        key is deleted, and returns None if nothing changes before the
+        timeout expires.
+
+        By default this accesses the bucket for the owning userid and appid.
+        Use the optional arguments "userid" and/or "appid" to override this
+        (assuming, of course, that you have the appropriate permissions).
+        """
+
+    def changes(since=0, limit=None, userid=None, appid=None, wait=0):
+        """Get the changes made to a bucket since a given sequence number.
+
+        This method returns a list of Change objects in sequence order, one
+        for each key that has been set or deleted since the sequence number
+        "since".  A client can keep a copy of the bucket in sync by applying
+        the changes and remembering the highest sequence number seen.  If
+        the changes since that point are no longer available, it raises
+        ResyncRequiredError and the client must start again from zero.
+
+        If there are no changes, this method waits up to "wait" seconds for
+        some to arrive before returning an empty list.
+
+        By default this accesses the bucket for the owning userid and appid.
+        Use the optional arguments "userid" and/or "appid" to override this
+        (assuming, of course, that you have the appropriate permissions).
+        """
+
+    def delete_bucket(userid=None, appid=None):
+        """Delete all the values stored in a bucket.
+
+        This method deletes every key in the bucket, e.g. when a user
+        removes their data from an application.
+
+        By default this accesses the bucket for the owning userid and appid.
+        Use the optional arguments "userid" and/or "appid" to override this
+        (assuming, of course, that you have the appropriate permissions).
+        """
+
+    def delete_user(userid=None):
+        """Delete all the values stored for a user, across all applications.
+
+        This method is intended for account removal.  It deletes every bucket
+        belonging to the user, and requires special permissions.
+
+        By default this deletes the data for the owning userid.
+        """
+
 
 class ISauropodBackend(Interface):
     """Interface to backend storage for Sauropod.
@@ -127,6 +210,9 @@ class ISauropodBackend(Interface):
     permission checking).
     """
 
+    notifier = Attribute("ChangeNotifier to be told about every write")
+    max_connections = Attribute("Most connections used at once, or None")
+
     def close():
         """Close down the backend.
 
@@ -143,11 +229,20 @@ class ISauropodBackend(Interface):
         metadata such as the etag.
         """
 
-    def set(appid, userid, key, value, if_match=None):
+    def getitems(appid, userid, keys):
+        """Get the items stored under several keys in a bucket at once.
+
+        This method returns a dict mapping each of the given keys to its
+        Item.  Keys with nothing stored under them are left out.
+        """
+
+    def set(appid, userid, key, value, if_match=None, ttl=None):
         """Set the value stored under the specified key.
 
         This method takes the name of a key and a string value, and stores the
-        value under the specified key.
+        value under the specified key.  If "ttl" is given then the item will
+        expire after that many seconds, and will then read as missing.
+        Backends that can't expire items may raise NotImplementedError.
         """
 
     def delete(appid, userid, key, if_match=None):
@@ -157,6 +252,57 @@ class ISauropodBackend(Interface):
         stored under that key.
         """
 
+    def delete_bucket(appid, userid):
+        """Delete all the values stored in the specified bucket.
+
+        This method deletes every key in the bucket without reading back the
+        values, and returns the number of items deleted.
+        """
+
+    def delete_user(userid):
+        """Delete all the values stored for a user, across all applications.
+
+        This method deletes every bucket belonging to the given userid, and
+        returns the number of items deleted.
+        """
+
+    def getstats(appid, userid):
+        """Get the usage counters for the specified bucket.
+
+        This method returns a dict giving the number of "items" stored in
+        the bucket and the total number of "bytes" used by their keys and
+        values.  Backends that don't track usage may raise
+        NotImplementedError.
+        """
+
+    def changes(appid, userid, since=0, limit=None):
+        """Get the changes made to a bucket since a given sequence number.
+
+        This method returns a list of at most "limit" Change objects in
+        sequence order, giving the current state of each key changed since
+        the sequence number "since".  It raises ResyncRequiredError if those
+        changes are no longer available.  Backends that don't keep a change
+        feed may raise NotImplementedError.
+        """
+
+    def dump(appid=None, userid=None):
+        """Iterate over all the items stored in the backend.
+
+        This method generates (appid, userid, key, value) tuples for every
+        item in the store, or only those in the given app and/or bucket.
+        Items are streamed from the backend in batches so that arbitrarily
+        large stores can be dumped in bounded memory.
+        """
+
+    def load(records):
+        """Load items into the backend in bulk.
+
+        This method takes an iterable of (appid, userid, key, value) tuples,
+        such as that produced by the dump() method, and stores them in
+        batches.  Any existing values for those keys will be overwritten.
+        It returns the number of items loaded.
+        """
+
 
 class Item(object):
     """Individual item stored in Sauropod.
@@ -169,12 +315,47 @@ class Item(object):
         * key:      the key under which this item is stored
         * value:    the value stored for this item
         * etag:     opaque etag to allow conflict detection
+        * bucket:   backend-specific id of the item's bucket, or None
+        * expires:  the time at which the item expires, or None if it
+                    was stored without a TTL or the backend doesn't say
 
+    Items are created for every read, so they use __slots__ to keep them
+    small and cheap to allocate.
     """
 
-    def __init__(self, appid, userid, key, value, etag):
+    __slots__ = ("appid", "userid", "key", "value", "etag", "bucket",
+                 "expires")
+
+    def __init__(self, appid, userid, key, value, etag, bucket=None,
+                 expires=None):
         self.appid = appid
         self.userid = userid
         self.key = key
         self.value = value
         self.etag = etag
+        self.bucket = bucket
+        self.expires = expires
+
+
+class Change(object):
+    """Individual change made to a bucket in Sauropod.
+
+    Instances of Change are produced by the change feed for a bucket.  Only
+    the latest change to each key is kept.  Interesting attributes are:
+
+        * seq:      the bucket's sequence number as of this change
+        * key:      the key that was changed
+        * item:     the Item now stored under the key, or None if deleted
+
+    """
+
+    __slots__ = ("seq", "key", "item")
+
+    def __init__(self, seq, key, item):
+        self.seq = seq
+        self.key = key
+        self.item = item
+
+    @property
+    def deleted(self):
+        return self.item is None
@@ -0,0 +1,133 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+In-process change notification for the Sauropod data store.
+
+This module lets code wait for changes to a key or bucket without polling
+the store.  Backends tell a ChangeNotifier about every write they make, and
+waiters block on a threading.Event until they are woken by a relevant write
+or their timeout expires.  No database connection is held while waiting.
+
+Notifications only reach waiters in the same process as the writer.  The
+watch functions always re-read the store after waking, so a spurious or
+missed wakeup can delay a result but never make it wrong.
+
+"""
+
+import time
+import threading
+import contextlib
+
+
+class ChangeNotifier(object):
+    """Registry of threads waiting for changes to keys or buckets.
+
+    Waiters are indexed by userid, and each records the appid and key that
+    it is interested in.  A key of None means any key in the bucket, and
+    an appid of None means any bucket belonging to the user.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._waiters = {}
+
+    @contextlib.contextmanager
+    def watching(self, userid, appid=None, key=None):
+        """Context manager yielding an Event that is set on each change."""
+        waiter = self.add_waiter(threading.Event(), userid, appid, key)
+        try:
+            yield waiter[2]
+        finally:
+            self.remove_waiter(waiter, userid)
+
+    def add_waiter(self, event, userid, appid=None, key=None):
+        """Register an object whose set() method is called on each change.
+
+        The set() method is called from the writing thread while holding
+        the notifier's lock, so it must be quick and must not write to the
+        store.  This returns a handle to pass to remove_waiter().
+        """
+        waiter = (appid, key, event)
+        with self._lock:
+            self._waiters.setdefault(userid, []).append(waiter)
+        return waiter
+
+    def remove_waiter(self, waiter, userid):
+        """Unregister a waiter previously returned by add_waiter()."""
+        with self._lock:
+            waiters = self._waiters[userid]
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[userid]
+
+    def notify(self, userid, appid=None, key=None):
+        """Wake any waiters interested in a change to the given key.
+
+        Passing None for the key signals a change to the whole bucket, and
+        passing None for the appid signals a change to all the user's data.
+        """
+        with self._lock:
+            for (w_appid, w_key, event) in self._waiters.get(userid, ()):
+                if appid is None or w_appid is None or w_appid == appid:
+                    if key is None or w_key is None or w_key == key:
+                        event.set()
+
+
+# Notifier shared by all backends in the process that don't supply their own.
+default_notifier = ChangeNotifier()
+
+
+def watch_key(backend, appid, userid, key, etag=None, timeout=None):
+    """Wait for the item stored under a key to change from the given etag.
+
+    An etag of None means the key is not expected to exist.  This returns
+    the new Item as soon as its etag differs, raises KeyError if the key is
+    deleted, or returns None if nothing has changed when the timeout expires.
+    """
+    def check():
+        try:
+            item = backend.getitem(appid, userid, key)
+        except KeyError:
+            if etag is not None:
+                raise
+            return None
+        if item.etag == etag:
+            return None
+        return item
+    return _watch(backend, userid, appid, key, check, timeout)
+
+
+def watch_changes(backend, appid, userid, since=0, limit=None, timeout=None):
+    """Wait for a bucket to change after the given sequence number.
+
+    This returns the bucket's changes since "since" as soon as there are
+    any, or an empty list if there are none when the timeout expires.
+    """
+    def check():
+        return backend.changes(appid, userid, since, limit) or None
+    return _watch(backend, userid, appid, None, check, timeout) or []
+
+
+def _watch(backend, userid, appid, key, check, timeout):
+    """Call check() until it returns a result, after each relevant change.
+
+    The event is cleared before each check, so a write that lands between
+    the check and the wait will still wake us up.
+    """
+    if timeout is not None:
+        deadline = time.time() + timeout
+    with backend.notifier.watching(userid, appid, key) as event:
+        while True:
+            event.clear()
+            result = check()
+            if result is not None:
+                return result
+            if timeout is None:
+                event.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                event.wait(remaining)
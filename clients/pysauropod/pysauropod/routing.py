@@ -0,0 +1,107 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Routing of client requests across several Sauropod servers.
+
+Each server, or group of servers behind a single URL, is a Node.  Buckets
+are assigned to nodes by a consistent-hash ring on their (appid, userid):
+every node is hashed onto the ring at many "virtual node" points, and a
+bucket belongs to the first node found clockwise from the bucket's own
+hash.  The next distinct nodes around the ring are its replicas, to be
+tried in turn if the owner can't be reached.  Adding or removing a node
+only moves the buckets on the arcs next to that node's points, about one
+bucket in every N for N nodes.
+
+"""
+
+import time
+import struct
+import bisect
+import hashlib
+
+
+# Points on the ring for each node.  More points give a more even spread of
+# buckets, at the cost of a bigger ring to search.
+DEFAULT_VNODES = 100
+
+# Seconds to avoid a node for after it fails, if it doesn't say otherwise.
+DEFAULT_RETRY_INTERVAL = 5
+
+
+def hash_key(key):
+    """Get the position on the ring of the given string."""
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    return struct.unpack(">Q", hashlib.md5(key).digest()[:8])[0]
+
+
+def bucket_key(appid, userid):
+    """Get the string that is hashed to route the given bucket."""
+    key = "%s\x00%s" % (appid, userid)
+    if isinstance(key, unicode):
+        key = key.encode("utf8")
+    return key
+
+
+class Node(object):
+    """A server that requests can be routed to, and its health.
+
+    Each node has its own "requests" session, and so its own pool of
+    keep-alive connections.  A node that fails is marked down for a while,
+    during which it is only tried if no healthy node is left.
+    """
+
+    def __init__(self, url, session):
+        self.url = url
+        self.session = session
+        self.failures = 0
+        self.down_until = 0
+
+    def __repr__(self):
+        return "<Node %s>" % (self.url,)
+
+    def is_available(self, now=None):
+        if now is None:
+            now = time.time()
+        return now >= self.down_until
+
+    def mark_down(self, delay):
+        self.failures += 1
+        self.down_until = time.time() + delay
+
+    def mark_up(self):
+        self.failures = 0
+        self.down_until = 0
+
+
+class HashRing(object):
+    """Consistent-hash ring mapping keys onto a list of nodes."""
+
+    def __init__(self, nodes, vnodes=DEFAULT_VNODES):
+        if not nodes:
+            raise ValueError("a hash ring needs at least one node")
+        points = []
+        for node in nodes:
+            for i in xrange(vnodes):
+                points.append((hash_key("%s#%d" % (node.url, i)), node.url))
+        points.sort()
+        nodes_by_url = dict((node.url, node) for node in nodes)
+        self.nodes = list(nodes)
+        self._hashes = [point[0] for point in points]
+        self._nodes = [nodes_by_url[point[1]] for point in points]
+
+    def get_nodes(self, key, count=1):
+        """Get up to "count" distinct nodes for a key, in preference order."""
+        count = min(count, len(self.nodes))
+        found = []
+        i = bisect.bisect(self._hashes, hash_key(key))
+        num_points = len(self._nodes)
+        for j in xrange(num_points):
+            node = self._nodes[(i + j) % num_points]
+            if node not in found:
+                found.append(node)
+                if len(found) == count:
+                    break
+        return found
@@ -10,9 +10,17 @@ which will expose an ISauropodBackend via a HTTP-based API.
 
 """
 
+from pyramid.settings import asbool
+
 from mozsvc import plugin
 from mozsvc.config import get_configurator
 
+from pysauropod.interfaces import ISauropodBackend
+from pysauropod.backends.coalesce import CoalescingBackend
+from pysauropod.server.metrics import IMetricsRegistry, InstrumentedBackend
+from pysauropod.server.profiler import make_profiler
+from pysauropod.server.sweeper import Sweeper
+
 
 def includeme(config):
     config.include("cornice")
@@ -20,6 +28,7 @@ def includeme(config):
     config.include("pysauropod.server.security")
     config.include("pysauropod.server.session")
     config.include("pysauropod.server.credentials")
+    config.include("pysauropod.server.metrics")
     config.scan("pysauropod.server.views")
     settings = config.get_settings()
     if "sauropod.storage.backend" not in settings:
@@ -28,13 +37,45 @@ def includeme(config):
         #settings["sauropod.storage.sqluri"] = "sqlite:///:memory:"
         settings["sauropod.storage.sqluri"] = "sqlite:////tmp/sauropod.db"
         settings["sauropod.storage.create_tables"] = True
-    plugin.load_and_register("sauropod.storage", config)
+        settings["sauropod.storage.sqlite_tuned"] = True
+    # Load the backend by hand, so that we can register it wrapped
+    # in an InstrumentedBackend to time each operation.
+    if "config" in settings:
+        backend = plugin.load_from_config("sauropod.storage",
+                                          settings["config"])
+    else:
+        backend = plugin.load_from_settings("sauropod.storage", settings)
+    metrics = config.registry.getUtility(IMetricsRegistry)
+    # Share concurrent reads of the same key, so hot keys don't cost
+    # one query for every client reading them.
+    if asbool(settings.get("sauropod.coalesce_reads", True)):
+        backend = CoalescingBackend(backend)
+        metrics.add_source("sauropod_backend_reads_total",
+                           "Reads of single keys from the backend, by"
+                           " whether they shared another's result.",
+                           backend.coalesce_stats.collect)
+    cache_stats = getattr(backend, "cache_stats", None)
+    if cache_stats is not None:
+        metrics.add_source("sauropod_cache_lookups_total",
+                           "Lookups in the backend cache, by result.",
+                           cache_stats.collect)
+    pool_stats = getattr(backend, "pool_stats", None)
+    if pool_stats is not None:
+        for source in pool_stats.metric_sources():
+            metrics.add_source(*source)
+    sweep_interval = settings.get("sauropod.sweeper.interval")
+    if sweep_interval:
+        Sweeper(backend, float(sweep_interval)).start()
+    backend = InstrumentedBackend(backend, metrics)
+    config.registry.registerUtility(backend, ISauropodBackend)
 
 
 def main(global_config={}, **settings):
     config = get_configurator(global_config, **settings)
     config.include(includeme)
-    return config.make_wsgi_app()
+    app = config.make_wsgi_app()
+    routes = config.get_routes_mapper().get_routes()
+    return make_profiler(app, config.get_settings(), routes)
 
 
 if __name__ == '__main__':
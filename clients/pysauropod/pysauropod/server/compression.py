@@ -0,0 +1,120 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Negotiated compression of response bodies for the Sauropod web API.
+
+Views whose responses may be large pass them through compress_response(),
+which gzip- or deflate-encodes the body according to the request's
+Accept-Encoding header.  Small bodies, and bodies that look like they are
+already compressed, are sent as-is.  A compressed response's ETag gets the
+encoding as a suffix, e.g. "<etag>-gzip", so that it differs from the ETag
+of the identity-encoded response; decode_etag() strips it off again from
+etags that clients send back.  The following settings apply:
+
+    * sauropod.compression.min_size:  smallest body to compress, in bytes
+    * sauropod.compression.level:     zlib compression level, from 1 to 9
+
+"""
+
+import zlib
+
+from webob.acceptparse import create_accept_encoding_header
+
+
+# Encodings that we can produce, in order of preference.
+ENCODINGS = ["gzip", "deflate"]
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+
+# Content types whose bodies are compressed already.
+COMPRESSED_TYPES = frozenset(["application/gzip", "application/x-gzip",
+                              "application/zip", "application/x-bzip2",
+                              "application/x-xz", "application/zstd"])
+COMPRESSED_TYPE_PREFIXES = ("image/", "video/", "audio/")
+
+# Leading bytes of common compressed formats, for spotting raw values that
+# are compressed already: gzip, zlib, zip, bzip2, xz, zstd, png and jpeg.
+COMPRESSED_MAGIC = ("\x1f\x8b", "\x78\x01", "\x78\x9c", "\x78\xda",
+                    "PK\x03\x04", "BZh", "\xfd7zXZ\x00", "\x28\xb5\x2f\xfd",
+                    "\x89PNG", "\xff\xd8\xff")
+
+
+def compress_response(request, response):
+    """Compress the body of a response, if the client will accept it.
+
+    The response is modified in place and returned.  It is left alone if
+    the body is small or appears to be compressed already, or if that
+    doesn't make it any smaller.
+    """
+    response.vary = tuple(response.vary or ()) + ("Accept-Encoding",)
+    if response.content_encoding:
+        return response
+    body, encoding = compress_body(response.body, response.content_type,
+                                   request.headers.get("Accept-Encoding"),
+                                   request.registry.settings)
+    if encoding is not None:
+        response.body = body
+        response.content_encoding = encoding
+        etag = response.headers.get("ETag")
+        if etag:
+            response.headers["ETag"] = encode_etag(etag, encoding)
+    return response
+
+
+def compress_body(body, content_type, accept_encoding, settings):
+    """Compress a response body as allowed by an Accept-Encoding header.
+
+    This returns a tuple (body, encoding), where the encoding is None if
+    the body was left uncompressed.
+    """
+    if accept_encoding is None:
+        return body, None
+    min_size = settings.get("sauropod.compression.min_size",
+                            DEFAULT_MIN_SIZE)
+    if len(body) < int(min_size):
+        return body, None
+    accept = create_accept_encoding_header(accept_encoding)
+    offers = accept.acceptable_offers(ENCODINGS)
+    if not offers:
+        return body, None
+    if is_compressed(content_type, body):
+        return body, None
+    encoding = offers[0][0]
+    level = int(settings.get("sauropod.compression.level", DEFAULT_LEVEL))
+    if encoding == "gzip":
+        compressor = zlib.compressobj(level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(level)
+    compressed = compressor.compress(body) + compressor.flush()
+    if len(compressed) >= len(body):
+        return body, None
+    return compressed, encoding
+
+
+def is_compressed(content_type, body):
+    """Guess whether a body is compressed already, from its type or data."""
+    if content_type in COMPRESSED_TYPES:
+        return True
+    if content_type and content_type.startswith(COMPRESSED_TYPE_PREFIXES):
+        return True
+    return body.startswith(COMPRESSED_MAGIC)
+
+
+def encode_etag(etag, encoding):
+    """Mark an etag as belonging to a body with the given content-encoding."""
+    return "%s-%s" % (etag, encoding)
+
+
+def decode_etag(etag):
+    """Strip any content-encoding suffix from an etag sent by a client."""
+    if etag is None:
+        return None
+    for encoding in ENCODINGS:
+        suffix = "-" + encoding
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)]
+    return etag
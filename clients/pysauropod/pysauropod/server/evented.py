@@ -0,0 +1,912 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Event-driven HTTP front end for the Sauropod web API.
+
+The pyramid app ties up a thread for the whole life of each request, so slow
+clients and long-poll watches limit the number of requests a server can have
+in progress.  This module serves the core of the same API from a single
+asyncore event loop instead:
+
+    * POST /session/start
+    * GET, DELETE /app/{appid}/users/{userid}/keys/
+    * GET, PUT, DELETE /app/{appid}/users/{userid}/keys/{key}
+
+Connections are parsed and kept alive by the event loop, so an idle
+connection costs only a socket and a small channel object.  Blocking calls
+to the backend and credentials manager run on a bounded pool of threads,
+and watches on a key wait for a ChangeNotifier wakeup without holding a
+thread at all.  The same pyramid configuration is used to load the backend,
+session manager, credentials manager and authorization policy, so all the
+usual settings apply.
+
+Use it from the command-line like so:
+
+    sauropod-evented-server --threads 10 prod.ini
+
+"""
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import heapq
+import Queue
+import select
+import socket
+import logging
+import asyncore
+import asynchat
+import optparse
+import threading
+import collections
+from urllib import quote as urlquote, unquote as urlunquote
+from urlparse import parse_qsl
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from webob.acceptparse import create_accept_header
+
+from pyramid.security import Everyone, Authenticated
+from pyramid.interfaces import IAuthorizationPolicy
+
+from pysauropod.errors import (ConflictError, QuotaExceededError,
+                               ServerBusyError)
+from pysauropod.interfaces import ISauropodBackend
+from pysauropod.server.session import ISessionManager
+from pysauropod.server.security import OperationContext
+from pysauropod.server.credentials import ICredentialsManager
+from pysauropod.server.compression import (compress_body, encode_etag,
+                                            decode_etag)
+from pysauropod.server.views import (ITEM_CONTENT_TYPES, _item_to_json,
+                                     _parse_ttl)
+
+
+logger = logging.getLogger("pysauropod.server.evented")
+
+# The key service here can send and receive raw values and set TTLs, but
+# there's no /batch URL, so that feature of the pyramid app isn't offered.
+FEATURES = ["raw-values", "ttl"]
+
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+
+
+def make_registry(config_file=None, settings=None):
+    """Load the Sauropod pyramid configuration, returning its registry.
+
+    The app itself is never served, but the registry holds the backend and
+    the other utilities that it would use.
+    """
+    from mozsvc.config import get_configurator, load_into_settings
+    from pysauropod.server import includeme
+    settings = dict(settings or {})
+    if config_file is not None:
+        load_into_settings(config_file, settings)
+    config = get_configurator({}, **settings)
+    config.include(includeme)
+    config.commit()
+    return config.registry
+
+
+class HTTPError(Exception):
+    """Exception raised by handlers to send an error response."""
+
+    def __init__(self, status, body=""):
+        Exception.__init__(self, status, body)
+        self.status = status
+        self.body = body
+
+
+class HTTPRequest(object):
+    """A parsed HTTP request.  Header names are stored in lowercase."""
+
+    __slots__ = ("method", "path", "query", "version", "headers", "body")
+
+    def __init__(self, method, path, query, version, headers, body=""):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.version = version
+        self.headers = headers
+        self.body = body
+
+    def keep_alive(self):
+        """Check whether the connection should be kept open afterwards."""
+        connection = self.headers.get("connection", "").lower()
+        if self.version == "HTTP/1.0":
+            return connection == "keep-alive"
+        return connection != "close"
+
+
+class HTTPResponse(object):
+    """An HTTP response to send to the client."""
+
+    __slots__ = ("status", "body", "headers")
+
+    def __init__(self, status=200, body="", content_type=None, headers=None):
+        self.status = status
+        self.body = body
+        self.headers = list(headers or ())
+        if content_type is not None:
+            self.headers.append(("Content-Type", content_type))
+
+    def format(self, keep_alive, version):
+        """Format the response for sending over the wire."""
+        reason = BaseHTTPRequestHandler.responses.get(self.status, ("",))[0]
+        lines = ["HTTP/1.1 %d %s" % (self.status, reason)]
+        for header in self.headers:
+            lines.append("%s: %s" % header)
+        lines.append("X-Sauropod-Features: " + " ".join(FEATURES))
+        lines.append("Content-Length: %d" % (len(self.body),))
+        if not keep_alive:
+            lines.append("Connection: close")
+        elif version == "HTTP/1.0":
+            lines.append("Connection: keep-alive")
+        lines.append("")
+        lines.append(self.body)
+        return "\r\n".join(lines)
+
+
+def busy_response():
+    """Make the response sent when too many requests are in progress."""
+    return HTTPResponse(503, headers=[("Retry-After", "1")])
+
+
+class Timer(object):
+    """Handle for a call scheduled with EventLoop.call_later()."""
+
+    __slots__ = ("deadline", "func", "args", "cancelled")
+
+    def __init__(self, deadline, func, args):
+        self.deadline = deadline
+        self.func = func
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class Waker(asyncore.file_dispatcher):
+    """Pipe used by other threads to interrupt the event loop."""
+
+    def __init__(self, map):
+        read_fd, self._write_fd = os.pipe()
+        flags = fcntl.fcntl(self._write_fd, fcntl.F_GETFL)
+        fcntl.fcntl(self._write_fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        asyncore.file_dispatcher.__init__(self, read_fd, map)
+        os.close(read_fd)
+
+    def wake(self):
+        try:
+            os.write(self._write_fd, "x")
+        except OSError, e:
+            # A full pipe means a wakeup is already pending.
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        self.recv(4096)
+
+    def close(self):
+        asyncore.file_dispatcher.close(self)
+        os.close(self._write_fd)
+
+
+class SocketMap(dict):
+    """asyncore socket map that tells its loop as dispatchers come and go."""
+
+    def __init__(self, loop):
+        dict.__init__(self)
+        self.loop = loop
+
+    def __setitem__(self, fd, dispatcher):
+        dict.__setitem__(self, fd, dispatcher)
+        self.loop.touch(dispatcher)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self.loop._forget(fd)
+
+
+class EventLoop(object):
+    """An asyncore socket map with timers and thread-safe callbacks.
+
+    Everything but call_soon_threadsafe() and stop() must be called from
+    the thread running the loop.
+
+    Where epoll is available, each socket stays registered with it between
+    iterations, and readable() and writable() are only re-checked for the
+    dispatchers that just handled an event or were passed to touch().  So
+    idle connections cost nothing per iteration, unlike asyncore.loop().
+    """
+
+    def __init__(self, poll_interval=1.0):
+        self.map = SocketMap(self)
+        self.poll_interval = poll_interval
+        self._epoll = select.epoll() if hasattr(select, "epoll") else None
+        self._registered = {}
+        self._touched = set()
+        self._timers = []
+        self._timer_count = 0
+        self._callbacks = collections.deque()
+        self._stopping = False
+        self._closed = False
+        self._waker = Waker(self.map)
+        self._waker_lock = threading.Lock()
+
+    def touch(self, dispatcher):
+        """Note that a dispatcher's readable() or writable() may change."""
+        self._touched.add(dispatcher._fileno)
+
+    def call_later(self, delay, func, *args):
+        """Call func(*args) after the given number of seconds."""
+        timer = Timer(time.time() + delay, func, args)
+        self._timer_count += 1
+        heapq.heappush(self._timers, (timer.deadline, self._timer_count,
+                                      timer))
+        return timer
+
+    def call_soon_threadsafe(self, func, *args):
+        """Call func(*args) in the loop thread, from any thread.
+
+        Calls made once the loop has been closed are dropped.
+        """
+        # The loop may run the callback, stop and close the waker before
+        # wake() is reached, and its fd may then be reused by the time it
+        # is written to.  So close() waits for any call in progress.
+        with self._waker_lock:
+            if self._closed:
+                return
+            self._callbacks.append((func, args))
+            self._waker.wake()
+
+    def run(self):
+        """Run the loop until stop() is called."""
+        self._stopping = False
+        while not self._stopping:
+            timeout = self.poll_interval
+            if self._callbacks:
+                timeout = 0
+            elif self._timers:
+                timeout = max(0, min(timeout,
+                                     self._timers[0][0] - time.time()))
+            self._poll(timeout)
+            self._run_callbacks()
+            self._run_timers()
+
+    def stop(self):
+        """Stop the loop, from any thread."""
+        self.call_soon_threadsafe(setattr, self, "_stopping", True)
+
+    def close(self):
+        """Close all the dispatchers in the loop."""
+        with self._waker_lock:
+            self._closed = True
+        asyncore.close_all(self.map)
+        if self._epoll is not None:
+            self._epoll.close()
+
+    def _poll(self, timeout):
+        if self._epoll is None:
+            self._touched.clear()
+            asyncore.loop(timeout, True, self.map, 1)
+            return
+        touched, self._touched = self._touched, set()
+        for fd in touched:
+            self._update(fd)
+        try:
+            events = self._epoll.poll(timeout)
+        except IOError, e:
+            if e.errno != errno.EINTR:
+                raise
+            events = ()
+        for fd, flags in events:
+            dispatcher = self.map.get(fd)
+            if dispatcher is not None:
+                asyncore.readwrite(dispatcher, flags)
+                self._touched.add(fd)
+
+    def _update(self, fd):
+        """Bring a dispatcher's epoll registration up to date."""
+        dispatcher = self.map.get(fd)
+        if dispatcher is None:
+            return
+        flags = 0
+        if dispatcher.readable():
+            flags |= select.EPOLLIN | select.EPOLLPRI
+        if dispatcher.writable() and not dispatcher.accepting:
+            flags |= select.EPOLLOUT
+        registered = self._registered.get(fd, 0)
+        if flags == registered:
+            return
+        # Unregister rather than waiting for nothing, since epoll would
+        # still report errors and hangups on every iteration.
+        if not flags:
+            self._forget(fd)
+        elif registered:
+            self._epoll.modify(fd, flags)
+            self._registered[fd] = flags
+        else:
+            self._epoll.register(fd, flags)
+            self._registered[fd] = flags
+
+    def _forget(self, fd):
+        self._touched.discard(fd)
+        if self._registered.pop(fd, None) is not None:
+            self._epoll.unregister(fd)
+
+    def _run_callbacks(self):
+        # Only run the callbacks that are already queued, so that a busy
+        # producer can't starve the sockets.
+        for _ in xrange(len(self._callbacks)):
+            func, args = self._callbacks.popleft()
+            self._call(func, args)
+
+    def _run_timers(self):
+        now = time.time()
+        while self._timers and self._timers[0][0] <= now:
+            timer = heapq.heappop(self._timers)[2]
+            if not timer.cancelled:
+                self._call(timer.func, timer.args)
+
+    def _call(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            logger.exception("error in event loop callback")
+
+
+class Executor(object):
+    """Bounded pool of threads for running blocking calls off the loop.
+
+    Each call's result is passed back to a callback in the loop thread.
+    """
+
+    def __init__(self, loop, num_threads=10, max_pending=1000):
+        self.loop = loop
+        self.max_pending = max_pending
+        self._queue = Queue.Queue()
+        self._threads = []
+        for _ in xrange(num_threads):
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, callback, func, *args):
+        """Call func(*args) in a worker thread, then callback(result).
+
+        This returns False without doing anything if there are already too
+        many calls waiting for a thread.
+        """
+        if self._queue.qsize() >= self.max_pending:
+            return False
+        self._queue.put((callback, func, args))
+        return True
+
+    def shutdown(self):
+        """Stop the worker threads once they finish any pending calls."""
+        for _ in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _run(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            callback, func, args = task
+            result = func(*args)
+            self.loop.call_soon_threadsafe(callback, result)
+
+
+class HTTPChannel(asynchat.async_chat):
+    """A client connection, parsing requests and sending responses.
+
+    Requests are handled one at a time, in the order received, and nothing
+    more is read from the client while one is in progress.
+    """
+
+    def __init__(self, server, sock):
+        asynchat.async_chat.__init__(self, sock, server.loop.map)
+        self.server = server
+        self.busy = False
+        self.closing = False
+        self.last_activity = time.time()
+        self._pending = collections.deque()
+        self._incoming = []
+        self._incoming_size = 0
+        self._request = None
+        self.set_terminator("\r\n\r\n")
+
+    def readable(self):
+        return not self.busy and not self.closing
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        self._incoming.append(data)
+        self._incoming_size += len(data)
+        if self._request is None and self._incoming_size > MAX_HEADER_SIZE:
+            self._fail(431)
+
+    def found_terminator(self):
+        data = "".join(self._incoming)
+        self._incoming = []
+        self._incoming_size = 0
+        if self.closing:
+            return
+        if self._request is not None:
+            # That was the body of the current request.
+            self._request.body = data
+            self._queue_request(self._request)
+            self._request = None
+            self.set_terminator("\r\n\r\n")
+            return
+        data = data.lstrip("\r\n")
+        if not data:
+            return
+        try:
+            request = self._parse_headers(data)
+        except ValueError:
+            self._fail(400)
+            return
+        if "transfer-encoding" in request.headers:
+            self._fail(411)
+            return
+        try:
+            length = int(request.headers.get("content-length", 0))
+        except ValueError:
+            self._fail(400)
+            return
+        if length > MAX_BODY_SIZE:
+            self._fail(413)
+        elif length > 0:
+            self._request = request
+            self.set_terminator(length)
+        else:
+            self._queue_request(request)
+
+    def respond(self, request, response):
+        """Send the response to a request, then move on to the next one."""
+        if not self.connected or self.closing:
+            return
+        self.last_activity = time.time()
+        self.server.loop.touch(self)
+        keep_alive = request.keep_alive()
+        self.push(response.format(keep_alive, request.version))
+        if not keep_alive:
+            self.closing = True
+            self._pending.clear()
+            self.close_when_done()
+        else:
+            self.busy = False
+            self._next_request()
+
+    def handle_error(self):
+        logger.exception("error on connection")
+        self.close()
+
+    def _parse_headers(self, data):
+        lines = data.split("\r\n")
+        method, target, version = lines[0].split(" ")
+        if not version.startswith("HTTP/"):
+            raise ValueError("not a HTTP request")
+        headers = {}
+        for line in lines[1:]:
+            name, value = line.split(":", 1)
+            headers[name.strip().lower()] = value.strip()
+        path, _, query = target.partition("?")
+        query = dict(parse_qsl(query))
+        return HTTPRequest(method, path, query, version, headers)
+
+    def _queue_request(self, request):
+        self._pending.append(request)
+        self._next_request()
+
+    def _next_request(self):
+        if not self.busy and self._pending:
+            self.busy = True
+            self.server.dispatch(self, self._pending.popleft())
+
+    def _fail(self, status):
+        request = HTTPRequest("GET", "", {}, "HTTP/1.1",
+                              {"connection": "close"})
+        self.busy = False
+        self.respond(request, HTTPResponse(status))
+
+
+class EventedServer(asyncore.dispatcher):
+    """HTTP server running the Sauropod web API on an event loop.
+
+    The listening socket is bound when the server is created, so that any
+    port number chosen by the OS is known before serve_forever() is called.
+    Connections that stay idle for longer than keepalive_timeout seconds
+    are closed.
+    """
+
+    def __init__(self, registry, host="0.0.0.0", port=8080, num_threads=10,
+                 max_pending=1000, keepalive_timeout=75, backlog=1024):
+        self.loop = EventLoop()
+        asyncore.dispatcher.__init__(self, map=self.loop.map)
+        self.registry = registry
+        self.settings = registry.settings
+        self.backend = registry.getUtility(ISauropodBackend)
+        self.sessions = registry.getUtility(ISessionManager)
+        self.credentials = registry.getUtility(ICredentialsManager)
+        self.policy = registry.getUtility(IAuthorizationPolicy)
+        self.executor = Executor(self.loop, num_threads, max_pending)
+        self.keepalive_timeout = keepalive_timeout
+        self.accept_batch = 100
+        self._accept_paused = False
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+        self.address = self.socket.getsockname()
+
+    def serve_forever(self):
+        """Run the event loop until stop() is called."""
+        self.loop.call_later(self.keepalive_timeout / 2.0,
+                             self._close_idle_channels)
+        try:
+            self.loop.run()
+        finally:
+            self.loop.close()
+            self.executor.shutdown()
+
+    def stop(self):
+        """Stop serving requests, from any thread."""
+        self.loop.stop()
+
+    def handle_accept(self):
+        # Accept a batch of connections at once, rather than going round
+        # the loop for each of them.
+        for _ in xrange(self.accept_batch):
+            try:
+                pair = self.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    # Back off for a while, rather than spinning on a socket
+                    # that stays readable until we can accept from it.
+                    logger.error("too many open files; not accepting")
+                    self._accept_paused = True
+                    self.loop.call_later(1.0, self._resume_accepting)
+                    return
+                raise
+            if pair is None:
+                return
+            HTTPChannel(self, pair[0])
+
+    def readable(self):
+        return not self._accept_paused
+
+    def _resume_accepting(self):
+        self._accept_paused = False
+        self.loop.touch(self)
+
+    def dispatch(self, channel, request):
+        """Route a request to the matching handler."""
+        try:
+            self._dispatch(channel, request)
+        except HTTPError, e:
+            channel.respond(request, HTTPResponse(e.status, e.body))
+
+    def _dispatch(self, channel, request):
+        if request.path == "/session/start":
+            if request.method != "POST":
+                raise HTTPError(405)
+            self._submit(channel, request, self.create_session)
+            return
+        parts = request.path.split("/")
+        if len(parts) != 7 or parts[:2] != ["", "app"] or\
+                parts[3] != "users" or parts[5] != "keys":
+            raise HTTPError(404)
+        appid, userid, key = [urlunquote(parts[i]) for i in (2, 4, 6)]
+        if key:
+            handlers = {"GET": ("get-key", self.get_key),
+                        "PUT": ("set-key", self.set_key),
+                        "DELETE": ("del-key", self.delete_key)}
+        else:
+            handlers = {"GET": ("get-key", self.list_keys),
+                        "DELETE": ("del-key", self.delete_keys)}
+        try:
+            permission, handler = handlers[request.method]
+        except KeyError:
+            raise HTTPError(405)
+        if not self._permits(request, appid, userid, permission):
+            raise HTTPError(403)
+        if handler == self.get_key and request.query.get("wait"):
+            self._watch(channel, request, appid, userid, key)
+        else:
+            self._submit(channel, request, handler, appid, userid, key)
+
+    def create_session(self, request):
+        """Create a new session from the credentials in the POST body."""
+        credentials = dict(parse_qsl(request.body))
+        appid, userid = self.credentials.check_credentials(credentials)
+        if appid is None or userid is None:
+            raise HTTPError(403)
+        sessionid = self.sessions.new_session(appid, userid)
+        return HTTPResponse(200, sessionid, "text/plain")
+
+    def list_keys(self, request, appid, userid, key):
+        """List keys for the given user."""
+        limit = request.query.get("limit")
+        if limit:
+            try:
+                limit = int(limit)
+            except ValueError:
+                raise HTTPError(400)
+        keys = self.backend.listkeys(appid, userid,
+                                     request.query.get("start"),
+                                     request.query.get("end"), limit)
+        body = "\n".join(urlquote(key) for key in keys)
+        return self._compressed(request, body, "application/newlines")
+
+    def delete_keys(self, request, appid, userid, key):
+        """Delete all keys for the given user."""
+        self.backend.delete_bucket(appid, userid)
+        return HTTPResponse(204)
+
+    def get_key(self, request, appid, userid, key):
+        """Get the value of a key, as JSON or raw bytes."""
+        try:
+            item = self.backend.getitem(appid, userid, key)
+        except KeyError:
+            raise HTTPError(404)
+        return self._item_response(request, item)
+
+    def set_key(self, request, appid, userid, key):
+        """Update the value of a key."""
+        content_type = request.headers.get("content-type", "")
+        if content_type.split(";")[0] == "application/octet-stream":
+            value = request.body
+        else:
+            value = dict(parse_qsl(request.body)).get("value")
+            if value is None:
+                raise HTTPError(400, "missing value")
+        try:
+            ttl = _parse_ttl(request.headers.get("x-sauropod-ttl"))
+        except ValueError:
+            raise HTTPError(400, "invalid ttl")
+        try:
+            if_match = self._get_if_match(request)
+            item = self.backend.set(appid, userid, key, value, if_match, ttl)
+        except ConflictError:
+            raise HTTPError(412)
+        except QuotaExceededError, e:
+            raise HTTPError(413, str(e))
+        except NotImplementedError:
+            raise HTTPError(501)
+        headers = []
+        if item.etag:
+            headers.append(("ETag", item.etag))
+        return HTTPResponse(204, headers=headers)
+
+    def delete_key(self, request, appid, userid, key):
+        """Delete a key."""
+        try:
+            if_match = self._get_if_match(request)
+            self.backend.delete(appid, userid, key, if_match)
+        except KeyError:
+            raise HTTPError(404)
+        except ConflictError:
+            raise HTTPError(412)
+        return HTTPResponse(204)
+
+    def _item_response(self, request, item):
+        accept = create_accept_header(request.headers.get("accept"))
+        offers = accept.acceptable_offers(ITEM_CONTENT_TYPES)
+        if offers and offers[0][0] == "application/octet-stream":
+            return self._compressed(request, item.value,
+                                    "application/octet-stream", item.etag)
+        return self._compressed(request, _item_to_json(item),
+                                "application/json", item.etag)
+
+    def _compressed(self, request, body, content_type, etag=None):
+        body, encoding = compress_body(body, content_type,
+                                       request.headers.get("accept-encoding"),
+                                       self.settings)
+        response = HTTPResponse(200, body, content_type,
+                                [("Vary", "Accept-Encoding")])
+        if encoding is not None:
+            response.headers.append(("Content-Encoding", encoding))
+            if etag:
+                etag = encode_etag(etag, encoding)
+        if etag:
+            response.headers.append(("ETag", etag))
+        return response
+
+    def _get_if_match(self, request):
+        if_match = request.headers.get("if-match")
+        if if_match is None:
+            if_match = request.headers.get("if-none-match")
+            if if_match is not None:
+                if if_match != "*":
+                    raise HTTPError(400)
+                if_match = ""
+        return decode_etag(if_match)
+
+    def _permits(self, request, appid, userid, permission):
+        """Check a permission using the configured authorization policy.
+
+        This is cheap enough to do in the loop thread, since signed sessions
+        are checked without going to a database.
+        """
+        principals = [Everyone]
+        sessionid = request.headers.get("signature")
+        if sessionid is not None:
+            session = self.sessions.get_session_data(sessionid)
+            if session is not None:
+                principals.append(Authenticated)
+                principals.append(session[1])
+                principals.append("app:" + session[0])
+        try:
+            userid = userid.decode("utf8")
+        except UnicodeDecodeError:
+            raise HTTPError(400)
+        context = OperationContext(request, appid, userid)
+        return self.policy.permits(context, principals, permission)
+
+    def _submit(self, channel, request, handler, *args):
+        """Run a handler on the executor, then respond with its result."""
+        def callback(response):
+            channel.respond(request, response)
+        if not self.executor.submit(callback, self._call, handler, request,
+                                    *args):
+            channel.respond(request, busy_response())
+
+    def _call(self, handler, request, *args):
+        try:
+            return handler(request, *args)
+        except HTTPError, e:
+            return HTTPResponse(e.status, e.body)
+        except ServerBusyError:
+            return busy_response()
+        except Exception:
+            logger.exception("error handling %s %s", request.method,
+                             request.path)
+            return HTTPResponse(500)
+
+    def _watch(self, channel, request, appid, userid, key):
+        try:
+            wait = int(request.query["wait"])
+        except ValueError:
+            raise HTTPError(400)
+        max_wait = int(self.settings.get("sauropod.watch.max_wait", 60))
+        wait = max(0, min(wait, max_wait))
+        KeyWatch(self, channel, request, appid, userid, key, wait).start()
+
+    def _close_idle_channels(self):
+        cutoff = time.time() - self.keepalive_timeout
+        for dispatcher in self.loop.map.values():
+            if isinstance(dispatcher, HTTPChannel):
+                if not dispatcher.busy and dispatcher.last_activity < cutoff:
+                    dispatcher.close()
+        self.loop.call_later(self.keepalive_timeout / 2.0,
+                             self._close_idle_channels)
+
+
+class KeyWatch(object):
+    """A long-poll for a change to a key, that holds no thread while idle.
+
+    The key is registered with the backend's ChangeNotifier before it is
+    first read, and re-read on the executor after every relevant write, as
+    in pysauropod.notify.watch_key().
+    """
+
+    def __init__(self, server, channel, request, appid, userid, key, wait):
+        self.server = server
+        self.channel = channel
+        self.request = request
+        self.appid = appid
+        self.userid = userid
+        self.key = key
+        self.etag = decode_etag(request.headers.get("if-none-match"))
+        self.wait = wait
+        self.checking = False
+        self.changed = False
+        self.expired = False
+        self.done = False
+
+    def start(self):
+        notifier = self.server.backend.notifier
+        self.waiter = notifier.add_waiter(self, self.userid, self.appid,
+                                          self.key)
+        self.timer = self.server.loop.call_later(self.wait, self._expire)
+        self._check()
+
+    def set(self):
+        """Called by the notifier, in the writing thread."""
+        self.server.loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self):
+        if self.checking:
+            self.changed = True
+        elif not self.done:
+            self._check()
+
+    def _expire(self):
+        self.expired = True
+        if not self.checking:
+            self._finish(HTTPResponse(304))
+
+    def _check(self):
+        self.checking = True
+        self.changed = False
+        if not self.server.executor.submit(self._checked, self.server._call,
+                                           self._read, self.request):
+            self._finish(busy_response())
+
+    def _read(self, request):
+        try:
+            item = self.server.backend.getitem(self.appid, self.userid,
+                                               self.key)
+        except KeyError:
+            if self.etag is not None:
+                raise HTTPError(404)
+            return None
+        if item.etag == self.etag:
+            return None
+        return self.server._item_response(request, item)
+
+    def _checked(self, response):
+        self.checking = False
+        if self.done:
+            return
+        if response is not None:
+            self._finish(response)
+        elif self.expired:
+            self._finish(HTTPResponse(304))
+        elif self.changed:
+            self._check()
+
+    def _finish(self, response):
+        self.done = True
+        self.timer.cancel()
+        self.server.backend.notifier.remove_waiter(self.waiter, self.userid)
+        self.channel.respond(self.request, response)
+
+
+def main(argv=None):
+    """Command-line entry point for the evented server."""
+    usage = "usage: %prog [options] [CONFIG_FILE]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--host", default="0.0.0.0",
+                      help="address on which to listen")
+    parser.add_option("--port", type="int", default=8080,
+                      help="port on which to listen")
+    parser.add_option("--threads", type="int", default=10,
+                      help="number of threads for blocking backend calls")
+    parser.add_option("--max-pending", type="int", default=1000,
+                      help="number of backend calls that may wait for a"
+                           " thread before requests are refused")
+    parser.add_option("--keepalive-timeout", type="float", default=75,
+                      help="seconds after which idle connections are closed")
+    opts, args = parser.parse_args(argv)
+    if len(args) > 1:
+        parser.error("invalid arguments")
+    config_file = os.path.abspath(args[0]) if args else None
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format="%(asctime)s %(message)s")
+    registry = make_registry(config_file)
+    server = EventedServer(registry, opts.host, opts.port, opts.threads,
+                           opts.max_pending, opts.keepalive_timeout)
+    logger.info("listening on %s:%d", *server.address[:2])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
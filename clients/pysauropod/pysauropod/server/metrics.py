@@ -0,0 +1,359 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Request and backend timing metrics for the Sauropod webapi server.
+
+This module records a count, a latency histogram and a tally of errors for
+each cornice service and each backend operation, and renders them in the
+Prometheus text exposition format.
+
+To keep the cost of recording low, each thread accumulates its figures in
+a private shard that only it writes to, so the request path never takes a
+lock.  The shards are merged when the metrics are rendered, and the shards
+of threads that have exited are folded into a shared total at that point.
+
+"""
+
+import time
+import types
+import threading
+from bisect import bisect_left
+
+from zope.interface import implements, Interface
+
+from pysauropod.interfaces import ISauropodBackend
+
+
+# Upper bounds of the latency histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Backend methods that are timed by InstrumentedBackend.
+INSTRUMENTED_OPERATIONS = ("getitem", "getitems", "set", "delete",
+                           "listkeys", "changes", "getstats",
+                           "delete_bucket", "delete_user")
+
+# Help text for each family of metrics.
+FAMILIES = {
+    "sauropod_request": "requests handled, by cornice service and method",
+    "sauropod_request_db": "database queries made while handling requests",
+    "sauropod_backend": "calls to the storage backend, by operation",
+}
+
+# Help text for each plain counter.
+COUNTERS = {
+    "sauropod_request_db_queries_total":
+        "Database queries made while handling requests.",
+}
+
+
+def includeme(config):
+    """Include the sauropod metrics definitions in a pyramid config.
+
+    This registers an IMetricsRegistry utility and a tween that times every
+    request.  The metrics are served from the "/metrics" URL, which only
+    the applications listed in "sauropod.security.admin_apps" may read.
+    """
+    metrics = MetricsRegistry()
+    config.registry.registerUtility(metrics, IMetricsRegistry)
+    config.add_tween("pysauropod.server.metrics.metrics_tween_factory")
+
+
+class IMetricsRegistry(Interface):
+    """Interface for recording and reporting timing metrics."""
+
+    def record(family, labels, duration, error=None):
+        """Record a timed event in the given family of metrics.
+
+        The labels are a tuple of (name, value) pairs identifying what was
+        timed.  If the event failed then "error" names the kind of failure.
+        """
+
+    def increment(name, labels, amount=1):
+        """Add to the named counter.
+
+        The labels are a tuple of (name, value) pairs identifying what was
+        counted.
+        """
+
+    def add_source(name, help, collect, type="counter"):
+        """Add a counter or gauge whose values are read from elsewhere.
+
+        When the metrics are rendered, collect() is called to get a list
+        of (labels, value) pairs for the named metric.
+        """
+
+    def render():
+        """Render all metrics recorded so far in Prometheus text format."""
+
+
+class _Stats(object):
+    """Counters for a single labelled series of events."""
+
+    __slots__ = ("count", "total", "buckets", "errors")
+
+    def __init__(self, num_buckets):
+        self.count = 0
+        self.total = 0.0
+        # One more than the number of bounds, to count overflows.
+        self.buckets = [0] * (num_buckets + 1)
+        self.errors = {}
+
+    def merge(self, other):
+        self.count += other.count
+        self.total += other.total
+        for i, n in enumerate(other.buckets):
+            self.buckets[i] += n
+        for error, n in other.errors.items():
+            self.errors[error] = self.errors.get(error, 0) + n
+
+
+class MetricsRegistry(object):
+    """IMetricsRegistry implementation using per-thread aggregation."""
+
+    implements(IMetricsRegistry)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []
+        self._retired = {}
+        self._sources = []
+
+    def _get_shard(self):
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = {}
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def record(self, family, labels, duration, error=None):
+        """Record a timed event in the given family of metrics."""
+        shard = self._get_shard()
+        try:
+            stats = shard[(family, labels)]
+        except KeyError:
+            stats = shard[(family, labels)] = _Stats(len(self.buckets))
+        stats.count += 1
+        stats.total += duration
+        stats.buckets[bisect_left(self.buckets, duration)] += 1
+        if error is not None:
+            stats.errors[error] = stats.errors.get(error, 0) + 1
+
+    def increment(self, name, labels, amount=1):
+        """Add to the named counter."""
+        shard = self._get_shard()
+        try:
+            stats = shard[(name, labels)]
+        except KeyError:
+            stats = shard[(name, labels)] = _Stats(0)
+        stats.count += amount
+
+    def add_source(self, name, help, collect, type="counter"):
+        """Add a counter or gauge whose values are read from elsewhere."""
+        self._sources.append((name, help, collect, type))
+
+    def collect(self):
+        """Merge the per-thread shards into a dict of _Stats objects.
+
+        Live shards may be updated while we read them, so the merged figures
+        are only approximately consistent with each other.
+        """
+        with self._lock:
+            live_shards = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    live_shards.append((thread, shard))
+                else:
+                    self._merge_into(self._retired, shard)
+            self._shards = live_shards
+            merged = {}
+            self._merge_into(merged, self._retired)
+            for thread, shard in live_shards:
+                self._merge_into(merged, shard)
+        return merged
+
+    def _merge_into(self, target, shard):
+        for key, stats in shard.items():
+            try:
+                target[key].merge(stats)
+            except KeyError:
+                target[key] = _Stats(len(self.buckets))
+                target[key].merge(stats)
+
+    def render(self):
+        """Render all metrics recorded so far in Prometheus text format."""
+        merged = self.collect()
+        lines = []
+        for family in sorted(FAMILIES):
+            series = sorted((labels, stats)
+                            for ((f, labels), stats) in merged.iteritems()
+                            if f == family)
+            name = family + "_duration_seconds"
+            lines.append("# HELP %s Time taken by %s." % (name,
+                                                          FAMILIES[family]))
+            lines.append("# TYPE %s histogram" % (name,))
+            for labels, stats in series:
+                cumulative = 0
+                for bound, n in zip(self.buckets, stats.buckets):
+                    cumulative += n
+                    le = _format_labels(labels + (("le", repr(bound)),))
+                    lines.append("%s_bucket%s %d" % (name, le, cumulative))
+                le = _format_labels(labels + (("le", "+Inf"),))
+                lines.append("%s_bucket%s %d" % (name, le, stats.count))
+                lines.append("%s_sum%s %r" % (name, _format_labels(labels),
+                                              stats.total))
+                lines.append("%s_count%s %d" % (name, _format_labels(labels),
+                                                stats.count))
+            name = family + "_errors_total"
+            lines.append("# HELP %s Failed %s." % (name, FAMILIES[family]))
+            lines.append("# TYPE %s counter" % (name,))
+            for labels, stats in series:
+                for error, n in sorted(stats.errors.items()):
+                    err_labels = _format_labels(labels + (("error", error),))
+                    lines.append("%s%s %d" % (name, err_labels, n))
+        for name in sorted(COUNTERS):
+            lines.append("# HELP %s %s" % (name, COUNTERS[name]))
+            lines.append("# TYPE %s counter" % (name,))
+            for ((n, labels), stats) in sorted(merged.iteritems()):
+                if n == name:
+                    lines.append("%s%s %d" % (name, _format_labels(labels),
+                                              stats.count))
+        for name, help, collect, type in self._sources:
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, type))
+            for labels, value in collect():
+                if isinstance(value, float):
+                    value = repr(value)
+                lines.append("%s%s %s" % (name, _format_labels(labels),
+                                          value))
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    """Format (name, value) pairs as a Prometheus label set."""
+    items = []
+    for name, value in labels:
+        value = value.replace("\\", "\\\\").replace("\"", "\\\"")
+        items.append("%s=\"%s\"" % (name, value.replace("\n", "\\n")))
+    return "{" + ",".join(items) + "}"
+
+
+def metrics_tween_factory(handler, registry):
+    """Pyramid tween factory to time each request by cornice service.
+
+    Cornice names the route for each service after the service itself, so
+    the matched route name identifies the service.  Error responses are
+    tallied under the name of their HTTPException class.
+
+    If the backend keeps "query_stats", as SQLBackend does, then the number
+    of queries and the database time for each request are also recorded,
+    and reported to the client in a Server-Timing header.
+    """
+    metrics = registry.getUtility(IMetricsRegistry)
+    backend = registry.queryUtility(ISauropodBackend)
+    query_stats = getattr(backend, "query_stats", None)
+
+    def metrics_tween(request):
+        start = time.time()
+        if query_stats is not None:
+            query_stats.reset()
+        try:
+            response = handler(request)
+        except Exception, e:
+            _record_request(metrics, query_stats, request, start,
+                            type(e).__name__)
+            raise
+        error = None
+        if response.status_int >= 400:
+            error = type(response).__name__
+            if error == "Response":
+                error = str(response.status_int)
+        duration = _record_request(metrics, query_stats, request, start,
+                                   error)
+        timings = []
+        if query_stats is not None:
+            timings.append("db;dur=%.3f;desc=\"%d queries\"" % (
+                           query_stats.duration * 1000, query_stats.count))
+        timings.append("total;dur=%.3f" % (duration * 1000,))
+        response.headers["Server-Timing"] = ", ".join(timings)
+        return response
+
+    return metrics_tween
+
+
+def _record_request(metrics, query_stats, request, start, error):
+    route = getattr(request, "matched_route", None)
+    if route is None:
+        service = "none"
+    else:
+        service = route.name
+    labels = (("service", service), ("method", request.method))
+    duration = time.time() - start
+    metrics.record("sauropod_request", labels, duration, error)
+    if query_stats is not None:
+        metrics.record("sauropod_request_db", labels, query_stats.duration)
+        metrics.increment("sauropod_request_db_queries_total", labels,
+                          query_stats.count)
+    return duration
+
+
+class InstrumentedBackend(object):
+    """ISauropodBackend wrapper that times calls to the underlying backend.
+
+    Calls to the given operations are timed, and all other attributes are
+    passed straight through.  For methods returning a generator, such as
+    listkeys(), the time taken to consume the generator is included.
+    Calls that the backend makes to its own methods are not counted.
+    """
+
+    implements(ISauropodBackend)
+
+    def __init__(self, backend, metrics, operations=INSTRUMENTED_OPERATIONS):
+        self.backend = backend
+        for name in operations:
+            method = getattr(backend, name, None)
+            if method is not None:
+                setattr(self, name, _instrument(metrics, name, method))
+
+    def __getattr__(self, name):
+        return getattr(self.backend, name)
+
+
+def _instrument(metrics, name, method):
+    labels = (("operation", name),)
+
+    def instrumented(*args, **kwds):
+        start = time.time()
+        try:
+            result = method(*args, **kwds)
+        except Exception, e:
+            duration = time.time() - start
+            metrics.record("sauropod_backend", labels, duration,
+                           type(e).__name__)
+            raise
+        if isinstance(result, types.GeneratorType):
+            return _instrument_iter(metrics, labels, result, start)
+        metrics.record("sauropod_backend", labels, time.time() - start)
+        return result
+
+    instrumented.__name__ = method.__name__
+    instrumented.__doc__ = method.__doc__
+    return instrumented
+
+
+def _instrument_iter(metrics, labels, iterator, start):
+    error = None
+    try:
+        for value in iterator:
+            yield value
+    except Exception, e:
+        error = type(e).__name__
+        raise
+    finally:
+        metrics.record("sauropod_backend", labels, time.time() - start, error)
@@ -0,0 +1,318 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Preforking multi-process server for the Sauropod web API.
+
+The master process binds the listening socket and forks a number of worker
+processes, each of which serves requests from a fixed pool of threads.  The
+app is only loaded inside each worker, after the fork, so every worker opens
+its own database connection pool rather than sharing connections with its
+parent.  The total connection budget is divided between the workers to pick
+the size of each pool.
+
+The master process responds to the following signals:
+
+    * SIGHUP:  gracefully reload, by starting a fresh set of workers that
+               re-read the config file and then stopping the old ones.
+    * SIGTERM, SIGINT:  gracefully shut down, letting workers finish any
+               requests in progress.
+
+Workers that die unexpectedly are replaced.  Note that each worker keeps its
+own /metrics counters, and that long-poll watches are only woken by writes
+made through the same worker.
+
+Use it from the command-line like so:
+
+    sauropod-server --workers 4 --threads 10 --db-connections 40 prod.ini
+
+"""
+
+import os
+import sys
+import time
+import errno
+import signal
+import socket
+import logging
+import optparse
+import threading
+import multiprocessing
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler
+
+from mozsvc.config import load_into_settings
+
+
+logger = logging.getLogger("pysauropod.server.prefork")
+
+
+def pool_size_for_workers(budget, num_workers, num_threads):
+    """Divide a total connection budget between workers.
+
+    Each worker gets an equal share of the budget, but at least one
+    connection and no more than it has threads to use them.
+    """
+    size = max(1, int(budget) // int(num_workers))
+    return min(size, int(num_threads))
+
+
+def make_app_factory(config_file=None, settings=None, pool_size=None):
+    """Make a function to load the Sauropod app inside a worker process.
+
+    Settings are read from the given config file, if any, on each call.
+    If a pool size is given then the storage backend is configured to
+    use exactly that many connections.
+    """
+    def app_factory():
+        app_settings = dict(settings or {})
+        if config_file is not None:
+            config = load_into_settings(config_file, app_settings)
+        else:
+            config = None
+        if pool_size is not None:
+            overrides = {"pool_size": pool_size, "pool_max_overflow": 0}
+            for name, value in overrides.iteritems():
+                app_settings["sauropod.storage." + name] = value
+                if config is not None and config.has_section(
+                                                     "sauropod.storage"):
+                    config.set("sauropod.storage", name, value)
+        from pysauropod.server import main
+        return main({}, **app_settings)
+    return app_factory
+
+
+class RequestHandler(WSGIRequestHandler):
+    """WSGIRequestHandler that logs to the logging module, not stderr."""
+
+    def log_message(self, format, *args):
+        logger.debug("%s - " + format, self.client_address[0], *args)
+
+
+class SharedSocketWSGIServer(WSGIServer):
+    """WSGIServer that accepts requests from an existing listening socket.
+
+    The socket may be shared with other processes and threads, so it is
+    expected to be non-blocking; any accept() lost to a competitor is
+    silently ignored.
+    """
+
+    def __init__(self, sock, app):
+        WSGIServer.__init__(self, sock.getsockname(), RequestHandler,
+                            bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        host, port = sock.getsockname()[:2]
+        self.server_name = socket.getfqdn(host)
+        self.server_port = port
+        self.setup_environ()
+        self.set_app(app)
+
+    def get_request(self):
+        request, client_address = self.socket.accept()
+        request.setblocking(1)
+        return request, client_address
+
+
+class Worker(object):
+    """A single worker process, serving requests from a pool of threads."""
+
+    def __init__(self, sock, app_factory, num_threads, poll_interval=1.0):
+        self.sock = sock
+        self.app_factory = app_factory
+        self.num_threads = num_threads
+        self.poll_interval = poll_interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        """Serve requests until signalled to stop, then return."""
+        ppid = os.getppid()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+        server = SharedSocketWSGIServer(self.sock, self.app_factory())
+        server.timeout = self.poll_interval
+        threads = []
+        for _ in xrange(self.num_threads):
+            thread = threading.Thread(target=self._serve, args=(server,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # Also stop if the master dies without telling us.
+        while not self.stopping.is_set():
+            self.stopping.wait(self.poll_interval)
+            if os.getppid() != ppid:
+                self.stopping.set()
+        for thread in threads:
+            thread.join()
+
+    def _serve(self, server):
+        while not self.stopping.is_set():
+            try:
+                server.handle_request()
+            except Exception:
+                logger.exception("error handling request")
+
+    def _stop(self, signum, frame):
+        self.stopping.set()
+
+
+class PreforkServer(object):
+    """Master process managing a set of preforked worker processes.
+
+    The listening socket is bound when the server is created, so that any
+    port number chosen by the OS is known before serve_forever() is called.
+    """
+
+    def __init__(self, app_factory, host="0.0.0.0", port=8080,
+                 num_workers=None, num_threads=10, graceful_timeout=30,
+                 backlog=1024):
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self.app_factory = app_factory
+        self.num_workers = num_workers
+        self.num_threads = num_threads
+        self.graceful_timeout = graceful_timeout
+        self.workers = set()
+        self.retiring = {}
+        self._reloading = False
+        self._stopping = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(backlog)
+        self.sock.setblocking(0)
+        self.address = self.sock.getsockname()
+
+    def serve_forever(self):
+        """Run the master process until signalled to shut down."""
+        signal.signal(signal.SIGHUP, self._reload)
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        logger.info("listening on %s:%d", *self.address[:2])
+        try:
+            while not self._stopping:
+                if self._reloading:
+                    self._reloading = False
+                    logger.info("reloading workers")
+                    # Start the new workers before stopping the old ones,
+                    # so there's always someone accepting requests.
+                    old_workers, self.workers = self.workers, set()
+                    self._spawn_workers()
+                    for pid in old_workers:
+                        self._retire(pid)
+                self._spawn_workers()
+                self._reap_workers()
+                self._kill_overdue_workers()
+                time.sleep(0.5)
+        finally:
+            for pid in list(self.workers):
+                self._retire(pid)
+            self.workers.clear()
+            while self.retiring:
+                self._reap_workers()
+                self._kill_overdue_workers()
+                time.sleep(0.1)
+            self.sock.close()
+            logger.info("shut down")
+
+    def _spawn_workers(self):
+        while len(self.workers) < self.num_workers:
+            pid = os.fork()
+            if pid == 0:
+                status = 0
+                try:
+                    Worker(self.sock, self.app_factory,
+                           self.num_threads).run()
+                except BaseException:
+                    logger.exception("worker failed")
+                    status = 1
+                finally:
+                    os._exit(status)
+            logger.info("started worker %d", pid)
+            self.workers.add(pid)
+
+    def _retire(self, pid):
+        self.retiring[pid] = time.time() + self.graceful_timeout
+        self._signal(pid, signal.SIGTERM)
+
+    def _reap_workers(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno != errno.ECHILD:
+                    raise
+                pid = 0
+            if pid == 0:
+                break
+            if pid in self.workers:
+                logger.error("worker %d died with status %d", pid, status)
+                self.workers.discard(pid)
+            else:
+                logger.info("worker %d exited", pid)
+                self.retiring.pop(pid, None)
+
+    def _kill_overdue_workers(self):
+        now = time.time()
+        for pid, deadline in self.retiring.items():
+            if deadline < now:
+                logger.warning("killing worker %d", pid)
+                self._signal(pid, signal.SIGKILL)
+
+    def _signal(self, pid, signum):
+        try:
+            os.kill(pid, signum)
+        except OSError, e:
+            if e.errno != errno.ESRCH:
+                raise
+
+    def _reload(self, signum, frame):
+        self._reloading = True
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+
+def main(argv=None):
+    """Command-line entry point for the preforking server."""
+    usage = "usage: %prog [options] [CONFIG_FILE]"
+    parser = optparse.OptionParser(usage=usage)
+    parser.add_option("--host", default="0.0.0.0",
+                      help="address on which to listen")
+    parser.add_option("--port", type="int", default=8080,
+                      help="port on which to listen")
+    parser.add_option("--workers", type="int", default=None,
+                      help="number of worker processes (default: one per"
+                           " CPU)")
+    parser.add_option("--threads", type="int", default=10,
+                      help="number of threads in each worker process")
+    parser.add_option("--db-connections", type="int", default=None,
+                      help="total number of backend connections, to be"
+                           " divided between the workers")
+    parser.add_option("--graceful-timeout", type="float", default=30,
+                      help="seconds to wait for workers to finish requests"
+                           " when stopping or reloading")
+    opts, args = parser.parse_args(argv)
+    if len(args) > 1:
+        parser.error("invalid arguments")
+    config_file = os.path.abspath(args[0]) if args else None
+    num_workers = opts.workers or multiprocessing.cpu_count()
+    pool_size = None
+    if opts.db_connections is not None:
+        if opts.db_connections < num_workers:
+            parser.error("need at least one connection per worker")
+        pool_size = pool_size_for_workers(opts.db_connections, num_workers,
+                                          opts.threads)
+    logging.basicConfig(level=logging.INFO, stream=sys.stderr,
+                        format="%(asctime)s [%(process)d] %(message)s")
+    app_factory = make_app_factory(config_file, pool_size=pool_size)
+    server = PreforkServer(app_factory, opts.host, opts.port, num_workers,
+                           opts.threads, opts.graceful_timeout)
+    server.serve_forever()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
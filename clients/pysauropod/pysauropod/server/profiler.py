@@ -0,0 +1,161 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Sampling profiler middleware for the Sauropod webapi server.
+
+This module provides a WSGI middleware that runs a random sample of requests
+under cProfile, along with any request carrying a debug header with the
+configured token.  Profiles are aggregated per endpoint and periodically
+written out as pstats files, which can be examined with the standard pstats
+module or tools such as snakeviz:
+
+    python -m pstats /tmp/sauropod-profiles/key.GET.1337000000.pstats
+
+The middleware is only installed when "sauropod.profiler.enabled" is set,
+so it costs nothing at all when disabled.
+
+"""
+
+import os
+import time
+import random
+import pstats
+import cProfile
+import tempfile
+import threading
+
+from pyramid.settings import asbool
+
+from pysauropod.utils import strings_differ
+
+
+# Header that can be sent to force profiling of a request.
+DEBUG_HEADER = "HTTP_X_SAUROPOD_PROFILE"
+
+
+def make_profiler(app, settings, routes=()):
+    """Wrap the given app in a ProfilerMiddleware, if enabled in settings.
+
+    The settings used are those starting with "sauropod.profiler.", e.g.
+    "sauropod.profiler.sample_rate".  If profiling is not enabled then the
+    app is returned unchanged.
+    """
+    if not asbool(settings.get("sauropod.profiler.enabled", False)):
+        return app
+    kwds = {}
+    for name, convert in (("directory", str), ("sample_rate", float),
+                          ("debug_token", str), ("flush_interval", int),
+                          ("max_files", int)):
+        value = settings.get("sauropod.profiler." + name)
+        if value is not None:
+            kwds[name] = convert(value)
+    return ProfilerMiddleware(app, routes=routes, **kwds)
+
+
+class ProfilerMiddleware(object):
+    """WSGI middleware to profile a sample of requests.
+
+    Each request is profiled with probability "sample_rate", or if it has
+    an X-Sauropod-Profile header matching "debug_token".  Profiles for each
+    endpoint are added together, and every "flush_interval" seconds they are
+    written to a new file in "directory".  Only the latest "max_files" files
+    are kept for each endpoint.
+
+    Endpoints are named by the first of the given routes that matches the
+    request path, along with the request method.
+    """
+
+    def __init__(self, app, directory=None, sample_rate=0.01,
+                 debug_token=None, flush_interval=60, max_files=10,
+                 routes=()):
+        if directory is None:
+            directory = os.path.join(tempfile.gettempdir(),
+                                     "sauropod-profiles")
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.app = app
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.debug_token = debug_token
+        self.flush_interval = flush_interval
+        self.max_files = max_files
+        self.routes = list(routes)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_flush = time.time()
+
+    def __call__(self, environ, start_response):
+        if not self._should_profile(environ):
+            return self.app(environ, start_response)
+        profile = cProfile.Profile()
+        result = profile.runcall(self._call_app, environ, start_response)
+        self.add_profile(self._get_endpoint(environ), profile)
+        return result
+
+    def _call_app(self, environ, start_response):
+        """Call the app, consuming the response so it's all profiled."""
+        app_iter = self.app(environ, start_response)
+        try:
+            return list(app_iter)
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+    def _should_profile(self, environ):
+        if self.debug_token is not None:
+            token = environ.get(DEBUG_HEADER)
+            if token is not None:
+                if not strings_differ(token, self.debug_token):
+                    return True
+        return random.random() < self.sample_rate
+
+    def _get_endpoint(self, environ):
+        path = environ.get("PATH_INFO", "")
+        method = environ.get("REQUEST_METHOD", "GET")
+        for route in self.routes:
+            if route.match(path) is not None:
+                return "%s.%s" % (route.name, method)
+        return "unknown.%s" % (method,)
+
+    def add_profile(self, endpoint, profile):
+        """Add a profile to the aggregated stats for an endpoint."""
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                self._stats[endpoint] = pstats.Stats(profile)
+            else:
+                stats.add(profile)
+            if time.time() - self._last_flush >= self.flush_interval:
+                self._flush()
+
+    def flush(self):
+        """Write out the aggregated stats for each endpoint, and reset them."""
+        with self._lock:
+            self._flush()
+
+    def _flush(self):
+        now = time.time()
+        for endpoint, stats in self._stats.iteritems():
+            filename = "%s.%d.pstats" % (endpoint, now)
+            stats.dump_stats(os.path.join(self.directory, filename))
+            self._rotate(endpoint)
+        self._stats.clear()
+        self._last_flush = now
+
+    def _rotate(self, endpoint):
+        """Remove all but the latest max_files files for an endpoint."""
+        prefix = endpoint + "."
+        filenames = []
+        for filename in os.listdir(self.directory):
+            if filename.startswith(prefix) and filename.endswith(".pstats"):
+                timestamp = filename[len(prefix):-len(".pstats")]
+                if timestamp.isdigit():
+                    filenames.append((int(timestamp), filename))
+        filenames.sort()
+        for _, filename in filenames[:-self.max_files]:
+            try:
+                os.unlink(os.path.join(self.directory, filename))
+            except EnvironmentError:
+                pass
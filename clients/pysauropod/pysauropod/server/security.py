@@ -25,9 +25,14 @@ def includeme(config):
         * an authorization policy that defines some handy permissions
         * an authentication policy that handles auth via OAuth header data
 
+    Applications listed in the "sauropod.security.admin_apps" setting are
+    trusted to perform administrative actions such as deleting all the data
+    for a user.
     """
+    settings = config.get_settings()
+    admin_apps = settings.get("sauropod.security.admin_apps", "").split()
     config.set_root_factory(SauropodContext)
-    config.set_authorization_policy(SauropodAuthorizationPolicy())
+    config.set_authorization_policy(SauropodAuthorizationPolicy(admin_apps))
     config.set_authentication_policy(SauropodAuthenticationPolicy())
 
 
@@ -47,14 +52,31 @@ class SauropodContext(object):
             self.userid = request.matchdict.get("userid", None)
 
 
+class OperationContext(object):
+    """Request context for a single operation within a batch request.
+
+    Each operation in a batch names its own appid and userid, so it gets a
+    context of its own against which to check permissions.
+    """
+    def __init__(self, request, appid, userid):
+        self.request = request
+        self.appid = appid
+        self.userid = userid
+
+
 class SauropodAuthorizationPolicy(object):
     """Custom authorization policy for Sauropod.
 
     This policy provides pre-built permissions to identify valid appids,
-    as well as getting, setting and deleting keys.
+    as well as getting, setting and deleting keys.  Sessions started by one
+    of the given admin_apps may also delete all the data for their user,
+    and perform other administrative actions such as reading metrics.
     """
     implements(IAuthorizationPolicy)
 
+    def __init__(self, admin_apps=()):
+        self.admin_apps = frozenset(admin_apps)
+
     def permits(self, context, principals, permission):
         # The "valid-app" permission matches anything with a valid appid.
         if permission == "valid-app":
@@ -74,9 +96,25 @@ class SauropodAuthorizationPolicy(object):
                 return False
             principal = "app:" + context.appid
             return (principal in principals and context.userid in principals)
+        # The "del-user" permission needs the userid and an admin app.
+        if permission == "del-user":
+            if context.userid is None or context.userid not in principals:
+                return False
+            return self._is_admin(principals)
+        # The "admin" permission needs only an admin app.
+        if permission == "admin":
+            return self._is_admin(principals)
         # No other permissions are defined.
         return False
 
+    def _is_admin(self, principals):
+        """Check whether the principals include one of the admin apps."""
+        for principal in principals:
+            if principal.startswith("app:"):
+                if principal[len("app:"):] in self.admin_apps:
+                    return True
+        return False
+
 
 class SauropodAuthenticationPolicy(object):
     """Custom authentication policy for Sauropod.
@@ -126,7 +126,9 @@ class SignedSessionManager(object):
         if strings_differ(sig, expected_sig):
             return None
         # Hooray!
-        _, appid, userid = b64decode(data).split(":", 2)
+        # The random prefix is a fixed four bytes and might contain a colon,
+        # while the appid might be a URL; only the userid is colon-free.
+        appid, userid = b64decode(data)[5:].rsplit(":", 1)
         userid = userid.decode("utf8")
         return appid, userid
 
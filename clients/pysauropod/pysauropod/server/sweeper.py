@@ -0,0 +1,67 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+Background cleanup of expired items for the Sauropod webapi server.
+
+If the "sauropod.sweeper.interval" setting is given, the server starts a
+daemon thread that wakes up that many seconds apart to delete expired items
+from the backend and to compact old tombstones out of the change feed.
+Backends lacking either kind of cleanup are simply skipped for it.
+
+"""
+
+import logging
+import threading
+
+
+logger = logging.getLogger("pysauropod.server.sweeper")
+
+# Backend methods called on each sweep, each returning a count of rows
+# deleted, along with a description of those rows for logging.
+SWEEP_OPERATIONS = (("expire_items", "expired items"),
+                    ("compact_changes", "old tombstones"))
+
+
+class Sweeper(threading.Thread):
+    """Thread that periodically deletes expired data from a backend.
+
+    Call start() to begin sweeping every "interval" seconds, and stop() to
+    finish.  Errors are logged, and the next sweep goes ahead as usual.
+    """
+
+    def __init__(self, backend, interval=60):
+        super(Sweeper, self).__init__(name="sauropod-sweeper")
+        self.daemon = True
+        self.backend = backend
+        self.interval = interval
+        self.stopping = threading.Event()
+
+    def run(self):
+        while not self.stopping.wait(self.interval):
+            self.sweep()
+
+    def stop(self):
+        self.stopping.set()
+        if self.is_alive():
+            self.join()
+
+    def sweep(self):
+        """Run each cleanup operation once, returning the counts."""
+        counts = {}
+        for name, description in SWEEP_OPERATIONS:
+            operation = getattr(self.backend, name, None)
+            if operation is None:
+                continue
+            try:
+                count = operation()
+            except NotImplementedError:
+                continue
+            except Exception:
+                logger.exception("sweeper failed to delete %s", description)
+                continue
+            if count:
+                logger.info("sweeper deleted %d %s", count, description)
+            counts[name] = count
+        return counts
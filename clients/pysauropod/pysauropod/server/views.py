@@ -9,23 +9,73 @@ Views for Sauropod Web-API server.
 
 import json
 from urllib import quote as urlquote
+from base64 import b64encode, b64decode
 
+from pyramid.events import subscriber, NewResponse
+from pyramid.view import view_config
+from pyramid.interfaces import IAuthorizationPolicy
 from pyramid.response import Response
 from pyramid.httpexceptions import (HTTPNoContent, HTTPNotFound,
+                                    HTTPNotModified,
                                     HTTPForbidden, HTTPBadRequest,
-                                    HTTPPreconditionFailed)
+                                    HTTPPreconditionFailed,
+                                    HTTPRequestEntityTooLarge,
+                                    HTTPNotImplemented, HTTPGone,
+                                    HTTPServiceUnavailable)
 
 from cornice import Service
 
-from pysauropod.errors import ConflictError
+from pysauropod.errors import (ConflictError, QuotaExceededError,
+                               ResyncRequiredError, ServerBusyError)
 from pysauropod.interfaces import ISauropodBackend
+from pysauropod.notify import watch_key, watch_changes
 from pysauropod.server.session import ISessionManager
+from pysauropod.server.metrics import IMetricsRegistry
+from pysauropod.server.security import OperationContext
+from pysauropod.server.compression import compress_response, decode_etag
 from pysauropod.server.credentials import ICredentialsManager
 
 
 start_session = Service(name="start_session", path="/session/start")
 keys = Service(name="keys", path="/app/{appid}/users/{userid}/keys/")
 key = Service(name="key", path="/app/{appid}/users/{userid}/keys/{key}")
+stats = Service(name="stats", path="/app/{appid}/users/{userid}/stats")
+changes = Service(name="changes", path="/app/{appid}/users/{userid}/changes")
+user = Service(name="user", path="/users/{userid}")
+metrics = Service(name="metrics", path="/metrics")
+batch = Service(name="batch", path="/batch")
+
+# Optional protocol features supported by this server, which are advertised
+# to clients in the X-Sauropod-Features header of every response.
+#
+#   raw-values:  the key service accepts and returns values as raw
+#                application/octet-stream bodies, on request.
+#   batch:       several operations can be sent in one request to /batch.
+#   ttl:         keys can be set with a TTL in the X-Sauropod-TTL header,
+#                or the "ttl" of a batched set, after which they expire.
+#
+FEATURES = ["raw-values", "batch", "ttl"]
+
+# Permission needed for each type of operation in a batch request.
+BATCH_PERMISSIONS = {"get": "get-key", "set": "set-key", "delete": "del-key"}
+
+# Representations of an item that can be returned by the key service.
+# JSON comes first so that it's used unless the client asks for raw bytes.
+ITEM_CONTENT_TYPES = ["application/json", "application/octet-stream"]
+
+
+@subscriber(NewResponse)
+def advertise_features(event):
+    """Add the X-Sauropod-Features header to every response."""
+    event.response.headers["X-Sauropod-Features"] = " ".join(FEATURES)
+
+
+@view_config(context=ServerBusyError)
+def server_busy(exc, request):
+    """Ask the client to back off when the backend is overloaded."""
+    r = HTTPServiceUnavailable()
+    r.headers["Retry-After"] = str(exc.retry_after or 1)
+    return r
 
 
 @start_session.post()
@@ -70,7 +120,20 @@ def list_keys(request):
     keys = store.listkeys(appid, userid, start, end, limit)
     response = "\n".join(urlquote(key) for key in keys)
     r = Response(response, content_type="application/newlines")
-    return r
+    return compress_response(request, r)
+
+
+@keys.delete(permission="del-key")
+def delete_keys(request):
+    """Delete all keys for the given user.
+
+    You must have a valid session and be authenticated as the target user.
+    """
+    appid = request.matchdict["appid"].encode("utf8")
+    userid = request.matchdict["userid"].encode("utf8")
+    store = request.registry.getUtility(ISauropodBackend)
+    store.delete_bucket(appid, userid)
+    return HTTPNoContent()
 
 
 @key.get(permission="get-key")
@@ -78,19 +141,39 @@ def get_key(request):
     """Get the value of a key.
 
     You must have a valid session and be authenticated as the target user.
+
+    If the "wait" parameter is given, the request is held for up to that
+    many seconds until the item's etag differs from the one given in the
+    If-None-Match header, returning 304 Not Modified if it doesn't.
+
+    The item is returned as a JSON dict, unless the Accept header prefers
+    application/octet-stream in which case the raw value is returned.  In
+    JSON, values that aren't valid UTF-8 are base64-encoded and the dict
+    has an "encoding" of "base64".
     """
     appid = request.matchdict["appid"].encode("utf8")
     userid = request.matchdict["userid"].encode("utf8")
     key = request.matchdict["key"].encode("utf8")
     store = request.registry.getUtility(ISauropodBackend)
+    wait = _get_wait(request)
     try:
-        item = store.getitem(appid, userid, key)
+        if wait:
+            etag = decode_etag(request.headers.get("If-None-Match", None))
+            item = watch_key(store, appid, userid, key, etag, wait)
+            if item is None:
+                raise HTTPNotModified()
+        else:
+            item = store.getitem(appid, userid, key)
     except KeyError:
         raise HTTPNotFound()
-    r = Response(_item_to_json(item), content_type="application/json")
+    offers = request.accept.acceptable_offers(ITEM_CONTENT_TYPES)
+    if offers and offers[0][0] == "application/octet-stream":
+        r = Response(item.value, content_type="application/octet-stream")
+    else:
+        r = Response(_item_to_json(item), content_type="application/json")
     if item.etag:
         r.headers["ETag"] = item.etag
-    return r
+    return compress_response(request, r)
 
 
 @key.put(permission="set-key")
@@ -98,19 +181,36 @@ def set_key(request):
     """Update the value of a key.
 
     You must have a valid session and be authenticated as the target user.
+
+    The value is taken from the "value" field of a form-encoded body, or is
+    the entire body if it has type application/octet-stream.  If there is
+    an X-Sauropod-TTL header then the key expires after that many seconds.
     """
     appid = request.matchdict["appid"].encode("utf8")
     userid = request.matchdict["userid"].encode("utf8")
     key = request.matchdict["key"].encode("utf8")
     store = request.registry.getUtility(ISauropodBackend)
-    value = request.POST.get("value")
-    if value is None:
-        raise HTTPBadRequest("mising value")
+    if request.content_type == "application/octet-stream":
+        value = request.body
+    else:
+        value = request.POST.get("value")
+        if value is None:
+            raise HTTPBadRequest("mising value")
+        value = value.encode("utf8")
     if_match = _get_if_match(request)
     try:
-        item = store.set(appid, userid, key, value, if_match=if_match)
+        ttl = _parse_ttl(request.headers.get("X-Sauropod-TTL"))
+    except ValueError:
+        raise HTTPBadRequest("invalid ttl")
+    try:
+        item = store.set(appid, userid, key, value, if_match=if_match,
+                         ttl=ttl)
     except ConflictError:
         raise HTTPPreconditionFailed()
+    except QuotaExceededError, e:
+        raise HTTPRequestEntityTooLarge(str(e))
+    except NotImplementedError:
+        raise HTTPNotImplemented()
     r = HTTPNoContent()
     if item.etag:
         r.headers["ETag"] = item.etag
@@ -137,15 +237,244 @@ def delete_key(request):
     return HTTPNoContent()
 
 
+@stats.get(permission="get-key")
+def get_stats(request):
+    """Get the usage counters for the given user.
+
+    You must have a valid session and be authenticated as the target user.
+    """
+    appid = request.matchdict["appid"].encode("utf8")
+    userid = request.matchdict["userid"].encode("utf8")
+    store = request.registry.getUtility(ISauropodBackend)
+    try:
+        stats = store.getstats(appid, userid)
+    except NotImplementedError:
+        raise HTTPNotImplemented()
+    return Response(json.dumps(stats), content_type="application/json")
+
+
+@changes.get(permission="get-key")
+def get_changes(request):
+    """Get the changes made to the given user's keys since a sequence number.
+
+    You must have a valid session and be authenticated as the target user.
+
+    If the "wait" parameter is given and there are no changes, the request
+    is held for up to that many seconds until some arrive.
+
+    Values are encoded as in the JSON representation of an item.
+    """
+    appid = request.matchdict["appid"].encode("utf8")
+    userid = request.matchdict["userid"].encode("utf8")
+    try:
+        since = int(request.GET.get("since", 0))
+        limit = request.GET.get("limit", None)
+        if limit:
+            limit = int(limit)
+    except ValueError:
+        raise HTTPBadRequest()
+    wait = _get_wait(request)
+    store = request.registry.getUtility(ISauropodBackend)
+    try:
+        if wait:
+            changes = watch_changes(store, appid, userid, since, limit, wait)
+        else:
+            changes = store.changes(appid, userid, since, limit)
+    except ResyncRequiredError, e:
+        raise HTTPGone(str(e))
+    except NotImplementedError:
+        raise HTTPNotImplemented()
+    data = []
+    for change in changes:
+        if change.deleted:
+            data.append({"seq": change.seq, "key": change.key,
+                         "deleted": True})
+        else:
+            value, encoding = _json_value(change.item.value)
+            entry = {"seq": change.seq, "key": change.key, "value": value,
+                     "etag": change.item.etag}
+            if encoding is not None:
+                entry["encoding"] = encoding
+            data.append(entry)
+    r = Response(json.dumps({"changes": data}),
+                 content_type="application/json")
+    return compress_response(request, r)
+
+
+@batch.post(permission="valid-app")
+def run_batch(request):
+    """Perform an ordered list of get, set and delete operations.
+
+    The body must be a JSON dict whose "operations" entry is a list of dicts,
+    each giving the "op" to perform along with the "appid", "userid" and
+    "key" to which it applies, plus the "value" for a set and an optional
+    "if_match" etag.  Sets may also give a "ttl" in seconds, and an
+    "encoding" of "base64" if the value is base64-encoded.  Each operation
+    is checked against the same permissions as the corresponding request on
+    that key.
+
+    The response is a JSON dict whose "results" entry gives the outcome of
+    each operation in order, as a dict with the HTTP "status" it would have
+    had plus the "value" and/or "etag" of the item where relevant.  Values
+    are encoded as in the JSON representation of an item.
+
+    Operations are performed in order, but runs of consecutive gets are
+    grouped by bucket and fetched with a single backend call per bucket.
+    """
+    settings = request.registry.settings
+    max_operations = int(settings.get("sauropod.batch.max_operations", 100))
+    try:
+        operations = json.loads(request.body)["operations"]
+        if not isinstance(operations, list):
+            raise ValueError("operations must be a list")
+    except (ValueError, KeyError, TypeError):
+        raise HTTPBadRequest("invalid batch")
+    if len(operations) > max_operations:
+        raise HTTPRequestEntityTooLarge("too many operations")
+    # Check all the operations before performing any of them, so that a
+    # malformed batch is rejected without having been partly applied.
+    policy = request.registry.getUtility(IAuthorizationPolicy)
+    principals = request.effective_principals
+    checked = []
+    for operation in operations:
+        try:
+            op = operation["op"]
+            args = [operation["appid"], operation["userid"], operation["key"]]
+            if op == "set":
+                args.append(operation["value"])
+            if_match = operation.get("if_match")
+            for arg in args + [if_match or ""]:
+                if not isinstance(arg, basestring):
+                    raise TypeError(arg)
+            ttl = _parse_ttl(operation.get("ttl"))
+            context = OperationContext(request, args[0], args[1])
+            allowed = policy.permits(context, principals,
+                                     BATCH_PERMISSIONS[op])
+            args = [arg.encode("utf8") for arg in args]
+            if op == "set" and operation.get("encoding") == "base64":
+                args[3] = b64decode(args[3])
+        except (KeyError, TypeError, ValueError, AttributeError):
+            raise HTTPBadRequest("invalid operation")
+        checked.append((allowed, op, args, if_match, ttl))
+    store = request.registry.getUtility(ISauropodBackend)
+    results = []
+    gets = []
+    for allowed, op, args, if_match, ttl in checked:
+        if not allowed:
+            result = {"status": 403}
+        elif op == "get":
+            # Gets are deferred until the next write, to group them together.
+            # The result dict is filled in once they've been fetched.
+            result = {}
+            gets.append((args, result))
+        else:
+            _run_batch_gets(store, gets)
+            gets = []
+            result = _run_batch_write(store, op, args, if_match, ttl)
+        results.append(result)
+    _run_batch_gets(store, gets)
+    r = Response(json.dumps({"results": results}),
+                 content_type="application/json")
+    return compress_response(request, r)
+
+
+def _run_batch_gets(store, gets):
+    """Fetch the items for a run of gets from a batch, by bucket."""
+    buckets = {}
+    for (appid, userid, key), result in gets:
+        buckets.setdefault((appid, userid), []).append((key, result))
+    for (appid, userid), requests in buckets.iteritems():
+        items = store.getitems(appid, userid, [key for key, _ in requests])
+        for key, result in requests:
+            item = items.get(key)
+            if item is None:
+                result["status"] = 404
+            else:
+                result["status"] = 200
+                result["value"], encoding = _json_value(item.value)
+                if encoding is not None:
+                    result["encoding"] = encoding
+                result["etag"] = item.etag
+
+
+def _run_batch_write(store, op, args, if_match, ttl=None):
+    """Perform a set or delete from a batch, returning its result dict."""
+    try:
+        if op == "delete":
+            store.delete(*args, if_match=if_match)
+            return {"status": 204}
+        item = store.set(*args, if_match=if_match, ttl=ttl)
+        return {"status": 204, "etag": item.etag}
+    except KeyError:
+        return {"status": 404}
+    except ConflictError:
+        return {"status": 412}
+    except QuotaExceededError, e:
+        return {"status": 413, "error": str(e)}
+    except NotImplementedError:
+        return {"status": 501}
+
+
+@user.delete(permission="del-user")
+def delete_user(request):
+    """Delete all keys for the given user, across all applications.
+
+    You must have a valid session, be authenticated as the target user, and
+    be using an application that is trusted to administer user accounts.
+    """
+    userid = request.matchdict["userid"].encode("utf8")
+    store = request.registry.getUtility(ISauropodBackend)
+    store.delete_user(userid)
+    return HTTPNoContent()
+
+
+@metrics.get(permission="admin")
+def get_metrics(request):
+    """Get request and backend timing metrics, in Prometheus text format.
+
+    You must have a valid session from one of the admin applications.
+    """
+    registry = request.registry.getUtility(IMetricsRegistry)
+    r = Response(registry.render(), content_type="text/plain")
+    r.headers["Content-Type"] = "text/plain; version=0.0.4"
+    return r
+
+
+_encode_json = json.JSONEncoder().encode
+
+
 def _item_to_json(item):
-    """Render an Item as a json dict."""
-    data = {}
-    data["key"] = item.key
-    data["value"] = item.value
-    data["user"] = item.userid
-    data["bucket"] = item.appid
-    data["timestamp"] = 0
-    return json.dumps(data)
+    """Render an Item as a json dict.
+
+    This is done for every read, so the dict is formatted directly rather
+    than building one to pass to json.dumps().
+    """
+    value, encoding = _json_value(item.value)
+    if encoding is None:
+        encoding = ""
+    else:
+        encoding = ' "encoding": %s,' % (_encode_json(encoding),)
+    return '{"key": %s, "value": %s,%s "user": %s, "bucket": %s,'\
+           ' "timestamp": 0}' % (_encode_json(item.key),
+                                 _encode_json(value), encoding,
+                                 _encode_json(item.userid),
+                                 _encode_json(item.appid))
+
+
+def _json_value(value):
+    """Get a value in a form that can be sent as a JSON string.
+
+    JSON strings can only hold text, so values that aren't valid UTF-8 are
+    base64-encoded.  This returns the value along with the encoding used,
+    which is None if it can be sent as-is.
+    """
+    if isinstance(value, unicode):
+        return value, None
+    try:
+        value.decode("utf8")
+    except UnicodeDecodeError:
+        return b64encode(value), "base64"
+    return value, None
 
 
 def _get_if_match(request):
@@ -159,4 +488,31 @@ def _get_if_match(request):
                 # Don't do that, OK?
                 raise HTTPBadRequest()
             if_match = ""
-    return if_match
+    return decode_etag(if_match)
+
+
+def _parse_ttl(value):
+    """Parse a TTL given in seconds, raising ValueError if it's invalid."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        raise ValueError(value)
+    ttl = int(value)
+    if ttl <= 0:
+        raise ValueError(value)
+    return ttl
+
+
+def _get_wait(request):
+    """Get the number of seconds for which to hold a watch request.
+
+    This is capped by the "sauropod.watch.max_wait" setting, so that a
+    client can't tie up a server thread indefinitely.
+    """
+    try:
+        wait = int(request.GET.get("wait", 0))
+    except ValueError:
+        raise HTTPBadRequest()
+    max_wait = int(request.registry.settings.get("sauropod.watch.max_wait",
+                                                 60))
+    return max(0, min(wait, max_wait))
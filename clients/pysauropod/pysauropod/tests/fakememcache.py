@@ -0,0 +1,136 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+"""
+
+In-process stand-in for a memcached server, for testing purposes.
+
+This module implements the get, gets, set, add, cas and delete commands of
+the memcached text protocol on top of a dict, served over a real socket so
+that the caching backend can be tested end-to-end without a memcached
+server.
+
+"""
+
+import time
+import itertools
+import threading
+import SocketServer
+
+
+class FakeMemcacheHandler(SocketServer.StreamRequestHandler):
+    """Handle the commands sent over a single client connection."""
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            args = line.split()
+            if not args:
+                continue
+            command = "do_" + args[0]
+            if not hasattr(self, command):
+                self.wfile.write("ERROR\r\n")
+                continue
+            getattr(self, command)(*args[1:])
+            self.wfile.flush()
+
+    def do_get(self, *keys):
+        self._retrieve(keys, with_cas=False)
+
+    def do_gets(self, *keys):
+        self._retrieve(keys, with_cas=True)
+
+    def _retrieve(self, keys, with_cas):
+        with self.server.lock:
+            for key in keys:
+                entry = self._live_entry(key)
+                if entry is None:
+                    continue
+                flags, expires, value, cas_id = entry
+                header = "VALUE %s %d %d" % (key, flags, len(value))
+                if with_cas:
+                    header += " %d" % (cas_id,)
+                self.wfile.write("%s\r\n%s\r\n" % (header, value))
+        self.wfile.write("END\r\n")
+
+    def do_set(self, key, flags, exptime, size):
+        value = self._read_value(size)
+        with self.server.lock:
+            self.server.data[key] = self._entry(flags, exptime, value)
+        self.wfile.write("STORED\r\n")
+
+    def do_add(self, key, flags, exptime, size):
+        value = self._read_value(size)
+        with self.server.lock:
+            if self._live_entry(key) is not None:
+                self.wfile.write("NOT_STORED\r\n")
+                return
+            self.server.data[key] = self._entry(flags, exptime, value)
+        self.wfile.write("STORED\r\n")
+
+    def do_cas(self, key, flags, exptime, size, cas_id):
+        value = self._read_value(size)
+        with self.server.lock:
+            entry = self._live_entry(key)
+            if entry is None:
+                self.wfile.write("NOT_FOUND\r\n")
+                return
+            if entry[3] != int(cas_id):
+                self.wfile.write("EXISTS\r\n")
+                return
+            self.server.data[key] = self._entry(flags, exptime, value)
+        self.wfile.write("STORED\r\n")
+
+    def do_delete(self, key):
+        with self.server.lock:
+            if self.server.data.pop(key, None) is None:
+                self.wfile.write("NOT_FOUND\r\n")
+            else:
+                self.wfile.write("DELETED\r\n")
+
+    def _read_value(self, size):
+        return self.rfile.read(int(size) + 2)[:-2]
+
+    def _live_entry(self, key):
+        """Get the unexpired entry for a key, or None.  Call under the lock."""
+        entry = self.server.data.get(key)
+        if entry is not None and entry[1] and entry[1] <= time.time():
+            del self.server.data[key]
+            entry = None
+        return entry
+
+    def _entry(self, flags, exptime, value):
+        exptime = int(exptime)
+        expires = time.time() + exptime if exptime else 0
+        return (int(flags), expires, value, next(self.server.cas_ids))
+
+
+class FakeMemcacheServer(SocketServer.ThreadingTCPServer):
+    """Memcached stand-in listening on localhost, storing data in a dict.
+
+    Call start() to serve in a background thread, and stop() when done.
+    The "address" attribute gives the "host:port" to connect to.
+    """
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.ThreadingTCPServer.__init__(self, ("localhost", 0),
+                                                 FakeMemcacheHandler)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.cas_ids = itertools.count(1)
+        self.address = "%s:%d" % self.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
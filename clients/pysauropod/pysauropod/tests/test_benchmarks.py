@@ -0,0 +1,47 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+import subprocess
+
+from pysauropod.benchmarks import (Benchmark, summarize, compare_results,
+                                   run_benchmarks)
+from pysauropod.benchmarks.imports import python_command
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def test_summarize(self):
+        result = summarize([0.001] * 98 + [0.1, 0.2])
+        self.assertEquals(result["iterations"], 100)
+        self.assertAlmostEquals(result["p50_ms"], 1.0)
+        self.assertAlmostEquals(result["p99_ms"], 100.0)
+        self.assertAlmostEquals(result["ops_per_sec"], 100 / 0.398)
+
+    def test_prepare_is_not_timed(self):
+        calls = []
+        benchmark = Benchmark("test", calls.append,
+                              prepare=lambda i: calls.append(-i))
+        result = run_benchmarks([benchmark], duration=0)["test"]
+        self.assertEquals(len(calls), (result["iterations"] + 10) * 2)
+        self.assertEquals(calls[:4], [0, 0, -1, 1])
+
+    def test_compare_results(self):
+        baseline = {"a": {"ops_per_sec": 100.0},
+                    "b": {"ops_per_sec": 100.0},
+                    "c": {"ops_per_sec": 100.0}}
+        results = {"a": {"ops_per_sec": 95.0},
+                   "b": {"ops_per_sec": 50.0},
+                   "d": {"ops_per_sec": 1.0}}
+        self.assertEquals(compare_results(results, baseline, 0.1),
+                          [("b", 100.0, 50.0)])
+
+    def test_importing_pysauropod_is_lazy(self):
+        code = "import sys, pysauropod; print ' '.join(sys.modules)"
+        output = subprocess.check_output(python_command(code))
+        modules = set(output.split())
+        self.assertTrue("pysauropod" in modules)
+        for name in ("requests", "vep", "mozsvc", "sqlalchemy",
+                     "pysauropod.backends.sql"):
+            self.assertFalse(name in modules, name)
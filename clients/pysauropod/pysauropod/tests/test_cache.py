@@ -0,0 +1,240 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import logging
+import unittest
+
+from pysauropod import DirectConnection
+from pysauropod.errors import ConflictError
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.backends.cache import CachingBackend
+from pysauropod.server.metrics import MetricsRegistry
+from pysauropod.tests.test_connection import SauropodConnectionTests
+from pysauropod.tests.fakememcache import FakeMemcacheServer
+
+
+class CachingBackendTests(SauropodConnectionTests):
+    """Tests to run against a CachingBackend with each kind of cache.
+
+    Concrete subclasses must override _make_backend() to wrap the given
+    backend in a CachingBackend.  All the usual connection tests are run
+    through a single shared CachingBackend.
+    """
+
+    def setUp(self):
+        self.sql = SQLBackend("sqlite:////tmp/sauropod.db",
+                              create_tables=True)
+        self.backend = self._make_backend(self.sql, negative_ttl=1)
+
+    def tearDown(self):
+        self.backend.close()
+        try:
+            os.unlink("/tmp/sauropod.db")
+        except EnvironmentError:
+            pass
+
+    def _get_store(self, appid):
+        return DirectConnection(self.backend, appid, "vep:DummyVerifier")
+
+    def test_reads_are_cached(self):
+        self.backend.set("APPID", "test@example.com", "hello", "world")
+        for _ in xrange(3):
+            item = self.backend.getitem("APPID", "test@example.com", "hello")
+            self.assertEquals(item.value, "world")
+        stats = self.backend.cache_stats
+        self.assertEquals((stats.hits, stats.misses), (3, 0))
+        # Writes made behind the cache's back aren't seen.
+        self.sql.set("APPID", "test@example.com", "hello", "there")
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "world")
+        # Unless a conditional write shows that the cached etag is stale.
+        self.assertRaises(ConflictError, self.backend.set, "APPID",
+                          "test@example.com", "hello", "X", item.etag)
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "there")
+        self.assertEquals((stats.hits, stats.misses), (4, 1))
+        self.assertEquals(stats.hit_ratio, 0.8)
+
+    def test_missing_keys_are_cached_briefly(self):
+        self.assertRaises(KeyError, self.backend.getitem, "APPID",
+                          "test@example.com", "hello")
+        self.sql.set("APPID", "test@example.com", "hello", "world")
+        self.assertRaises(KeyError, self.backend.getitem, "APPID",
+                          "test@example.com", "hello")
+        self.assertEquals(self.backend.cache_stats.negative_hits, 1)
+        time.sleep(1.1)
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "world")
+
+    def test_late_fills_dont_undo_invalidation(self):
+        self.backend.cache_max_item_size = 10
+        self.sql.set("APPID", "test@example.com", "hello", "world")
+        # Start a read through the cache, which misses.
+        cache = self.backend.cache
+        found, token = cache.get_many("APPID", "test@example.com", ["hello"])
+        self.assertEquals(found, {})
+        old_item = self.sql.getitem("APPID", "test@example.com", "hello")
+        # A value too large to cache is written while the read is running.
+        self.backend.set("APPID", "test@example.com", "hello", "X" * 11)
+        cache.fill("APPID", "test@example.com", {"hello": old_item}, 60,
+                   token)
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "X" * 11)
+        # Likewise after a conditional write shows the cached etag is stale.
+        self.sql.set("APPID", "test@example.com", "hello", "there")
+        self.assertRaises(ConflictError, self.backend.set, "APPID",
+                          "test@example.com", "hello", "X", "badetag")
+        cache.fill("APPID", "test@example.com", {"hello": old_item}, 60,
+                   token)
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "there")
+        self.assertEquals(self.backend.cache_stats.hits, 0)
+
+    def test_getitems_uses_the_cache(self):
+        self.backend.set("APPID", "test@example.com", "a", "1")
+        self.sql.set("APPID", "test@example.com", "b", "2")
+        items = self.backend.getitems("APPID", "test@example.com",
+                                      ["a", "b", "c"])
+        self.assertEquals(sorted(items), ["a", "b"])
+        stats = self.backend.cache_stats
+        self.assertEquals((stats.hits, stats.misses), (1, 2))
+        items = self.backend.getitems("APPID", "test@example.com",
+                                      ["a", "b", "c"])
+        self.assertEquals(sorted(items), ["a", "b"])
+        self.assertEquals((stats.hits, stats.negative_hits), (3, 1))
+
+    def test_deleting_users_purges_the_cache(self):
+        self.backend.set("APP1", "test@example.com", "hello", "world")
+        self.backend.set("APP2", "test@example.com", "hello", "world")
+        self.backend.delete_bucket("APP1", "test@example.com")
+        self.assertRaises(KeyError, self.backend.getitem, "APP1",
+                          "test@example.com", "hello")
+        self.backend.getitem("APP2", "test@example.com", "hello")
+        self.backend.delete_user("test@example.com")
+        self.assertRaises(KeyError, self.backend.getitem, "APP2",
+                          "test@example.com", "hello")
+
+    def test_hit_counts_are_reported_as_metrics(self):
+        metrics = MetricsRegistry()
+        metrics.add_source("sauropod_cache_lookups_total", "Cache lookups.",
+                           self.backend.cache_stats.collect)
+        self.backend.set("APPID", "test@example.com", "hello", "world")
+        self.backend.getitem("APPID", "test@example.com", "hello")
+        lines = metrics.render().splitlines()
+        self.assertTrue('sauropod_cache_lookups_total{result="hit"} 1'
+                        in lines)
+        self.assertTrue('sauropod_cache_lookups_total{result="miss"} 0'
+                        in lines)
+
+
+class TestLRUCache(unittest.TestCase, CachingBackendTests):
+
+    setUp = CachingBackendTests.setUp
+    tearDown = CachingBackendTests.tearDown
+
+    def _make_backend(self, backend, **kwds):
+        return CachingBackend(backend, cache_size=10, **kwds)
+
+    def test_cache_size_is_bounded(self):
+        for i in xrange(20):
+            self.backend.set("APPID", "test@example.com", str(i), "value")
+        self.assertEquals(len(self.backend.cache._entries), 10)
+        for i in xrange(20):
+            self.backend.getitem("APPID", "test@example.com", str(i))
+        stats = self.backend.cache_stats
+        self.assertEquals((stats.hits, stats.misses), (0, 20))
+
+    def test_loading_from_settings(self):
+        backend = CachingBackend(sqluri="sqlite:////tmp/sauropod.db",
+                                 cache_size="5", cache_ttl="0")
+        self.assertTrue(isinstance(backend.backend, SQLBackend))
+        self.assertEquals(backend.cache.size, 5)
+        self.assertEquals(backend.max_connections, None)
+        backend.close()
+
+
+class TestMemcacheCache(unittest.TestCase, CachingBackendTests):
+
+    def setUp(self):
+        self.memcache = FakeMemcacheServer()
+        self.memcache.start()
+        CachingBackendTests.setUp(self)
+
+    def tearDown(self):
+        CachingBackendTests.tearDown(self)
+        self.memcache.stop()
+
+    def _make_backend(self, backend, **kwds):
+        return CachingBackend(backend, cache_servers=self.memcache.address,
+                              **kwds)
+
+    def test_cache_is_shared_between_processes(self):
+        other = self._make_backend(self.sql)
+        self.backend.set("APPID", "test@example.com", "hello", "world")
+        self.assertEquals(other.getitem("APPID", "test@example.com",
+                                        "hello").value, "world")
+        self.assertEquals(other.cache_stats.hits, 1)
+        other.set("APPID", "test@example.com", "hello", "there")
+        self.assertEquals(self.backend.getitem("APPID", "test@example.com",
+                                               "hello").value, "there")
+        other.delete_user("test@example.com")
+        self.assertRaises(KeyError, self.backend.getitem, "APPID",
+                          "test@example.com", "hello")
+        other.close()
+
+    def test_writes_from_other_processes_are_ordered(self):
+        other = self._make_backend(self.sql)
+        cache = self.backend.cache
+        with cache.write_lock("APPID", "test@example.com", "hello") as lease:
+            self.assertNotEquals(lease, None)
+            item = self.sql.set("APPID", "test@example.com", "hello", "mine")
+            # Another process writes the key before this one can cache it.
+            other.set("APPID", "test@example.com", "hello", "theirs")
+            cache.store("APPID", "test@example.com", "hello", item, 60,
+                        lease)
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "theirs")
+        self.assertEquals(self.backend.cache_stats.hits, 0)
+        # Once the lock is released, writes are cached again.
+        other.set("APPID", "test@example.com", "hello", "again")
+        item = self.backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "again")
+        self.assertEquals(self.backend.cache_stats.hits, 1)
+        other.close()
+
+    def test_generation_tokens_are_retried_a_few_times(self):
+        client = self.backend.cache.client
+        calls = []
+
+        def add(key, *args):
+            calls.append(key)
+            return False
+
+        client.add = add
+        logger = logging.getLogger("pysauropod.backends.cache")
+        logger.disabled = True
+        try:
+            self.backend.set("APPID", "test@example.com", "hello", "world")
+            item = self.backend.getitem("APPID", "test@example.com", "hello")
+        finally:
+            logger.disabled = False
+        self.assertEquals(item.value, "world")
+        self.assertTrue(0 < len(calls) <= 10, calls)
+
+    def test_memcache_errors_fall_back_to_the_backend(self):
+        self.backend.set("APPID", "test@example.com", "hello", "world")
+        self.memcache.stop()
+        logger = logging.getLogger("pysauropod.backends.cache")
+        logger.disabled = True
+        try:
+            self.backend.cache.client.close()
+            item = self.backend.getitem("APPID", "test@example.com", "hello")
+            self.assertEquals(item.value, "world")
+            self.backend.set("APPID", "test@example.com", "hello", "there")
+        finally:
+            logger.disabled = False
+        self.memcache = FakeMemcacheServer()
+        self.memcache.start()
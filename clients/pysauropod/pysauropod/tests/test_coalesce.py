@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import unittest
+import threading
+
+from pysauropod import DirectConnection
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.backends.coalesce import CoalescingBackend
+from pysauropod.tests.test_connection import SauropodConnectionTests
+
+
+class GatedSQLBackend(SQLBackend):
+    """SQLBackend whose reads wait for the test to let them through."""
+
+    def __init__(self, *args, **kwds):
+        super(GatedSQLBackend, self).__init__(*args, **kwds)
+        self.gate = threading.Event()
+        self.gate.set()
+        self.reads = 0
+
+    def getitem(self, appid, userid, key, connection=None):
+        self.reads += 1
+        self.gate.wait()
+        return super(GatedSQLBackend, self).getitem(appid, userid, key,
+                                                    connection)
+
+
+class TestCoalescingBackend(unittest.TestCase, SauropodConnectionTests):
+
+    def setUp(self):
+        self.sql = GatedSQLBackend("sqlite:////tmp/sauropod.db",
+                                   create_tables=True)
+        self.backend = CoalescingBackend(self.sql)
+
+    def tearDown(self):
+        self.sql.gate.set()
+        self.backend.close()
+        try:
+            os.unlink("/tmp/sauropod.db")
+        except EnvironmentError:
+            pass
+
+    def _get_store(self, appid):
+        return DirectConnection(self.backend, appid, "vep:DummyVerifier")
+
+    def _start_reads(self, count, key="hello"):
+        """Start reads of a key in threads, returning their outcomes."""
+        results = []
+
+        def read():
+            try:
+                results.append(self.backend.getitem("APPID", "alice", key))
+            except Exception, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=read) for _ in xrange(count)]
+        for thread in threads:
+            thread.start()
+        # Give them all a chance to join the first one's read.
+        time.sleep(0.1)
+        return threads, results
+
+    def test_concurrent_reads_are_shared(self):
+        self.backend.set("APPID", "alice", "hello", "world")
+        self.sql.gate.clear()
+        threads, results = self._start_reads(5)
+        self.sql.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals([item.value for item in results], ["world"] * 5)
+        self.assertEquals(self.sql.reads, 1)
+        stats = self.backend.coalesce_stats
+        self.assertEquals((stats.issued, stats.shared), (1, 4))
+        # Once it's finished, the next read goes to the backend.
+        self.backend.getitem("APPID", "alice", "hello")
+        self.assertEquals(self.sql.reads, 2)
+
+    def test_errors_are_shared(self):
+        self.sql.gate.clear()
+        threads, results = self._start_reads(3, "missing")
+        self.sql.gate.set()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(results), 3)
+        for result in results:
+            self.assertTrue(isinstance(result, KeyError))
+        self.assertEquals(self.sql.reads, 1)
+
+    def test_reads_after_a_write_are_not_shared(self):
+        self.backend.set("APPID", "alice", "hello", "world")
+        self.sql.gate.clear()
+        threads, results = self._start_reads(2)
+        self.backend.set("APPID", "alice", "hello", "there")
+        later_threads, later_results = self._start_reads(2)
+        self.assertEquals(self.sql.reads, 2)
+        self.sql.gate.set()
+        for thread in threads + later_threads:
+            thread.join()
+        # The reads that started before the write was made may see either
+        # value, but those started after it must see the new one.
+        self.assertEquals([item.value for item in later_results],
+                          ["there"] * 2)
+        self.sql.gate.clear()
+        threads, results = self._start_reads(2)
+        self.backend.delete_bucket("APPID", "alice")
+        later_threads, later_results = self._start_reads(1)
+        self.sql.gate.set()
+        for thread in threads + later_threads:
+            thread.join()
+        self.assertTrue(isinstance(later_results[0], KeyError))
@@ -3,15 +3,20 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import os
+import json
+import time
 import unittest
 import threading
 import logging
+import SocketServer
 import wsgiref.simple_server
 
 from pyramid import testing
 from pyramid.httpexceptions import HTTPException
 
-from pysauropod.errors import ConflictError, AuthenticationError
+from pysauropod.errors import (ConflictError, AuthenticationError,
+                               QuotaExceededError, ResyncRequiredError,
+                               ServerError)
 from pysauropod import connect
 
 import vep
@@ -39,6 +44,16 @@ class SilentWSGIRequestHandler(wsgiref.simple_server.WSGIRequestHandler):
         pass
 
 
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn,
+                          wsgiref.simple_server.WSGIServer):
+    """WSGIServer that handles each request in a new thread.
+
+    This lets the tests make concurrent requests, e.g. to wake up a watch
+    request that is being held open by the server.
+    """
+    daemon_threads = True
+
+
 class TestingServer(object):
     """Class to spin up a local WSGI server for testing purposes.
 
@@ -46,16 +61,18 @@ class TestingServer(object):
     for testing HTTP-based API.
     """
 
-    def __init__(self, app):
+    def __init__(self, app, port=8080):
         self.app = app
+        self.port = port
 
     def start(self):
-        args = ("localhost", 8080, self.app)
-        kwds = {"handler_class": SilentWSGIRequestHandler}
+        args = ("localhost", self.port, self.app)
+        kwds = {"handler_class": SilentWSGIRequestHandler,
+                "server_class": ThreadingWSGIServer}
         self.server = wsgiref.simple_server.make_server(*args, **kwds)
         self.runthread = threading.Thread(target=self.run)
         self.runthread.start()
-        self.base_url = "http://localhost:8080"
+        self.base_url = "http://localhost:%d" % (self.port,)
 
     def run(self):
         """Run the server in a background thread."""
@@ -64,6 +81,7 @@ class TestingServer(object):
     def shutdown(self):
         """Explicitly shut down the server."""
         self.server.shutdown()
+        self.server.server_close()
         self.runthread.join()
         del self.server
         del self.runthread
@@ -129,6 +147,169 @@ class SauropodConnectionTests(object):
         s.delete("hello", if_match=item2.etag)
         self.assertRaises(KeyError, s.get, "hello")
 
+    def test_batch(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        with s.batch() as b:
+            b.get("hello")
+            b.get("missing")
+            b.set("hi", "there", if_match="")
+            b.set("hello", "again", if_match="badetag")
+            b.get("hi")
+            b.delete("hello")
+            b.get("hello")
+        results = b.results
+        self.assertEquals(len(results), 7)
+        self.assertEquals(results[0].value, "world")
+        self.assertEquals(results[0].etag, s.set("x", "world").etag)
+        self.assertTrue(isinstance(results[1], KeyError))
+        self.assertEquals(results[2].etag, results[4].etag)
+        self.assertTrue(isinstance(results[3], ConflictError))
+        self.assertEquals(results[4].value, "there")
+        self.assertEquals(results[5], None)
+        self.assertTrue(isinstance(results[6], KeyError))
+        self.assertRaises(KeyError, s.get, "hello")
+        # Binary values can be set and read back.
+        s.set("binary", "\x00\xff\r\n")
+        with s.batch() as b:
+            b.get("binary")
+            b.set("binary2", "\xff\xfe")
+            b.get("binary2")
+        self.assertEquals(b.results[0].value, "\x00\xff\r\n")
+        self.assertEquals(b.results[2].value, "\xff\xfe")
+        self.assertEquals(s.get("binary2"), "\xff\xfe")
+        # Nothing is sent if the with-block fails.
+        try:
+            with s.batch() as b:
+                b.set("hi", "ho")
+                raise RuntimeError
+        except RuntimeError:
+            pass
+        self.assertEquals(b.results, None)
+        self.assertEquals(s.get("hi"), "there")
+
+    def test_expiring_keys(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("nonce", "value", ttl=1)
+        with s.batch() as b:
+            b.set("batched", "value", ttl=1)
+        s.set("kept", "value")
+        self.assertEquals(s.get("nonce"), "value")
+        self.assertEquals(s.get("batched"), "value")
+        time.sleep(2.05)
+        self.assertRaises(KeyError, s.get, "nonce")
+        self.assertRaises(KeyError, s.get, "batched")
+        self.assertEquals(s.get("kept"), "value")
+        # Expired keys can be written again as if they were missing.
+        s.set("nonce", "again", if_match="")
+        self.assertEquals(s.get("nonce"), "again")
+
+    def test_usage_stats(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertEquals(s.getstats(), {"items": 0, "bytes": 0})
+        s.set("hello", "world")
+        s.set("hi", "there")
+        self.assertEquals(s.getstats(), {"items": 2, "bytes": 17})
+        s.set("hello", "everybody")
+        self.assertEquals(s.getstats(), {"items": 2, "bytes": 21})
+        s.delete("hi")
+        self.assertEquals(s.getstats(), {"items": 1, "bytes": 14})
+        # A failed write doesn't change the counters.
+        self.assertRaises(ConflictError, s.set, "hi", "there", if_match="X")
+        self.assertEquals(s.getstats(), {"items": 1, "bytes": 14})
+        s.delete_bucket()
+        self.assertEquals(s.getstats(), {"items": 0, "bytes": 0})
+
+    def test_delete_bucket_and_user(self):
+        s1 = self._get_session("APPID", "test@example.com")
+        s2 = self._get_session("ADMINAPP", "test@example.com")
+        s3 = self._get_session("APPID", "other@example.com")
+        for i in xrange(5):
+            s1.set("key%d" % (i,), "value")
+        s2.set("hello", "world")
+        s3.set("hello", "world")
+        # Deleting a bucket leaves other apps and other users alone.
+        s1.delete_bucket()
+        self.assertRaises(KeyError, s1.get, "key0")
+        self.assertEquals(s2.get("hello"), "world")
+        self.assertEquals(s3.get("hello"), "world")
+        # The bucket can be used again after deleting it.
+        s1.set("key0", "value")
+        self.assertEquals(s1.get("key0"), "value")
+        # Deleting the user removes their data from all apps.
+        s2.delete_user()
+        self.assertRaises(KeyError, s1.get, "key0")
+        self.assertRaises(KeyError, s2.get, "hello")
+        self.assertEquals(s3.get("hello"), "world")
+
+    def test_change_feed(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertEquals(s.changes(), [])
+        s.set("hello", "world")
+        s.set("hi", "there")
+        s.set("hello", "everybody")
+        changes = s.changes()
+        self.assertEquals([(c.seq, c.key) for c in changes],
+                          [(2, "hi"), (3, "hello")])
+        self.assertEquals(changes[1].item.value, "everybody")
+        self.assertEquals(changes[1].item.etag, s.getitem("hello").etag)
+        # Deletions show up as tombstones.
+        s.delete("hi")
+        changes = s.changes(since=3)
+        self.assertEquals([(c.seq, c.key, c.deleted) for c in changes],
+                          [(4, "hi", True)])
+        self.assertEquals(len(s.changes(since=0, limit=1)), 1)
+        self.assertEquals(s.changes(since=4), [])
+        # Binary values come through intact.
+        s.set("binary", "\x00\xff\r\n")
+        changes = s.changes(since=4)
+        self.assertEquals(changes[0].item.value, "\x00\xff\r\n")
+        # A client that's ahead of a recreated bucket must start over.
+        s.delete_bucket()
+        self.assertRaises(ResyncRequiredError, s.changes, since=5)
+        s.set("hello", "world")
+        self.assertRaises(ResyncRequiredError, s.changes, since=5)
+        self.assertEquals([c.key for c in s.changes()], ["hello"])
+
+    def test_watch_key(self):
+        s1 = self._get_session("APPID", "test@example.com")
+        s2 = self._get_session("APPID", "test@example.com")
+        # There's no need to wait if the etag is already out of date.
+        s1.set("hello", "world")
+        self.assertEquals(s1.watch("hello").value, "world")
+        etag = s1.getitem("hello").etag
+        self.assertEquals(s1.watch("hello", etag, timeout=0.1), None)
+        # A write from another thread wakes up the waiter.
+        t = threading.Timer(0.2, s2.set, ("hello", "there"))
+        t.start()
+        try:
+            item = s1.watch("hello", etag, timeout=5)
+        finally:
+            t.join()
+        self.assertEquals(item.value, "there")
+        # As does a delete.
+        t = threading.Timer(0.2, s2.delete, ("hello",))
+        t.start()
+        try:
+            self.assertRaises(KeyError, s1.watch, "hello", item.etag,
+                              timeout=5)
+        finally:
+            t.join()
+
+    def test_watch_changes(self):
+        s1 = self._get_session("APPID", "test@example.com")
+        s2 = self._get_session("APPID", "test@example.com")
+        s1.set("hello", "world")
+        seq = s1.changes()[-1].seq
+        self.assertEquals(s1.changes(since=seq, wait=1), [])
+        t = threading.Timer(0.2, s2.set, ("hi", "there"))
+        t.start()
+        try:
+            changes = s1.changes(since=seq, wait=5)
+        finally:
+            t.join()
+        self.assertEquals([c.key for c in changes], ["hi"])
+
 
 class TestSauropodDirectAPI(unittest.TestCase, SauropodConnectionTests):
     """Run the Sauropod testsuite against a local SQL-backed store."""
@@ -145,7 +326,33 @@ class TestSauropodDirectAPI(unittest.TestCase, SauropodConnectionTests):
     def _get_store(self, appid):
         kwds = {"create_tables": True,
                 "verifier": "vep:DummyVerifier"}
-        return connect("sqlite:////tmp/sauropod.db", appid, **kwds)
+        store = connect("sqlite:////tmp/sauropod.db", appid, **kwds)
+        # Use tiny batches to exercise the batching of bulk operations.
+        store.backend.batch_size = 2
+        return store
+
+    def test_async_operations(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertEquals(s.store.max_workers, 10)
+        # Writes to SQLite are done one at a time, reads all at once.
+        for i in xrange(20):
+            s.set_async("key%d" % (i,), "value%d" % (i,)).get()
+        results = [s.get_async("key%d" % (i,)) for i in xrange(20)]
+        self.assertEquals([r.get() for r in results],
+                          ["value%d" % (i,) for i in xrange(20)])
+        item = s.getitem_async("key0").get()
+        self.assertRaises(ConflictError, s.delete_async("key0",
+                                                        if_match="X").get)
+        s.delete_async("key0", if_match=item.etag).get()
+        self.assertRaises(KeyError, s.get_async("key0").get)
+        # imap() fans out over a long iterable, giving results in order.
+        keys = ("key%d" % (i % 19 + 1,) for i in xrange(100))
+        values = list(s.store.imap(s.get, keys))
+        self.assertEquals(values, ["value%d" % (i % 19 + 1,)
+                                   for i in xrange(100)])
+        self.assertRaises(KeyError, list, s.store.imap(s.get, ["key0"]))
+        s.store.close()
+        self.assertEquals(s.store._executor, None)
 
 
 class TestSauropodWebAPI(unittest.TestCase, SauropodConnectionTests):
@@ -166,7 +373,11 @@ class TestSauropodWebAPI(unittest.TestCase, SauropodConnectionTests):
            # Stub out the credentials-checking for testing purposes.
            "sauropod.credentials.verifier": "vep:DummyVerifier",
            "sauropod.credentials.backend":
-               "pysauropod.server.credentials:BrowserIDCredentials"}
+               "pysauropod.server.credentials:BrowserIDCredentials",
+           # Allow one app to perform administrative actions.
+           "sauropod.security.admin_apps": "ADMINAPP",
+           # Use a small quota so that it's easy to exceed.
+           "sauropod.storage.quota_items": "20"}
         self.config.add_settings(settings)
 
         # Load up pysauropod.server.
@@ -196,6 +407,160 @@ class TestSauropodWebAPI(unittest.TestCase, SauropodConnectionTests):
     def _get_store(self, appid):
         return connect(self.server.base_url, appid)
 
+    def test_delete_user_requires_admin_app(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        self.assertRaises(AuthenticationError, s.delete_user)
+        s2 = self._get_session("ADMINAPP", "other@example.com")
+        self.assertRaises(AuthenticationError, s2.delete_user,
+                          "test@example.com")
+        self.assertEquals(s.get("hello"), "world")
+
+    def test_metrics_are_served_to_admin_apps(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        s.get("hello")
+        self.assertRaises(KeyError, s.get, "missing")
+        self.assertRaises(AuthenticationError, s.request, "/metrics")
+        s2 = self._get_session("ADMINAPP", "test@example.com")
+        metrics = s2.request("/metrics").content
+        self.assertTrue('sauropod_request_duration_seconds_count'
+                        '{service="key",method="PUT"} 1\n' in metrics)
+        self.assertTrue('sauropod_request_errors_total'
+                        '{service="key",method="GET",error="HTTPNotFound"} 1\n'
+                        in metrics)
+        self.assertTrue('sauropod_backend_duration_seconds_count'
+                        '{operation="getitem"} 2\n' in metrics)
+        self.assertTrue('sauropod_request_db_queries_total'
+                        '{service="key",method="GET"}' in metrics)
+
+    def test_server_timing_header(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        r = s.request(s.keypath("hello"))
+        timings = r.headers["Server-Timing"].split(", ")
+        self.assertEquals(timings[0].split(";")[0], "db")
+        self.assertTrue(timings[0].endswith(';desc="1 queries"'))
+        self.assertTrue(timings[1].startswith("total;dur="))
+
+    def test_batch_checks_each_operation(self):
+        s = self._get_session("APPID", "test@example.com")
+        s2 = self._get_session("APPID", "other@example.com")
+        s2.set("hello", "world")
+        with s.batch() as b:
+            b.set("hello", "there")
+            b.get("hello", userid="other@example.com")
+            b.delete("hello", userid="other@example.com")
+            b.get("hello")
+        self.assertTrue(isinstance(b.results[1], AuthenticationError))
+        self.assertTrue(isinstance(b.results[2], AuthenticationError))
+        self.assertEquals(b.results[3].value, "there")
+        self.assertEquals(s2.get("hello"), "world")
+        # Malformed batches are rejected without doing anything.
+        self.assertRaises(ServerError, s.request, "/batch", "POST",
+                          '{"operations": [{"op": "frob"}]}')
+        body = '{"operations": [{"op": "delete", "appid": "APPID",'\
+               ' "userid": "test@example.com", "key": "hello"},'\
+               ' {"op": "set", "appid": "APPID",'\
+               ' "userid": "test@example.com", "key": "hello"}]}'
+        self.assertRaises(ServerError, s.request, "/batch", "POST", body)
+        self.assertEquals(s.get("hello"), "there")
+
+    def test_batch_groups_gets_by_bucket(self):
+        s = self._get_session("APPID", "test@example.com")
+        with s.batch() as b:
+            for i in xrange(5):
+                b.set("key%d" % (i,), "value")
+            for i in xrange(5):
+                b.get("key%d" % (i,))
+        self.assertEquals([item.value for item in b.results[5:]],
+                          ["value"] * 5)
+        s2 = self._get_session("ADMINAPP", "test@example.com")
+        metrics = s2.request("/metrics").content
+        self.assertTrue('sauropod_backend_duration_seconds_count'
+                        '{operation="getitems"} 1\n' in metrics)
+
+    def test_raw_and_form_encoded_values(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertTrue("raw-values" in s.store.features)
+        # Raw values can be arbitrary bytes.
+        item = s.set("binary", "\x00\xff\r\n")
+        self.assertEquals(s.get("binary"), "\x00\xff\r\n")
+        self.assertEquals(s.getitem("binary").etag, item.etag)
+        r = s.request(s.keypath("binary"),
+                      headers={"Accept": "application/octet-stream"})
+        self.assertEquals(r.headers["Content-Type"],
+                          "application/octet-stream")
+        # Without raw values, they're form-encoded and read back from JSON.
+        s.store.raw_values = False
+        item = s.set("hello", u"caf\xe9".encode("utf8"))
+        self.assertEquals(s.get("hello"), u"caf\xe9")
+        self.assertEquals(s.getitem("hello").etag, item.etag)
+        s.store.raw_values = True
+        self.assertEquals(s.get("hello"), u"caf\xe9".encode("utf8"))
+
+    def test_binary_values_as_json(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("binary", "\x00\xff\r\n")
+        r = s.request(s.keypath("binary"),
+                      headers={"Accept": "application/json"})
+        data = json.loads(r.content)
+        self.assertEquals(data["encoding"], "base64")
+        self.assertEquals(data["value"], "AP8NCg==")
+        s.store.raw_values = False
+        self.assertEquals(s.get("binary"), "\x00\xff\r\n")
+        # Text values are sent as they are.
+        s.set("text", "hello")
+        r = s.request(s.keypath("text"),
+                      headers={"Accept": "application/json"})
+        self.assertFalse("encoding" in json.loads(r.content))
+
+    def test_large_responses_are_compressed(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("small", "x" * 10)
+        item = s.set("large", "x" * 5000)
+        s.set("gzipped", "\x1f\x8b" + "x" * 5000)
+        # The client asks for compression and transparently decodes it.
+        r = s.request(s.keypath("large"),
+                      headers={"Accept": "application/octet-stream"})
+        self.assertEquals(r.headers["Content-Encoding"], "gzip")
+        self.assertEquals(r.content, "x" * 5000)
+        self.assertEquals(r.headers["ETag"], item.etag + "-gzip")
+        self.assertEquals(s.get("large"), "x" * 5000)
+        self.assertEquals(s.getitem("large").etag, item.etag)
+        # The suffixed etag is accepted in conditional requests.
+        self.assertEquals(s.watch("large", r.headers["ETag"], timeout=0.1),
+                          None)
+        item = s.set("large", "y" * 5000, if_match=r.headers["ETag"])
+        # Deflate is used for clients that prefer it.
+        headers = {"Accept": "application/octet-stream",
+                   "Accept-Encoding": "deflate, gzip;q=0.5"}
+        r = s.request(s.keypath("large"), headers=headers)
+        self.assertEquals(r.headers["Content-Encoding"], "deflate")
+        self.assertEquals(r.headers["Vary"], "Accept-Encoding")
+        self.assertEquals(r.headers["ETag"], item.etag + "-deflate")
+        self.assertEquals(r.content, "y" * 5000)
+        # Small and already-compressed values are sent as-is.
+        for key in ("small", "gzipped"):
+            r = s.request(s.keypath(key), headers=headers)
+            self.assertFalse("Content-Encoding" in r.headers)
+        # As is everything, for clients that don't accept compression.
+        headers["Accept-Encoding"] = "identity"
+        r = s.request(s.keypath("large"), headers=headers)
+        self.assertFalse("Content-Encoding" in r.headers)
+        self.assertEquals(r.headers["ETag"], item.etag)
+        self.assertEquals(r.content, "y" * 5000)
+
+    def test_writes_over_quota_are_rejected(self):
+        s = self._get_session("APPID", "test@example.com")
+        for i in xrange(20):
+            s.set("key%d" % (i,), "value")
+        self.assertRaises(QuotaExceededError, s.set, "one-too-many", "value")
+        self.assertRaises(KeyError, s.get, "one-too-many")
+        # Overwriting existing keys is still allowed.
+        s.set("key0", "new value")
+        self.assertEquals(s.get("key0"), "new value")
+
     def test_connection_pooling(self):
         # Capture logging messages from requests module.
         handler = CaptureLoggingHandler()
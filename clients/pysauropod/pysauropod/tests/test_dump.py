@@ -0,0 +1,80 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import unittest
+import tempfile
+from StringIO import StringIO
+
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.dump import write_dump, read_dump, main
+
+
+class TestDumpAndLoad(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                                  create_tables=True, batch_size=3)
+        for appid in ("APP1", "APP2"):
+            for userid in ("alice", "bob"):
+                for i in xrange(5):
+                    value = "%s-%s-%d" % (appid, userid, i)
+                    self.backend.set(appid, userid, "key%d" % (i,), value)
+
+    def tearDown(self):
+        self.backend.close()
+        try:
+            os.unlink("/tmp/sauropod.db")
+        except EnvironmentError:
+            pass
+
+    def test_dump_streams_in_key_order(self):
+        records = list(self.backend.dump())
+        self.assertEquals(len(records), 20)
+        self.assertEquals(records[0], ("APP1", "alice", "key0",
+                                       "APP1-alice-0"))
+        self.assertEquals(records, sorted(records))
+        records = list(self.backend.dump("APP2"))
+        self.assertEquals(len(records), 10)
+        records = list(self.backend.dump("APP2", "bob"))
+        self.assertEquals([r[2] for r in records],
+                          ["key0", "key1", "key2", "key3", "key4"])
+
+    def test_round_trip_through_dump_file(self):
+        f = StringIO()
+        self.assertEquals(write_dump(f, self.backend.dump("APP1")), 10)
+        f.seek(0)
+        # Overwrite some values, to be restored by loading the dump.
+        self.backend.set("APP1", "alice", "key0", "CHANGED")
+        self.backend.delete("APP1", "bob", "key3")
+        self.assertEquals(self.backend.load(read_dump(f)), 10)
+        item = self.backend.getitem("APP1", "alice", "key0")
+        self.assertEquals(item.value, "APP1-alice-0")
+        item = self.backend.getitem("APP1", "bob", "key3")
+        self.assertEquals(item.value, "APP1-bob-3")
+
+    def test_reading_invalid_dumps(self):
+        self.assertRaises(ValueError, list, read_dump(StringIO("JUNK")))
+        f = StringIO()
+        write_dump(f, self.backend.dump())
+        truncated = StringIO(f.getvalue()[:-1])
+        self.assertRaises(ValueError, list, read_dump(truncated))
+
+    def test_command_line_tool(self):
+        fd, dbfile = tempfile.mkstemp()
+        os.close(fd)
+        fd, dumpfile = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            with open(dumpfile, "wb") as f:
+                write_dump(f, self.backend.dump())
+            dburl = "sqlite:///" + dbfile
+            main(["import", dburl, dumpfile, "--create-tables", "--quiet"])
+            main(["export", dburl, dumpfile, "--appid", "APP2", "--quiet"])
+            with open(dumpfile, "rb") as f:
+                records = list(read_dump(f))
+            self.assertEquals(records, list(self.backend.dump("APP2")))
+        finally:
+            os.unlink(dbfile)
+            os.unlink(dumpfile)
@@ -0,0 +1,178 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import socket
+import unittest
+import threading
+
+import vep
+
+from pysauropod import connect
+from pysauropod.errors import ConflictError, AuthenticationError, ServerError
+from pysauropod.interfaces import ISauropodBackend
+from pysauropod.server.evented import make_registry, EventedServer
+
+
+class TestEventedServer(unittest.TestCase):
+
+    def setUp(self):
+        settings = {
+           "sauropod.storage.backend": "pysauropod.backends.sql:SQLBackend",
+           "sauropod.storage.sqluri": "sqlite:////tmp/sauropod.db",
+           "sauropod.storage.create_tables": True,
+           "sauropod.credentials.verifier": "vep:DummyVerifier",
+           "sauropod.credentials.backend":
+               "pysauropod.server.credentials:BrowserIDCredentials"}
+        self.registry = make_registry(settings=settings)
+        self.server = EventedServer(self.registry, "localhost", 0,
+                                    num_threads=2)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.base_url = "http://localhost:%d" % (self.server.address[1],)
+
+    def tearDown(self):
+        self.server.stop()
+        self.thread.join()
+        try:
+            os.unlink("/tmp/sauropod.db")
+        except EnvironmentError:
+            pass
+
+    def _get_session(self, appid, userid, **kwds):
+        store = connect(self.base_url, appid, **kwds)
+        assertion = vep.DummyVerifier.make_assertion(userid, appid)
+        credentials = {"audience": appid, "assertion": assertion}
+        return store.start_session(userid, credentials)
+
+    def _raw_request(self, sock, data):
+        sock.sendall(data)
+        response = ""
+        while True:
+            chunk = sock.recv(4096)
+            if not chunk:
+                break
+            response += chunk
+        return response
+
+    def test_basic_get_set_delete(self):
+        for raw_values in (True, False):
+            s = self._get_session("APPID", "test@example.com",
+                                  raw_values=raw_values)
+            self.assertEquals(s.store.features, set(["raw-values", "ttl"]))
+            self.assertRaises(KeyError, s.get, "hello/there")
+            item = s.set("hello/there", "world")
+            self.assertEquals(s.getitem("hello/there").etag, item.etag)
+            self.assertRaises(ConflictError, s.set, "hello/there", "X",
+                              if_match="badetag")
+            s.set("hello/there", "again", if_match=item.etag)
+            self.assertEquals(s.get("hello/there"), "again")
+            r = s.request(s.keypath(""))
+            self.assertEquals(r.content, "hello/there")
+            s.delete("hello/there")
+            self.assertRaises(KeyError, s.get, "hello/there")
+            self.assertRaises(KeyError, s.delete, "hello/there")
+
+    def test_compressed_responses_have_their_own_etag(self):
+        s = self._get_session("APPID", "test@example.com")
+        item = s.set("large", "x" * 5000)
+        r = s.request(s.keypath("large"))
+        self.assertEquals(r.headers["Content-Encoding"], "gzip")
+        self.assertEquals(r.headers["ETag"], item.etag + "-gzip")
+        self.assertEquals(s.getitem("large").etag, item.etag)
+        self.assertEquals(s.watch("large", r.headers["ETag"], timeout=0.1),
+                          None)
+        s.set("large", "y" * 5000, if_match=r.headers["ETag"])
+        self.assertEquals(s.get("large"), "y" * 5000)
+
+    def test_delete_bucket(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        s.set("hello/there", "world")
+        s2 = self._get_session("OTHERAPP", "test@example.com")
+        s2.set("hello", "world")
+        s.delete_bucket()
+        self.assertRaises(KeyError, s.get, "hello")
+        self.assertEquals(s.request(s.keypath("")).content, "")
+        self.assertEquals(s2.get("hello"), "world")
+
+    def test_keys_can_be_set_with_a_ttl(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("nonce", "value", ttl=60)
+        backend = self.registry.getUtility(ISauropodBackend)
+        item = backend.getitem("APPID", "test@example.com", "nonce")
+        self.assertTrue(0 < item.expires - time.time() <= 61)
+        headers = {"Content-Type": "application/octet-stream",
+                   "X-Sauropod-TTL": "-1"}
+        try:
+            s.request(s.keypath("nonce"), "PUT", "x", headers)
+        except ServerError, e:
+            self.assertEquals(e.status_code, 400)
+        else:
+            self.fail("invalid TTL was accepted")
+
+    def test_permissions_are_checked(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        s2 = self._get_session("APPID", "other@example.com")
+        self.assertRaises(AuthenticationError, s2.get, "hello",
+                          userid="test@example.com")
+        self.assertRaises(AuthenticationError, s2.request,
+                          s.keypath("hello"), "DELETE")
+        self.assertRaises(AuthenticationError, s2.delete_bucket,
+                          "test@example.com")
+        self.assertEquals(s.get("hello"), "world")
+        s.sessionid = "invalid"
+        self.assertRaises(AuthenticationError, s.get, "hello")
+
+    def test_stopping_a_stopped_server(self):
+        self.server.stop()
+        self.thread.join()
+        self.server.stop()
+
+    def test_watch_holds_no_threads(self):
+        s = self._get_session("APPID", "test@example.com")
+        item = s.set("hello", "world")
+        # More watches than there are threads in the executor.
+        results = []
+        def watch():
+            s = self._get_session("APPID", "test@example.com")
+            results.append(s.watch("hello", item.etag, timeout=10))
+        watchers = [threading.Thread(target=watch) for _ in xrange(5)]
+        for watcher in watchers:
+            watcher.start()
+        time.sleep(0.5)
+        self.assertEquals(s.get("hello"), "world")
+        s.set("hello", "there")
+        for watcher in watchers:
+            watcher.join()
+        self.assertEquals([result.value for result in results],
+                          ["there"] * 5)
+        # With no change, the watch times out.
+        start = time.time()
+        self.assertEquals(s.watch("hello", results[0].etag, timeout=1), None)
+        self.assertTrue(time.time() - start >= 1)
+
+    def test_idle_and_pipelined_connections(self):
+        s = self._get_session("APPID", "test@example.com")
+        s.set("hello", "world")
+        idle = [socket.create_connection(self.server.address)
+                for _ in xrange(100)]
+        try:
+            self.assertEquals(s.get("hello"), "world")
+            path = s.keypath("hello")
+            request = "GET %s HTTP/1.1\r\nSignature: %s\r\n"\
+                      "Accept: application/octet-stream\r\n\r\n"
+            request = request % (path, s.sessionid)
+            sock = socket.create_connection(self.server.address)
+            response = self._raw_request(sock, request * 2 +
+                                         "GET /nowhere HTTP/1.0\r\n\r\n")
+            self.assertEquals(response.count("HTTP/1.1 200 OK"), 2)
+            self.assertEquals(response.count("\r\n\r\nworld"), 2)
+            self.assertTrue(response.endswith("Connection: close\r\n\r\n"))
+            self.assertTrue("HTTP/1.1 404 Not Found" in response)
+        finally:
+            for sock in idle:
+                sock.close()
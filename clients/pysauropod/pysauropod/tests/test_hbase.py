@@ -0,0 +1,184 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from pysauropod import connect
+from pysauropod.errors import ConflictError
+from pysauropod.backends.hbase import VALUE_COLUMN, DELETING_PREFIX
+from pysauropod.tests.test_connection import SauropodConnectionTests
+from pysauropod.tests.fakehbase import FakeHBase, FakeHBaseServer
+
+
+class RacingFakeHBase(FakeHBase):
+    """FakeHBase where another client writes to a row just after a get()."""
+
+    race = None
+
+    def get(self, tableName, row, column):
+        cells = FakeHBase.get(self, tableName, row, column)
+        if self.race is not None:
+            value, self.race = self.race, None
+            self.mutateRow(tableName, row, [_Put(column, value)])
+        return cells
+
+
+class _Put(object):
+    """Minimal stand-in for a Mutation object setting a value."""
+
+    isDelete = False
+
+    def __init__(self, column, value):
+        self.column = column
+        self.value = value
+
+
+class TestSauropodHBaseAPI(unittest.TestCase, SauropodConnectionTests):
+    """Run the Sauropod testsuite against an HBase-backed store.
+
+    This testsuite serves an in-memory fake of the HBase thrift gateway
+    from a background thread, and runs the testsuite against an HBaseBackend
+    connected to it.
+    """
+
+    def setUp(self):
+        self.hbase = FakeHBaseServer(RacingFakeHBase())
+        self.hbase.start()
+        self.stores = []
+
+    def tearDown(self):
+        for store in self.stores:
+            store.backend.close()
+        self.hbase.shutdown()
+
+    def _get_store(self, appid, hbase=None):
+        if hbase is None:
+            hbase = self.hbase
+        url = "hbase://localhost:%d" % (hbase.port,)
+        kwds = {"create_tables": True,
+                "verifier": "vep:DummyVerifier"}
+        store = connect(url, appid, **kwds)
+        self.stores.append(store)
+        return store
+
+    def test_usage_stats(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertRaises(NotImplementedError, s.getstats)
+
+    def test_change_feed(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertRaises(NotImplementedError, s.changes)
+
+    def test_watch_changes(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertRaises(NotImplementedError, s.changes, wait=1)
+
+    def test_expiring_keys(self):
+        s = self._get_session("APPID", "test@example.com")
+        self.assertRaises(NotImplementedError, s.set, "nonce", "value", ttl=1)
+
+    def test_one_table_per_app(self):
+        s1 = self._get_session("APP1", "test@example.com")
+        s2 = self._get_session("APP2", "test@example.com")
+        s1.set("hello", "one")
+        s2.set("hello", "two")
+        self.assertEquals(len(self.hbase.handler.tables), 2)
+        self.assertEquals(s1.get("hello"), "one")
+        self.assertEquals(s2.get("hello"), "two")
+
+    def test_listkeys_scans_only_the_bucket(self):
+        backend = self._get_store("APPID").backend
+        backend.batch_size = 3
+        items = [("key%d" % (i,), "value%d" % (i,)) for i in xrange(10)]
+        backend.set_many("APPID", "test@example.com", items)
+        backend.set("APPID", "other@example.com", "key5", "other")
+        keys = list(backend.listkeys("APPID", "test@example.com"))
+        self.assertEquals(keys, [k for (k, v) in items])
+        keys = backend.listkeys("APPID", "test@example.com", "key3", "key6")
+        self.assertEquals(list(keys), ["key3", "key4", "key5"])
+        keys = backend.listkeys("APPID", "test@example.com", "key3", limit=4)
+        self.assertEquals(list(keys), ["key3", "key4", "key5", "key6"])
+        keys = backend.listkeys("APPID", "nobody@example.com")
+        self.assertEquals(list(keys), [])
+        keys = backend.listkeys("NOAPP", "test@example.com")
+        self.assertEquals(list(keys), [])
+
+    def test_connections_are_pooled(self):
+        backend = self._get_store("APPID").backend
+        for i in xrange(10):
+            backend.set("APPID", "test@example.com", "hello", "world")
+            backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(backend._pool._num_clients, 1)
+
+    def test_dump_and_load_a_bucket(self):
+        backend = self._get_store("APPID").backend
+        backend.batch_size = 2
+        items = [("key%d" % (i,), "value%d" % (i,)) for i in xrange(5)]
+        backend.set_many("APPID", "test@example.com", items)
+        records = list(backend.dump("APPID", "test@example.com"))
+        self.assertEquals(records, [("APPID", "test@example.com", k, v)
+                                    for (k, v) in items])
+        self.assertRaises(ValueError, list, backend.dump("APPID"))
+        records = [("APPID", "other@example.com", k, v) for (_, _, k, v)
+                   in records]
+        self.assertEquals(backend.load(records), 5)
+        keys = backend.listkeys("APPID", "other@example.com")
+        self.assertEquals(list(keys), [k for (k, v) in items])
+
+    def test_conditional_writes_are_atomic(self):
+        backend = self._get_store("APPID").backend
+        item = backend.set("APPID", "test@example.com", "hello", "world")
+        # Another write landing between the etag check and the put makes
+        # the put fail, rather than silently overwriting it.
+        self.hbase.handler.race = "racer"
+        self.assertRaises(ConflictError, backend.set, "APPID",
+                          "test@example.com", "hello", "mine", item.etag)
+        item = backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "racer")
+        self.hbase.handler.race = "racer again"
+        self.assertRaises(ConflictError, backend.delete, "APPID",
+                          "test@example.com", "hello", item.etag)
+        item = backend.getitem("APPID", "test@example.com", "hello")
+        self.assertEquals(item.value, "racer again")
+        # Without a race, a conditional delete removes the row entirely.
+        backend.delete("APPID", "test@example.com", "hello", item.etag)
+        self.assertRaises(KeyError, backend.getitem, "APPID",
+                          "test@example.com", "hello")
+        for table in self.hbase.handler.tables.itervalues():
+            self.assertEquals(table, {})
+
+    def test_pending_deletes_read_as_missing(self):
+        backend = self._get_store("APPID").backend
+        backend.set("APPID", "test@example.com", "hello", "world")
+        backend.set("APPID", "test@example.com", "other", "value")
+        table = self.hbase.handler.tables.values()[0]
+        for row in table:
+            if row.endswith("hello"):
+                table[row] = {VALUE_COLUMN: (DELETING_PREFIX + "x", 1)}
+        self.assertRaises(KeyError, backend.getitem, "APPID",
+                          "test@example.com", "hello")
+        keys = backend.listkeys("APPID", "test@example.com")
+        self.assertEquals(list(keys), ["other"])
+        records = backend.dump("APPID", "test@example.com")
+        self.assertEquals([r[2] for r in records], ["other"])
+        backend.set("APPID", "test@example.com", "hello", "again", "")
+        self.assertEquals(backend.getitem("APPID", "test@example.com",
+                                          "hello").value, "again")
+
+    def test_old_gateways_refuse_conditional_writes(self):
+        old_hbase = FakeHBaseServer(check_and_put=False)
+        old_hbase.start()
+        try:
+            backend = self._get_store("APPID", old_hbase).backend
+            item = backend.set("APPID", "test@example.com", "hello", "world")
+            self.assertRaises(NotImplementedError, backend.set, "APPID",
+                              "test@example.com", "hello", "X", item.etag)
+            self.assertRaises(NotImplementedError, backend.delete, "APPID",
+                              "test@example.com", "hello", item.etag)
+            # The connection is still usable afterwards.
+            self.assertEquals(backend.getitem("APPID", "test@example.com",
+                                              "hello").value, "world")
+            self.assertEquals(backend._pool._num_clients, 1)
+        finally:
+            old_hbase.shutdown()
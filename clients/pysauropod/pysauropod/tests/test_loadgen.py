@@ -0,0 +1,75 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import random
+import unittest
+
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.benchmarks.loadgen import (ZipfKeys, Workload, Reporter,
+                                           parse_sizes, parse_mix, run)
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def tearDown(self):
+        if os.path.exists("/tmp/sauropod.db"):
+            os.unlink("/tmp/sauropod.db")
+
+    def test_zipf_keys_favour_low_numbers(self):
+        pick = ZipfKeys(100, 1.2)
+        rng = random.Random(42)
+        counts = [0] * 100
+        for _ in xrange(10000):
+            counts[pick(rng)] += 1
+        self.assertTrue(counts[0] > counts[1] > counts[10] > counts[99])
+        uniform = ZipfKeys(4, 0)
+        self.assertEquals(uniform.cdf, [0.25, 0.5, 0.75, 1.0])
+
+    def test_parsing_of_distributions(self):
+        rng = random.Random(42)
+        self.assertEquals(parse_sizes("fixed:10")(rng), 10)
+        for _ in xrange(100):
+            self.assertTrue(5 <= parse_sizes("uniform:5:8")(rng) <= 8)
+            self.assertTrue(parse_sizes("lognormal:100:1")(rng) >= 1)
+        self.assertRaises(ValueError, parse_sizes, "normal:5")
+        self.assertRaises(ValueError, parse_sizes, "fixed:big")
+        self.assertEquals(parse_mix("read=3,list=1"), {"read": 3, "list": 1})
+        self.assertRaises(ValueError, parse_mix, "read=1,update=1")
+        self.assertRaises(ValueError, parse_mix, "read=0")
+
+    def test_workload_only_picks_weighted_ops(self):
+        workload = Workload(num_users=2, mix="read=1,delete=1")
+        rng = random.Random(42)
+        picked = set()
+        for _ in xrange(100):
+            op, userid, key = workload.pick_op(rng)
+            picked.add(op)
+            self.assertTrue(userid in ("user0@example.com",
+                                       "user1@example.com"))
+        self.assertEquals(picked, set(["read", "delete"]))
+
+    def test_reporter_merges_intervals_from_all_processes(self):
+        reporter = Reporter(2, 1)
+        reporter.add(1, [("read", 0.001, None)])
+        self.assertEquals(reporter.intervals, [])
+        reporter.add(1, [("write", 0.002, "HTTP 500")])
+        reporter.add(2, [("read", 0.003, None)])
+        results = reporter.finish()
+        self.assertEquals([r["requests"] for r in results["intervals"]],
+                          [2, 1])
+        self.assertEquals(results["intervals"][0]["errors"], 1)
+        self.assertEquals(results["summary"]["read"]["requests"], 2)
+        self.assertEquals(results["summary"]["write"]["errors"], 1)
+
+    def test_run_against_wsgi_app(self):
+        sqluri = "sqlite:////tmp/sauropod.db"
+        SQLBackend(sqluri, create_tables=True).close()
+        workload = Workload(num_users=3, num_keys=10, conditional=0.5)
+        results = run("wsgi:" + sqluri, workload, num_threads=1,
+                      duration=1, interval=0.5, seed=42)
+        self.assertTrue(results["intervals"])
+        summary = results["summary"]
+        self.assertTrue(sum(r["requests"] for r in summary.values()) > 0)
+        self.assertEquals(sum(r["errors"] for r in summary.values()), 0)
@@ -0,0 +1,68 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+import threading
+
+from pysauropod.server.metrics import MetricsRegistry, InstrumentedBackend
+
+
+class DummyBackend(object):
+
+    def getitem(self, appid, userid, key):
+        raise KeyError(key)
+
+    def listkeys(self, appid, userid):
+        for key in ("a", "b"):
+            yield key
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram_rendering(self):
+        metrics = MetricsRegistry(buckets=(0.1, 1.0))
+        labels = (("service", "key"), ("method", "GET"))
+        metrics.record("sauropod_request", labels, 0.05)
+        metrics.record("sauropod_request", labels, 0.5, "HTTPNotFound")
+        metrics.record("sauropod_request", labels, 5.0)
+        lines = metrics.render().splitlines()
+        prefix = 'sauropod_request_duration_seconds'
+        labels = '{service="key",method="GET"'
+        self.assertTrue(prefix + '_bucket' + labels + ',le="0.1"} 1' in lines)
+        self.assertTrue(prefix + '_bucket' + labels + ',le="1.0"} 2' in lines)
+        self.assertTrue(prefix + '_bucket' + labels + ',le="+Inf"} 3' in lines)
+        self.assertTrue(prefix + '_count' + labels + '} 3' in lines)
+        self.assertTrue('sauropod_request_errors_total' + labels +
+                        ',error="HTTPNotFound"} 1' in lines)
+
+    def test_shards_from_exited_threads_are_kept(self):
+        metrics = MetricsRegistry()
+        labels = (("operation", "set"),)
+
+        def record():
+            for _ in xrange(10):
+                metrics.record("sauropod_backend", labels, 0.01)
+
+        threads = [threading.Thread(target=record) for _ in xrange(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        record()
+        key = ("sauropod_backend", labels)
+        self.assertEquals(metrics.collect()[key].count, 60)
+        # Only the shard for the live thread is kept separately.
+        self.assertEquals(len(metrics._shards), 1)
+        self.assertEquals(metrics.collect()[key].count, 60)
+
+    def test_instrumented_backend(self):
+        metrics = MetricsRegistry()
+        backend = InstrumentedBackend(DummyBackend(), metrics)
+        self.assertRaises(KeyError, backend.getitem, "APP", "user", "key")
+        self.assertEquals(list(backend.listkeys("APP", "user")), ["a", "b"])
+        stats = metrics.collect()
+        getitem = stats[("sauropod_backend", (("operation", "getitem"),))]
+        self.assertEquals(getitem.errors, {"KeyError": 1})
+        listkeys = stats[("sauropod_backend", (("operation", "listkeys"),))]
+        self.assertEquals(listkeys.count, 1)
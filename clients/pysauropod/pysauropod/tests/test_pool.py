@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import sqlite3
+import unittest
+
+from pysauropod.errors import ServerBusyError
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.backends.pool import InstrumentedPool, AdaptivePool
+from pysauropod.server.views import server_busy
+from pysauropod.server.metrics import MetricsRegistry
+
+
+def connect():
+    return sqlite3.connect(":memory:", check_same_thread=False)
+
+
+class TestPools(unittest.TestCase):
+
+    def test_checkout_telemetry(self):
+        pool = InstrumentedPool(connect, pool_size=1, max_overflow=1,
+                                timeout=0.01)
+        conn1 = pool.connect()
+        conn2 = pool.connect()
+        self.assertRaises(ServerBusyError, pool.connect)
+        conn2.close()
+        conn1.close()
+        pool.connect().close()
+        stats = pool.stats
+        self.assertEquals((stats.checkouts, stats.timeouts), (3, 1))
+        self.assertEquals(stats.overflows, 1)
+        self.assertTrue(stats.wait_time >= 0.01)
+        metrics = MetricsRegistry()
+        for source in stats.metric_sources():
+            metrics.add_source(*source)
+        lines = metrics.render().splitlines()
+        self.assertTrue("# TYPE sauropod_pool_connections gauge" in lines)
+        self.assertTrue('sauropod_pool_connections{state="idle"} 1' in lines)
+        self.assertTrue('sauropod_pool_checkouts_total{result="timeout"} 1'
+                        in lines)
+        wait_lines = [ln for ln in lines if ln.startswith(
+                      "sauropod_pool_checkout_wait_seconds_total")]
+        self.assertTrue(float(wait_lines[0].split()[1]) >= 0.01)
+        pool.dispose()
+
+    def test_adaptive_pool_grows_and_shrinks(self):
+        pool = AdaptivePool(connect, pool_size=1, max_overflow=7,
+                            timeout=0.01)
+        pool.configure(min_size=2, adjust_interval=0)
+        self.assertEquals((pool.size(), pool.max_size), (2, 8))
+        # Needing more connections than the pool keeps makes it grow.
+        conns = [pool.connect() for _ in xrange(6)]
+        self.assertEquals(pool.size(), 6)
+        for conn in conns:
+            conn.close()
+        self.assertEquals(pool.checkedin(), 6)
+        # But never beyond the most connections it may open.
+        conns = [pool.connect() for _ in xrange(8)]
+        self.assertRaises(ServerBusyError, pool.connect)
+        self.assertEquals(pool.size(), 8)
+        for conn in conns:
+            conn.close()
+        # Light use makes it shrink, closing the spare connections.
+        for _ in xrange(10):
+            pool.connect().close()
+        self.assertEquals(pool.size(), 2)
+        self.assertEquals(pool.checkedin(), 2)
+        self.assertEquals(pool.checkedout(), 0)
+        pool.dispose()
+
+    def test_sql_backend_pool_stats(self):
+        backend = SQLBackend("sqlite:////tmp/sauropod.db", create_tables=True,
+                             sqlite_tuned=True)
+        try:
+            backend.set("APPID", "alice", "a", "1")
+            self.assertTrue(backend.pool_stats.checkouts > 0)
+        finally:
+            backend.close()
+            for suffix in ("", "-wal", "-shm"):
+                try:
+                    os.unlink("/tmp/sauropod.db" + suffix)
+                except EnvironmentError:
+                    pass
+
+    def test_server_busy_errors_give_503(self):
+        r = server_busy(ServerBusyError("busy", retry_after=5), None)
+        self.assertEquals(r.status_int, 503)
+        self.assertEquals(r.headers["Retry-After"], "5")
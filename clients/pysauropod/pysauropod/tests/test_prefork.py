@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import signal
+import urllib2
+import tempfile
+import threading
+import unittest
+import multiprocessing
+
+from pysauropod.server.prefork import (PreforkServer, make_app_factory,
+                                       pool_size_for_workers)
+
+
+def pid_app(environ, start_response):
+    """WSGI app that responds slowly with the pid of its process."""
+    time.sleep(0.1)
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [str(os.getpid())]
+
+
+class TestPreforkServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = PreforkServer(lambda: pid_app, "localhost", 0,
+                                    num_workers=2, num_threads=1,
+                                    graceful_timeout=5)
+        self.url = "http://localhost:%d/" % (self.server.address[1],)
+        self.master = multiprocessing.Process(
+                                  target=self.server.serve_forever)
+        self.master.start()
+        self.server.sock.close()
+
+    def tearDown(self):
+        if self.master.is_alive():
+            os.kill(self.master.pid, signal.SIGKILL)
+            self.master.join()
+        if os.path.exists("/tmp/sauropod.db"):
+            os.unlink("/tmp/sauropod.db")
+
+    def _get_pids(self, num_requests=6):
+        pids = []
+
+        def get_pid():
+            pids.append(int(urllib2.urlopen(self.url).read()))
+
+        threads = [threading.Thread(target=get_pid)
+                   for _ in xrange(num_requests)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return set(pids)
+
+    def test_requests_are_spread_over_workers(self):
+        pids = self._get_pids()
+        self.assertEquals(len(pids), 2)
+        self.assertFalse(self.master.pid in pids)
+
+    def test_graceful_reload_and_shutdown(self):
+        old_pids = self._get_pids()
+        os.kill(self.master.pid, signal.SIGHUP)
+        for _ in xrange(50):
+            new_pids = self._get_pids()
+            if not new_pids & old_pids:
+                break
+        self.assertEquals(len(new_pids), 2)
+        self.assertFalse(new_pids & old_pids)
+        os.kill(self.master.pid, signal.SIGTERM)
+        self.master.join(10)
+        self.assertEquals(self.master.exitcode, 0)
+        self.assertRaises(urllib2.URLError, urllib2.urlopen, self.url)
+
+    def test_pool_size_for_workers(self):
+        self.assertEquals(pool_size_for_workers(40, 4, 20), 10)
+        self.assertEquals(pool_size_for_workers(40, 4, 5), 5)
+        self.assertEquals(pool_size_for_workers(3, 4, 5), 1)
+
+    def test_app_factory_overrides_pool_size_from_config(self):
+        fd, config_file = tempfile.mkstemp(suffix=".ini")
+        try:
+            os.write(fd, "[sauropod.storage]\n"
+                         "backend = pysauropod.backends.sql:SQLBackend\n"
+                         "sqluri = sqlite:////tmp/sauropod.db\n"
+                         "create_tables = true\n"
+                         "pool_size = 100\n"
+                         "[sauropod.session]\n"
+                         "backend = pysauropod.server.session."
+                         "SignedSessionManager\n"
+                         "[sauropod.credentials]\n"
+                         "backend = pysauropod.server.credentials."
+                         "BrowserIDCredentials\n"
+                         "verifier = vep:DummyVerifier\n")
+            os.close(fd)
+            app = make_app_factory(config_file, pool_size=7)()
+        finally:
+            os.unlink(config_file)
+        settings = app.registry.settings
+        self.assertEquals(settings["sauropod.storage.pool_size"], 7)
+        self.assertEquals(settings["config"].get("sauropod.storage",
+                                                 "pool_size"), 7)
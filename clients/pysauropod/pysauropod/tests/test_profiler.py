@@ -0,0 +1,91 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+from pysauropod.server.profiler import ProfilerMiddleware, make_profiler
+
+
+def hello_app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return ["hello world"]
+
+
+class DummyRoute(object):
+
+    def __init__(self, name, prefix):
+        self.name = name
+        self.prefix = prefix
+
+    def match(self, path):
+        if path.startswith(self.prefix):
+            return {}
+        return None
+
+
+class TestProfilerMiddleware(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _call(self, app, path, **environ):
+        environ["PATH_INFO"] = path
+        environ["REQUEST_METHOD"] = "GET"
+        return app(environ, lambda status, headers: None)
+
+    def test_disabled_by_default(self):
+        self.assertTrue(make_profiler(hello_app, {}) is hello_app)
+        settings = {"sauropod.profiler.enabled": "true",
+                    "sauropod.profiler.directory": self.directory,
+                    "sauropod.profiler.sample_rate": "0.5"}
+        app = make_profiler(hello_app, settings)
+        self.assertEquals(app.sample_rate, 0.5)
+
+    def test_profiles_are_aggregated_per_endpoint(self):
+        routes = [DummyRoute("keys", "/keys"), DummyRoute("stats", "/stats")]
+        app = ProfilerMiddleware(hello_app, self.directory, sample_rate=1,
+                                 routes=routes)
+        for _ in xrange(3):
+            self.assertEquals(self._call(app, "/keys/a"), ["hello world"])
+        self._call(app, "/stats")
+        self._call(app, "/other")
+        app.flush()
+        files = sorted(f.rsplit(".", 2)[0] for f in os.listdir(self.directory))
+        self.assertEquals(files, ["keys.GET", "stats.GET", "unknown.GET"])
+        for filename in os.listdir(self.directory):
+            if filename.startswith("keys."):
+                stats = pstats.Stats(os.path.join(self.directory, filename))
+        calls = [v[0] for (k, v) in stats.stats.iteritems()
+                 if k[2] == "hello_app"]
+        self.assertEquals(calls, [3])
+
+    def test_old_files_are_rotated(self):
+        app = ProfilerMiddleware(hello_app, self.directory, sample_rate=1,
+                                 max_files=2)
+        for i in xrange(4):
+            # Fake up old files, as flushes happen at most once per second.
+            filename = "unknown.GET.%d.pstats" % (1000 + i,)
+            open(os.path.join(self.directory, filename), "w").close()
+        self._call(app, "/")
+        app.flush()
+        files = sorted(os.listdir(self.directory))
+        self.assertEquals(len(files), 2)
+        self.assertEquals(files[0], "unknown.GET.1003.pstats")
+
+    def test_debug_header(self):
+        app = ProfilerMiddleware(hello_app, self.directory, sample_rate=0,
+                                 debug_token="secret")
+        self._call(app, "/", HTTP_X_SAUROPOD_PROFILE="wrong")
+        app.flush()
+        self.assertEquals(os.listdir(self.directory), [])
+        self._call(app, "/", HTTP_X_SAUROPOD_PROFILE="secret")
+        app.flush()
+        self.assertEquals(len(os.listdir(self.directory)), 1)
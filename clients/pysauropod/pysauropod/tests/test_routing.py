@@ -0,0 +1,162 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import time
+import unittest
+
+from pysauropod import connect, WebAPIConnection
+from pysauropod.errors import ConnectionError, AuthenticationError
+from pysauropod.routing import Node, HashRing, bucket_key
+from pysauropod.tests import test_connection
+
+
+def make_ring(count, vnodes=100):
+    nodes = [Node("http://node%d/" % (i,), None) for i in xrange(count)]
+    return HashRing(nodes, vnodes)
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_buckets_are_spread_over_the_nodes(self):
+        ring = make_ring(4)
+        counts = dict((node.url, 0) for node in ring.nodes)
+        for i in xrange(4000):
+            node = ring.get_nodes(bucket_key("APPID", "user%d" % (i,)))[0]
+            counts[node.url] += 1
+        for count in counts.itervalues():
+            self.assertTrue(700 < count < 1300, counts)
+
+    def test_replicas_are_distinct_nodes(self):
+        ring = make_ring(3)
+        nodes = ring.get_nodes(bucket_key("APPID", "alice"), 2)
+        self.assertEquals(len(set(nodes)), 2)
+        nodes = ring.get_nodes(bucket_key("APPID", "alice"), 5)
+        self.assertEquals(len(set(nodes)), 3)
+
+    def test_adding_a_node_moves_few_buckets(self):
+        keys = [bucket_key("APPID", "user%d" % (i,)) for i in xrange(2000)]
+        ring = make_ring(4)
+        before = [ring.get_nodes(key)[0].url for key in keys]
+        ring = make_ring(5)
+        after = [ring.get_nodes(key)[0].url for key in keys]
+        moved = [a for (b, a) in zip(before, after) if a != b]
+        # About a fifth of them should move, and all to the new node.
+        self.assertTrue(len(moved) < len(keys) * 0.3, len(moved))
+        self.assertEquals(set(moved), set(["http://node4/"]))
+
+    def test_lists_of_urls_connect_to_several_nodes(self):
+        store = connect(["http://node1/", "http://node2/"], "APPID")
+        self.assertTrue(isinstance(store, WebAPIConnection))
+        self.assertEquals(len(store.nodes), 2)
+        store = connect("http://node1/ http://node2/", "APPID")
+        self.assertEquals([n.url for n in store.nodes],
+                          ["http://node1/", "http://node2/"])
+
+
+class TestMultiNodeWebAPI(test_connection.TestSauropodWebAPI):
+    """Run the web API tests against several nodes sharing one backend."""
+
+    PORTS = (8080, 8081, 8082)
+
+    def setUp(self):
+        super(TestMultiNodeWebAPI, self).setUp()
+        self.busy = set()
+        self.hits = dict((port, 0) for port in self.PORTS)
+        self.server.shutdown()
+        self.servers = {}
+        for port in self.PORTS:
+            app = self._wrap_app(self.app, port)
+            server = test_connection.TestingServer(app, port)
+            server.start()
+            self.servers[port] = server
+        self.server = self.servers[self.PORTS[0]]
+
+    def tearDown(self):
+        for server in self.servers.itervalues():
+            if hasattr(server, "server"):
+                server.shutdown()
+        try:
+            os.unlink("/tmp/sauropod.db")
+        except EnvironmentError:
+            pass
+
+    def _wrap_app(self, app, port):
+        def wrapped_app(environ, start_response):
+            self.hits[port] += 1
+            if port in self.busy:
+                start_response("503 Service Unavailable",
+                               [("Retry-After", "30")])
+                return ["busy"]
+            return app(environ, start_response)
+        return wrapped_app
+
+    def _get_store(self, appid):
+        urls = [self.servers[port].base_url for port in self.PORTS]
+        return connect(urls, appid)
+
+    def _owner(self, store, userid, appid="APPID"):
+        return int(store.nodes_for(userid, appid)[0].url.rsplit(":", 1)[1])
+
+    def test_buckets_are_routed_to_their_nodes(self):
+        store = self._get_store("APPID")
+        users = ["user%d@example.com" % (i,) for i in xrange(12)]
+        owners = set(self._owner(store, userid) for userid in users)
+        self.assertEquals(owners, set(self.PORTS))
+        for userid in users:
+            s = self._get_session("APPID", userid)
+            owner = self._owner(s.store, userid)
+            before = dict(self.hits)
+            s.set("hello", "world")
+            self.assertEquals(s.get("hello"), "world")
+            self.assertEquals(self.hits[owner], before[owner] + 2)
+
+    def test_failover_when_a_node_is_down(self):
+        s = self._get_session("APPID", "test@example.com")
+        owner = self._owner(s.store, "test@example.com")
+        s.set("hello", "world")
+        self.servers[owner].shutdown()
+        self.assertEquals(s.get("hello"), "world")
+        node = s.store.nodes_for("test@example.com")[0]
+        self.assertFalse(node.is_available())
+        self.assertEquals(node.failures, 1)
+        # The down node isn't tried again until its retry interval is up.
+        s.set("hello", "there")
+        self.assertEquals(node.failures, 1)
+        # With no replicas to fail over to, the error comes through.
+        s.store.replicas = 0
+        self.assertRaises(ConnectionError, s.get, "hello")
+
+    def test_failover_when_a_node_is_busy(self):
+        s = self._get_session("APPID", "test@example.com")
+        owner = self._owner(s.store, "test@example.com")
+        s.set("hello", "world")
+        self.busy.add(owner)
+        before = dict(self.hits)
+        self.assertEquals(s.get("hello"), "world")
+        self.assertEquals(s.get("hello"), "world")
+        self.assertEquals(self.hits[owner], before[owner] + 1)
+        node = s.store.nodes_for("test@example.com")[0]
+        self.assertFalse(node.is_available())
+        self.assertTrue(node.down_until > time.time() + 25)
+
+    def test_batches_are_split_between_nodes(self):
+        s = self._get_session("APPID", "test@example.com")
+        users = ["user%d@example.com" % (i,) for i in xrange(6)]
+        owners = set(self._owner(s.store, userid) for userid in users)
+        self.assertTrue(len(owners) > 1)
+        before = dict(self.hits)
+        with s.batch() as b:
+            b.set("hello", "world")
+            for userid in users:
+                b.get("hello", userid=userid)
+            b.get("hello")
+        # Each node was sent the operations for its own buckets, and the
+        # results are put back in the original order.
+        hit = [port for port in self.PORTS if self.hits[port] > before[port]]
+        self.assertTrue(len(hit) > 1)
+        self.assertEquals(b.results[0].value, "world")
+        for result in b.results[1:-1]:
+            self.assertTrue(isinstance(result, AuthenticationError))
+        self.assertEquals(b.results[-1].value, "world")
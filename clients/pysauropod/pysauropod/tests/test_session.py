@@ -0,0 +1,36 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from pysauropod.server import session
+from pysauropod.server.session import SignedSessionManager
+
+
+class TestSignedSessionManager(unittest.TestCase):
+
+    def setUp(self):
+        self.manager = SignedSessionManager("SECRET")
+        self._orig_urandom = session.os.urandom
+
+    def tearDown(self):
+        session.os.urandom = self._orig_urandom
+
+    def test_session_data_roundtrips(self):
+        sessionid = self.manager.new_session("APPID", "test@example.com")
+        self.assertEquals(self.manager.get_session_data(sessionid),
+                          ("APPID", u"test@example.com"))
+
+    def test_colons_in_the_random_prefix_and_appid(self):
+        session.os.urandom = lambda n: ":" * n
+        appid = "http://example.com:8080"
+        sessionid = self.manager.new_session(appid, "test@example.com")
+        self.assertEquals(self.manager.get_session_data(sessionid),
+                          (appid, u"test@example.com"))
+
+    def test_bad_signatures_are_rejected(self):
+        sessionid = self.manager.new_session("APPID", "test@example.com")
+        other = SignedSessionManager("OTHER SECRET")
+        self.assertEquals(other.get_session_data(sessionid), None)
+        self.assertEquals(self.manager.get_session_data(sessionid + "x"), None)
@@ -0,0 +1,298 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import logging
+import unittest
+import threading
+
+from sqlalchemy import inspect
+
+from pysauropod.errors import QuotaExceededError, ResyncRequiredError
+from pysauropod.backends.sql import SQLBackend
+from pysauropod.server.sweeper import Sweeper
+from pysauropod.tests.test_connection import CaptureLoggingHandler
+
+
+class TestSQLBackend(unittest.TestCase):
+
+    def setUp(self):
+        self.backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                                  create_tables=True, batch_size=2)
+
+    def tearDown(self):
+        self.backend.close()
+        for suffix in ("", "-wal", "-shm"):
+            try:
+                os.unlink("/tmp/sauropod.db" + suffix)
+            except EnvironmentError:
+                pass
+
+    def test_quotas(self):
+        self.backend.quota_items = 2
+        self.backend.quota_bytes = 20
+        self.backend.set("APPID", "alice", "a", "1234")
+        self.backend.set("APPID", "alice", "b", "1234")
+        self.backend.set("APPID", "bob", "c", "1234567890123456789")
+        # Too many items.
+        self.assertRaises(QuotaExceededError, self.backend.set,
+                          "APPID", "alice", "c", "1234")
+        # Too many bytes.
+        self.backend.quota_items = None
+        self.assertRaises(QuotaExceededError, self.backend.set,
+                          "APPID", "alice", "a", "123456789012345")
+        # Shrinking writes and deletes are always allowed.
+        self.backend.quota_bytes = 5
+        self.backend.set("APPID", "alice", "a", "123")
+        self.backend.delete("APPID", "alice", "b")
+        stats = self.backend.getstats("APPID", "alice")
+        self.assertEquals(stats, {"items": 1, "bytes": 4})
+
+    def test_concurrent_writes_respect_the_quota(self):
+        self.backend.quota_items = 5
+        errors = []
+
+        def write(i):
+            try:
+                self.backend.set("APPID", "alice", "key%d" % (i,), "value")
+            except QuotaExceededError:
+                pass
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=write, args=(i,))
+                   for i in xrange(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        stats = self.backend.getstats("APPID", "alice")
+        self.assertEquals(stats["items"], 5)
+        keys = list(self.backend.listkeys("APPID", "alice"))
+        self.assertEquals(len(keys), 5)
+
+    def test_stats_are_counted_for_buckets_without_them(self):
+        key = u"caf\xe9".encode("utf8")
+        self.backend.set("APPID", "alice", "a", "1234")
+        self.backend.set("APPID", "alice", key, "123")
+        # Buckets from before the counters were kept have no stats row.
+        self.backend.execute("DELETE FROM bucket_stats")
+        self.backend.delete("APPID", "alice", "a")
+        stats = self.backend.getstats("APPID", "alice")
+        self.assertEquals(stats, {"items": 1, "bytes": 8})
+        self.backend.execute("DELETE FROM bucket_stats")
+        self.backend.quota_items = 2
+        self.backend.set("APPID", "alice", "b", "12")
+        self.assertRaises(QuotaExceededError, self.backend.set,
+                          "APPID", "alice", "c", "12")
+        stats = self.backend.getstats("APPID", "alice")
+        self.assertEquals(stats, {"items": 2, "bytes": 11})
+
+    def test_items_are_compact_and_hold_bytestrings(self):
+        value = u"caf\xe9".encode("utf8")
+        self.backend.set("APPID", "alice", "a", value)
+        item = self.backend.getitem("APPID", "alice", "a")
+        self.assertFalse(hasattr(item, "__dict__"))
+        self.assertEquals(type(item.value), str)
+        self.assertEquals(item.value, value)
+        self.assertEquals(type(item.bucket), int)
+        change, = self.backend.changes("APPID", "alice")
+        self.assertEquals(change.item.bucket, item.bucket)
+
+    def test_getitems_in_batches(self):
+        for key in ("a", "b", "c", "d"):
+            self.backend.set("APPID", "alice", key, key * 2)
+        self.backend.set("APPID", "bob", "e", "ee")
+        items = self.backend.getitems("APPID", "alice", ["a", "c", "d", "e"])
+        self.assertEquals(sorted(items), ["a", "c", "d"])
+        self.assertEquals(items["d"].value, "dd")
+        self.assertEquals(items["d"].etag,
+                          self.backend.getitem("APPID", "alice", "d").etag)
+        self.assertEquals(self.backend.getitems("APPID", "carol", ["a"]), {})
+
+    def test_load_maintains_stats(self):
+        records = [("APPID", "alice", "key%d" % (i,), "value")
+                   for i in xrange(5)]
+        self.backend.load(records)
+        stats = self.backend.getstats("APPID", "alice")
+        self.assertEquals(stats, {"items": 5, "bytes": 45})
+        # Reloading overwrites, so the counts don't change.
+        self.backend.load(records)
+        stats = self.backend.getstats("APPID", "alice")
+        self.assertEquals(stats, {"items": 5, "bytes": 45})
+
+    def test_load_records_changes(self):
+        self.backend.set("APPID", "alice", "key1", "old")
+        self.backend.delete("APPID", "alice", "key1")
+        records = [("APPID", "alice", "key%d" % (i,), "value")
+                   for i in xrange(3)]
+        self.backend.load(records)
+        changes = self.backend.changes("APPID", "alice", since=2)
+        self.assertEquals([(c.seq, c.key) for c in changes],
+                          [(3, "key0"), (4, "key1"), (5, "key2")])
+        self.assertFalse(any(c.deleted for c in changes))
+
+    def test_tombstone_compaction(self):
+        for i in xrange(5):
+            self.backend.set("APPID", "alice", "key%d" % (i,), "value")
+        for i in xrange(4):
+            self.backend.delete("APPID", "alice", "key%d" % (i,))
+        self.backend.set("APPID", "alice", "key0", "again")
+        # Recent tombstones are kept.
+        self.assertEquals(self.backend.compact_changes(), 0)
+        self.assertEquals(len(self.backend.changes("APPID", "alice", 1)), 5)
+        # Old ones are discarded, and resuming from before them fails.
+        self.assertEquals(self.backend.compact_changes(retention=-1), 3)
+        changes = self.backend.changes("APPID", "alice")
+        self.assertEquals([c.key for c in changes], ["key4", "key0"])
+        self.assertRaises(ResyncRequiredError,
+                          self.backend.changes, "APPID", "alice", 8)
+        changes = self.backend.changes("APPID", "alice", 9)
+        self.assertEquals([c.key for c in changes], ["key0"])
+
+    def test_expired_items_are_hidden_then_swept(self):
+        self.backend.expiry_batch_size = 2
+        for i in xrange(5):
+            self.backend.set("APPID", "alice", "key%d" % (i,), "value",
+                             ttl=3600)
+        self.backend.set("APPID", "alice", "kept", "value")
+        self.assertEquals(self.backend.getitem("APPID", "alice",
+                                               "key0").value, "value")
+        self.backend.execute("UPDATE items SET expires = 1"
+                             " WHERE key IN ('key0', 'key1', 'key2')")
+        # Expired items read as missing, but still count towards the quota.
+        self.assertRaises(KeyError, self.backend.getitem,
+                          "APPID", "alice", "key0")
+        items = self.backend.getitems("APPID", "alice", ["key0", "key3"])
+        self.assertEquals(items.keys(), ["key3"])
+        self.assertEquals(list(self.backend.listkeys("APPID", "alice")),
+                          ["kept", "key3", "key4"])
+        changes = self.backend.changes("APPID", "alice")
+        self.assertEquals([c.item for c in changes[:3]], [None, None, None])
+        self.assertEquals(len(list(self.backend.dump())), 3)
+        self.assertEquals(self.backend.getstats("APPID", "alice")["items"], 6)
+        # Writing to an expired key replaces it, without a TTL by default.
+        self.backend.set("APPID", "alice", "key2", "again")
+        self.assertEquals(self.backend.getitem("APPID", "alice",
+                                               "key2").expires, None)
+        # The rest are deleted by the sweeper, leaving tombstones.
+        counts = Sweeper(self.backend).sweep()
+        self.assertEquals(counts, {"expire_items": 2, "compact_changes": 0})
+        self.assertEquals(self.backend.expire_items(), 0)
+        self.assertEquals(self.backend.getstats("APPID", "alice")["items"], 4)
+        changes = self.backend.changes("APPID", "alice", 7)
+        self.assertEquals([(c.seq, c.key, c.item) for c in changes],
+                          [(8, "key0", None), (9, "key1", None)])
+
+    def test_expiry_column_is_added_to_old_tables(self):
+        self.backend.close()
+        os.unlink("/tmp/sauropod.db")
+        backend = SQLBackend("sqlite:////tmp/sauropod.db")
+        backend.execute("CREATE TABLE items (bucket INTEGER NOT NULL,"
+                        " key VARCHAR(256) NOT NULL, value BLOB NOT NULL,"
+                        " PRIMARY KEY (bucket, key))")
+        backend.close()
+        self.backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                                  create_tables=True)
+        self.backend.set("APPID", "alice", "a", "1", ttl=60)
+        item = self.backend.getitem("APPID", "alice", "a")
+        self.assertTrue(item.expires > 0)
+
+    def test_missing_indexes_are_added_to_old_tables(self):
+        self.backend.close()
+        os.unlink("/tmp/sauropod.db")
+        backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                             create_tables=True)
+        backend.execute("DROP INDEX idx_buckets_userid")
+        backend.close()
+        self.backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                                  create_tables=True)
+        indexes = inspect(self.backend._engine).get_indexes("buckets")
+        self.assertTrue("idx_buckets_userid" in
+                        [index["name"] for index in indexes])
+        # Opening the store again leaves the indexes alone.
+        self.backend.close()
+        self.backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                                  create_tables=True)
+
+    def test_query_stats_and_slow_query_log(self):
+        self.backend.set("APPID", "alice", "a", "1234")
+        self.backend.query_stats.reset()
+        self.backend.getitem("APPID", "alice", "a")
+        self.assertEquals(self.backend.query_stats.count, 1)
+        self.assertTrue(self.backend.query_stats.duration > 0)
+        handler = CaptureLoggingHandler()
+        logger = logging.getLogger("pysauropod.backends.sql")
+        logger.addHandler(handler)
+        try:
+            self.backend.slow_query_threshold = 0
+            self.backend.set("APPID", "alice", "a", "secret value")
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(len(handler.messages),
+                          self.backend.query_stats.count - 1)
+        msg = handler.messages[0].getMessage()
+        self.assertTrue(msg.startswith("slow query"))
+        self.assertTrue("FROM items" in msg)
+        for record in handler.messages:
+            self.assertFalse("secret" in record.getMessage())
+
+
+class TestTunedSQLiteBackend(TestSQLBackend):
+    """Run the SQLBackend tests against a tuned SQLite database."""
+
+    def setUp(self):
+        self.backend = SQLBackend("sqlite:////tmp/sauropod.db",
+                                  create_tables=True, batch_size=2,
+                                  sqlite_tuned="true", pool_size=20)
+
+    def test_pragmas_are_applied(self):
+        self.assertTrue(self.backend.sqlite_tuned)
+        self.assertEquals(self.backend.max_connections, 20)
+        for engine in (self.backend._engine, self.backend._reader):
+            mode = engine.execute("PRAGMA journal_mode").scalar()
+            self.assertEquals(mode.lower(), "wal")
+            sync = engine.execute("PRAGMA synchronous").scalar()
+            self.assertEquals(sync, 1)
+            timeout = engine.execute("PRAGMA busy_timeout").scalar()
+            self.assertEquals(timeout, 5000)
+        # In-memory databases can't be tuned.
+        backend = SQLBackend("sqlite:///:memory:", sqlite_tuned=True)
+        self.assertFalse(backend.sqlite_tuned)
+        backend.close()
+
+    def test_concurrent_reads_and_writes(self):
+        self.backend.set("APPID", "alice", "shared", "0")
+        errors = []
+
+        def writer(n):
+            try:
+                for i in xrange(20):
+                    self.backend.set("APPID", "user%d" % (n,), str(i), "x")
+                    self.backend.set("APPID", "alice", "shared", str(i))
+            except Exception, e:
+                errors.append(e)
+
+        def reader():
+            try:
+                for i in xrange(50):
+                    self.backend.getitem("APPID", "alice", "shared")
+                    list(self.backend.listkeys("APPID", "alice"))
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=writer, args=(n,))
+                   for n in xrange(4)]
+        threads.extend(threading.Thread(target=reader) for _ in xrange(8))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(errors, [])
+        for n in xrange(4):
+            stats = self.backend.getstats("APPID", "user%d" % (n,))
+            self.assertEquals(stats["items"], 20)
+        changes = self.backend.changes("APPID", "alice")
+        self.assertEquals(changes[-1].seq, 81)
@@ -11,7 +11,10 @@ with open(os.path.join(here, 'README.rst')) as f:
 with open(os.path.join(here, 'CHANGES.txt')) as f:
     CHANGES = f.read()
 
-requires = ["pyramid", "cornice", "mozsvc", "requests", "PyVEP"]
+# The metrics label requests with their matched route's name, which older
+# versions of cornice set to the service's path rather than its name.
+requires = ["SQLAlchemy>=1.3,<1.4", "WebOb>=1.8", "pyramid>=1.5",
+            "cornice>=0.14", "mozsvc", "requests", "PyVEP"]
 
 
 setup(name='pysauropod',
@@ -29,6 +32,18 @@ setup(name='pysauropod',
       include_package_data=True,
       zip_safe=False,
       install_requires=requires,
+      extras_require={"bench": ["WebTest"],
+                      # Later versions of thrift break the accelerated
+                      # binary protocol under python 2.
+                      "hbase": ["thrift>=0.9,<0.10", "hbase-thrift"]},
       tests_require=requires,
       test_suite="pysauropod",
+      entry_points="""
+      [console_scripts]
+      sauropod-dump = pysauropod.dump:main
+      sauropod-bench = pysauropod.benchmarks:main
+      sauropod-loadgen = pysauropod.benchmarks.loadgen:main
+      sauropod-server = pysauropod.server.prefork:main
+      sauropod-evented-server = pysauropod.server.evented:main
+      """,
       )